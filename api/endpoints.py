@@ -1,4 +1,4 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Response, Request, Form
+from fastapi import APIRouter, UploadFile, File, HTTPException, Response, Request, Form, Depends
 from typing import List, Dict, Any, Tuple, Optional
 import os
 from werkzeug.utils import secure_filename
@@ -6,26 +6,40 @@ from collections import defaultdict
 from music21 import *
 import math
 import base64
-from services.database import MongoDatabase
-from services.soundslice import SoundsliceService
+import json
+import asyncio
+from services.database import AsyncMongoDatabase, get_async_database, VALIDATION_INVALID, VALIDATION_PENDING, VALIDATION_VALID
 from api.models import (
     MeasureRequest, MeasureResponse, GenerateRequest,
     SliceRequest, MusicXMLRequest, ExerciseResponse,
     FileDataRequest, FileDataResponse, ExerciseRequest,
-    DeleteScoreRequest
+    DeleteScoreRequest, ManifestRequest, ManifestResponse,
+    ExerciseFetchRequest, ExerciseFetchResponse,
+    BatchGenerateRequest, BatchGenerateResponse,
+    PrerenderRequest, PrerenderResponse
 )
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from music.processor import get_music21_score_notation, get_musicxml_from_music21, get_music21_from_music_matrix_representation
-from music.exercise import get_all_exercises
+from music.exercise import get_all_exercises, deduplicate_musicxml, musicxml_id, normalize_exercise_types, filter_exercise_types, EXERCISE_TYPES
+from music.cache import parsed_score_cache, frozen_score_cache, content_hash
+from music.tasks import (
+    generate_exercises_from_bytes, measure_range_from_bytes,
+    exercise_manifest_from_bytes, exercise_from_bytes, stream_exercises_from_bytes,
+    generate_exercise_batch_from_bytes, validate_score_bytes
+)
+from services.workers import process_pool, PoolSaturatedError
+from core.config import GENERATE_BATCH_MAX_ITEMS, LIST_FILES_MAX_LIMIT, SOUNDSLICE_PRERENDER_MAX_EXERCISES
+from music.chunks import covers_range, spanners_cross
+from services.precompute import schedule_score_processing, PRECOMPUTE_JOB
+from services.slice_jobs import schedule_slice_upload, finish_slice_job, prerender_slices, SLICE_JOB
+from services.slicehash_cache import slicehash_cache
+from services.storage import ScoreStorage, ScoreTooLargeError
+from services.result_cache import GENERATOR_VERSION, exercise_result_cache, exercise_result_key, exercise_manifest_cache, exercise_item_cache
 
 
 # Create router
 router = APIRouter()
 
-# Initialize services
-db = MongoDatabase()
-soundslice = SoundsliceService()
-
 # Configuration
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(CURRENT_DIR)))
@@ -36,8 +50,78 @@ ALLOWED_EXTENSIONS = {'xml', 'musicxml', 'mxl'}
 def allowed_file(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Score hash storage
-scoreToScorehash = defaultdict(str)
+async def run_in_pool(fn, *args):
+    """Run a CPU-bound task in the process pool, answering 503 when the pool is saturated."""
+    try:
+        return await process_pool.run(fn, *args)
+    except PoolSaturatedError:
+        raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
+
+async def get_score_data(db: AsyncMongoDatabase, score_name: str) -> bytes:
+    """
+    Fetch a score's raw bytes from the database, or 404 (422 if its background parse failed).
+    A score whose background parse has not finished is parsed here first, and its processing is
+    queued again if no job is running it.
+    """
+    score = await db.get_score(score_name)
+    if not score or not score.get('data'):
+        raise HTTPException(status_code=404, detail="Score not found or no data available")
+    if score['validation_status'] == VALIDATION_INVALID:
+        raise HTTPException(status_code=422, detail=f"Invalid MusicXML file: {score.get('validation_error')}")
+    data = bytes(score['data'])
+    if score['validation_status'] == VALIDATION_PENDING:
+        digest = content_hash(data)
+        await schedule_score_processing(score_name, digest)
+        try:
+            await run_in_pool(validate_score_bytes, data)
+        except ValueError as e:
+            await db.set_validation_status(digest, VALIDATION_INVALID, str(e))
+            raise HTTPException(status_code=422, detail=f"Invalid MusicXML file: {e}")
+        await db.set_validation_status(digest, VALIDATION_VALID)
+    return data
+
+async def get_excerpt_chunks(db: AsyncMongoDatabase, digest: str, start_measure: int, end_measure: int) -> Optional[Dict[str, Any]]:
+    """
+    The stored chunks covering a measure range, for the tasks to parse instead of the whole
+    score, or None if this score data was not chunked, the range is not within it, or a
+    spanner crosses the edges of its chunks.
+    """
+    header = await db.get_score_chunk_header(digest)
+    if header is None or not covers_range(header, start_measure, end_measure):
+        return None
+    chunks = await db.get_score_chunks(digest, start_measure, end_measure)
+    if not chunks or spanners_cross(chunks):
+        return None
+    return {"header": header, "chunks": chunks}
+
+def get_exercise_types(exercise_types: Optional[List[str]]) -> Tuple[str, ...]:
+    """Validate requested exercise types, or 400."""
+    try:
+        return normalize_exercise_types(exercise_types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def get_cached_exercises(db: AsyncMongoDatabase, digest: str, start_measure: int, end_measure: int, exercise_types: Tuple[str, ...]):
+    """
+    Look up an exercise set in the result cache, then among the precomputed windows. A subset
+    of the exercise types can also be cut out of a cached or precomputed full set. Sets found
+    other than under their own key are cached under it, so it can serve as their generation_id.
+    """
+    key = exercise_result_key(digest, start_measure, end_measure, exercise_types)
+    exercises = await exercise_result_cache.get(key)
+    if exercises is not None:
+        return exercises
+
+    full = None
+    if exercise_types != EXERCISE_TYPES:
+        full = await exercise_result_cache.get(exercise_result_key(digest, start_measure, end_measure))
+    if full is None:
+        full = await db.get_precomputed_exercises(digest, start_measure, end_measure, GENERATOR_VERSION)
+    if full is None:
+        return None
+    exercises = full if exercise_types == EXERCISE_TYPES else filter_exercise_types(full, exercise_types)
+    await exercise_result_cache.put(key, exercises, content_hash=digest, start_measure=start_measure, end_measure=end_measure)
+    return exercises
 
 @router.get("/test")
 async def test_endpoint():
@@ -48,9 +132,19 @@ async def test_endpoint():
 async def upload_score(
     file: UploadFile = File(...),
     title: str = Form(...),
-    composer: str = Form(...)
-) -> Response:
-    """Upload a MusicXML score file."""
+    composer: str = Form(...),
+    db: AsyncMongoDatabase = Depends(get_async_database)
+) -> Dict:
+    """
+    Upload a MusicXML score file and queue its background processing.
+
+    Only the structure of the file is checked here. The job (see /precompute_jobs) fully parses
+    it, setting validation_status on the score to "valid" or "invalid", then stores its chunks
+    and precomputes its exercises. A file with the same content as a stored score shares its
+    stored data, validation, chunks and precomputed exercises: it gets the job processing that
+    content while it is not validated yet (queuing it again if none is running), and a null
+    job_id once it has been.
+    """
     try:
         if not file:
             raise HTTPException(status_code=400, detail='No file uploaded')
@@ -66,23 +160,46 @@ async def upload_score(
         print(title)
         print(composer)
         try:
-            # Read file as bytes
-            contents = await file.read()    
+            # Stream the file into GridFS, hashing it and checking its size on the way
+            storage = ScoreStorage(db)
+            try:
+                stored = await storage.save_upload(filename, file)
+            except ScoreTooLargeError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            # content that is already stored was checked and processed when it was first uploaded
+            blob = await db.get_score_blob(stored['content_hash'])
             try:
-                # Validate the file with music21
-                _ = converter.parse(contents)
-                print("passed music21 validation")
+                if blob is not None and blob.get('validation_status') == VALIDATION_INVALID:
+                    await storage.delete(stored['file_id'])
+                    raise HTTPException(status_code=400, detail=f"Invalid MusicXML file: {blob.get('validation_error')}")
+                # Check the structure of the file; the full music21 parse runs in the background job
+                if blob is None:
+                    try:
+                        await storage.check_structure(stored['file_id'])
+                    except BaseException:
+                        await storage.delete(stored['file_id'])
+                        raise
+                    print("passed MusicXML structure check")
 
                 # Save to database
-                success = db.save_score(filename, title=title, composer=composer, data=contents)
+                success = await db.save_score(filename, title=title, composer=composer, file_id=stored['file_id'],
+                                              content_hash=stored['content_hash'], size=stored['size'])
                 print("saved to database")
                 if not success:
                     raise HTTPException(status_code=500, detail="Failed to save score to database")
+
+                # validate, chunk and warm up the common practice windows in the background, once per content
+                pending = blob is None or blob.get('validation_status') == VALIDATION_PENDING
+                job_id = await schedule_score_processing(filename, stored['content_hash']) if pending else None
                 
-                return Response(status_code=200)
+                return {"job_id": job_id}
+            except HTTPException:
+                raise
             except Exception as e:
                 raise HTTPException(status_code=400, detail=f'Invalid MusicXML file: {str(e)}')
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=400, detail=f'Invalid MusicXML file: {str(e)}')
 
@@ -92,15 +209,30 @@ async def upload_score(
         raise HTTPException(status_code=500, detail=f'Server error: {str(e)}')
 
 @router.get("/list_files", response_model=List[Dict])
-async def list_files() -> List[Dict]:
-    """List all available music files."""
+async def list_files(
+    response: Response,
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+    db: AsyncMongoDatabase = Depends(get_async_database)
+) -> List[Dict]:
+    """
+    List the available music files by name, without their data.
+
+    Without a limit every file is listed. With one, at most that many are, and when the page is
+    full the X-Next-After header holds the score_name to pass as after to get the next page.
+    """
+    if limit is not None and not 1 <= limit <= LIST_FILES_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {LIST_FILES_MAX_LIMIT}")
     try:
-        scores = db.get_all_scores()
+        scores = await db.list_scores(limit=limit, after=after)
+        if limit is not None and len(scores) == limit:
+            response.headers["X-Next-After"] = scores[-1]['score_name']
         res = []
         for score in scores:
-            title = score["title"] if score["title"] is not None else score['score_name']
-            composer = score['composer'] if score['composer'] is not None else ""
-            res.append({'title': title, 'composer': composer, 'score_name': score['score_name'], 'filename': score['score_name']})
+            title = score.get("title") if score.get("title") is not None else score['score_name']
+            composer = score.get('composer') if score.get('composer') is not None else ""
+            res.append({'title': title, 'composer': composer, 'score_name': score['score_name'], 'filename': score['score_name'],
+                        'validation_status': score.get('validation_status', VALIDATION_VALID)})
         return res
 
 
@@ -109,9 +241,27 @@ async def list_files() -> List[Dict]:
         raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
 
 @router.post("/get_file_mxl")
-async def get_file_mxl(data: FileDataRequest):
-    """Get the MXL file data."""
-    score = db.get_score(data.filename)
+async def get_file_mxl(data: FileDataRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """Get the MXL file data, streamed from GridFS for scores stored there."""
+    if data.filename.endswith(".mxl"):
+        media_type = "application/vnd.recordare.musicxml+xml"
+    elif data.filename.endswith(".musicxml") or data.filename.endswith(".xml"):
+        media_type = "application/xml"
+    else:
+        media_type = None
+
+    info = await db.get_score_file_info(data.filename)
+    if info and info.get('file_id'):
+        if media_type is None:
+            raise HTTPException(status_code=400, detail="Invalid file type")
+        return StreamingResponse(
+            ScoreStorage(db).iter_file(info['file_id']),
+            media_type=media_type,
+            headers={"Content-Disposition": f"attachment; filename={data.filename}", "Content-Length": str(info['size'])}
+        )
+
+    # scores stored before GridFS keep their data inline
+    score = await db.get_score(data.filename)
     if score and score.get('data'):
         try:
             file_data = score['data']
@@ -141,66 +291,93 @@ async def get_file_mxl(data: FileDataRequest):
         raise HTTPException(status_code=404, detail="Score not found or no data available")
 
 @router.post("/get_measures_from_seconds", response_model=MeasureResponse)
-async def get_measures_from_seconds(data: MeasureRequest):
+async def get_measures_from_seconds(data: MeasureRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
     """Convert a time in seconds to a measure number."""
-    score = get_music21_score_notation(data.filename)
-    
-    # Get time signature
-    time_signature = score.recurse().getElementsByClass(meter.TimeSignature)[0]
-    
-    # Get tempo marking
-    tempo_marks = score.recurse().getElementsByClass(tempo.MetronomeMark)
-    tempo_marking = tempo_marks[0] if tempo_marks else None
-    bpm = tempo_marking.number if tempo_marking else 120
-
-    # Calculate measure number
-    beats_per_measure = time_signature.numerator
-    if bpm is None:
-        bpm = 120  # Default to 120 BPM if no tempo marking found
-    
-    start_measure = math.floor(data.start_second / 60 * bpm / beats_per_measure) + 1
-    if data.end_second is not None:
-        end_measure = math.floor(data.end_second / 60 * bpm / beats_per_measure) + 1
-        return {"start_measure": start_measure, "end_measure": end_measure}
-    return {"start_measure": start_measure, "end_measure": None}
+    score_data = await get_score_data(db, data.filename)
+    return await run_in_pool(measure_range_from_bytes, data.filename, score_data, data.start_second, data.end_second)
 
 @router.post("/slice_callback")
 async def slice_callback(request: Request):
-    """Handle Soundslice callback after notation processing."""
+    """Handle Soundslice callback after notation processing, marking the upload job done or failed."""
     data = await request.json()
     scorehash = data.get("scorehash")
     success = data.get("success")
     error = data.get("error")
-    
+
+    if scorehash:
+        await finish_slice_job(scorehash, error=(error or "Soundslice could not process the notation") if success == "2" else None)
+
     if success == "2":  # Error case
         raise HTTPException(status_code=400)
     
     return Response(status_code=200)
 
 @router.post("/get_slicehash")
-async def get_slicehash(data: SliceRequest):
-    """Get or create a Soundslice hash for a score."""
+async def get_slicehash(data: SliceRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """
+    Get the Soundslice hash of a score, or queue the creation of its slice and return the job id
+    (see /slice_jobs) with a null slicehash. Scores with the same content share one slice.
+    """
     score_name = data.filename
-    if score_name in scoreToScorehash:
-        return {"slicehash": scoreToScorehash[score_name]}
+    if data.musicxml:
+        digest = content_hash(data.musicxml.encode('utf-8'))
     else:
-        scorehash = soundslice.create_and_upload_slice(score_name, data.musicxml, data.title, data.composer)
-
-        # if the score is an exercise, look in a different part of the mongoDB server
-        if data.is_exercise:
-            score = db.get_exercise(score_name)
-            if score:
-                db.update_exercise_with_slicehash(score_name, scorehash)
-            else:
-                db.save_exercise(score_name, score_hash=bytes(scorehash, 'utf-8'), title=data.title, composer=data.composer, data=None)
-        else:
-            if db.get_score(score_name):
-                db.update_score_with_slicehash(score_name, scorehash)
-            else:
-                db.save_score(score_name, score_hash=bytes(scorehash, 'utf-8'), title=data.title, composer=data.composer, data=None)
+        info = await db.get_score_file_info(score_name)
+        if info is None:
+            raise HTTPException(status_code=404, detail="Score not found")
+        # scores stored inline, before content hashes were kept, are known by name only
+        digest = info.get('content_hash')
 
-        scoreToScorehash[score_name] = scorehash
+    scorehash = await slicehash_cache.get(digest, score_name, data.is_exercise)
+    if scorehash is not None:
         return {"slicehash": scorehash}
+    job_id = await schedule_slice_upload(score_name, digest, data.musicxml, data.title, data.composer, data.is_exercise)
+    return {"slicehash": None, "job_id": job_id}
+
+@router.post("/prerender_slices", response_model=PrerenderResponse)
+async def prerender_exercise_slices(data: PrerenderRequest):
+    """
+    Create the Soundslice slices of a whole exercise set at once, given the generation_id returned
+    by /generate or the exercises themselves. Missing slices are uploaded concurrently; exercises
+    whose notation already has a slice reuse it. Exercises are identified by the ids of their
+    MusicXML, as /generate returns them with dedupe, and saved under those names.
+    """
+    if data.generation_id:
+        exercises = await exercise_result_cache.get(data.generation_id)
+        if exercises is None:
+            raise HTTPException(status_code=404, detail="Exercise set not found; generate it again")
+    elif data.exercises is not None:
+        exercises = data.exercises
+    else:
+        raise HTTPException(status_code=400, detail="Give a generation_id or the exercises")
+
+    indexed, musicxml = deduplicate_musicxml(exercises)
+    if len(musicxml) > SOUNDSLICE_PRERENDER_MAX_EXERCISES:
+        raise HTTPException(status_code=400, detail=f"At most {SOUNDSLICE_PRERENDER_MAX_EXERCISES} exercises can be pre-rendered at once")
+    titles = {}
+    for items in indexed.values():
+        for description, xml_id in items:
+            if xml_id is not None and xml_id not in titles:
+                label = description or xml_id
+                titles[xml_id] = f"{data.title}: {label}" if data.title else label
+
+    slicehashes, errors = await prerender_slices(
+        {xml_id: (titles[xml_id], xml) for xml_id, xml in musicxml.items()}, data.composer
+    )
+    return {"exercises": indexed, "slicehashes": slicehashes, "errors": errors}
+
+@router.get("/slice_jobs")
+async def list_slice_jobs(limit: int = 50, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """List the most recent Soundslice upload jobs and their state."""
+    return await db.get_jobs(SLICE_JOB, limit=limit)
+
+@router.get("/slice_jobs/{job_id}")
+async def get_slice_job(job_id: str, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """Get the state of one Soundslice upload job; its slice is ready once the state is "processing" or "done"."""
+    job = await db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @router.post("/save_musicxml_to_file")
 async def save_musicxml_to_file(data: MusicXMLRequest):
@@ -213,35 +390,288 @@ async def save_musicxml_to_file(data: MusicXMLRequest):
         return {"success": False, "error": str(e)}
 
 @router.post("/generate", response_model=ExerciseResponse)
-async def generate_exercises(data: GenerateRequest):
+async def generate_exercises(data: GenerateRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
     """Generate exercises from a score excerpt."""
-    score_excerpt = get_music21_score_notation(
-        data.filename,
-        data.start_measure,
-        data.end_measure
-    )
-    
-    # Get all exercises
-    raw_exercises = get_all_exercises(score_excerpt)
-    
-    # Filter out None values and invalid tuples
-    filtered_exercises = {}
-    for category, exercises in raw_exercises.items():
-        valid_exercises = [
-            (desc, xml) for desc, xml in exercises 
-            if desc is not None and xml is not None
-        ]
-        if valid_exercises:  # Only include categories with valid exercises
-            filtered_exercises[category] = valid_exercises
+    exercise_types = get_exercise_types(data.exercise_types)
+    score_data = await get_score_data(db, data.filename)
+    digest = content_hash(score_data)
+
+    generation_id = exercise_result_key(digest, data.start_measure, data.end_measure, exercise_types)
+    filtered_exercises = await get_cached_exercises(db, digest, data.start_measure, data.end_measure, exercise_types)
+    if filtered_exercises is None:
+        chunks = await get_excerpt_chunks(db, digest, data.start_measure, data.end_measure)
+        filtered_exercises = await run_in_pool(
+            generate_exercises_from_bytes,
+            data.filename,
+            None if chunks else score_data,
+            data.start_measure,
+            data.end_measure,
+            exercise_types,
+            chunks
+        )
+        await exercise_result_cache.put(
+            generation_id,
+            filtered_exercises,
+            content_hash=digest,
+            start_measure=data.start_measure,
+            end_measure=data.end_measure
+        )
     
+    if data.dedupe:
+        exercises, musicxml = deduplicate_musicxml(filtered_exercises)
+        return {
+            "exercises": exercises,
+            "musicxml": musicxml,
+            "start_measure": data.start_measure,
+            "end_measure": data.end_measure,
+            "generation_id": generation_id
+        }
+
     return {
         "exercises": filtered_exercises,
         "start_measure": data.start_measure,
-        "end_measure": data.end_measure
+        "end_measure": data.end_measure,
+        "generation_id": generation_id
     } 
 
+@router.post("/generate_stream")
+async def generate_exercises_stream(data: GenerateRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """
+    Generate exercises from a score excerpt, streamed as NDJSON: one {"category", "description",
+    "musicxml"} object per line, sent as soon as each is ready. Lines come part by part in
+    display order; grouped by category they are the same as the result of /generate.
+
+    With dedupe, each line carries a "musicxml_id" and only the first line with a given id also
+    carries the MusicXML. If generation fails part way, the last line is {"error": ...}.
+    Disconnecting stops the remaining generation.
+    """
+    exercise_types = get_exercise_types(data.exercise_types)
+    score_data = await get_score_data(db, data.filename)
+    digest = content_hash(score_data)
+
+    cached = await get_cached_exercises(db, digest, data.start_measure, data.end_measure, exercise_types)
+    items = None
+    if cached is None:
+        chunks = await get_excerpt_chunks(db, digest, data.start_measure, data.end_measure)
+        try:
+            items = process_pool.stream(
+                stream_exercises_from_bytes,
+                data.filename,
+                None if chunks else score_data,
+                data.start_measure,
+                data.end_measure,
+                exercise_types,
+                chunks
+            )
+        except PoolSaturatedError:
+            raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
+
+    async def exercises():
+        if cached is not None:
+            for category, entries in cached.items():
+                for description, xml in entries:
+                    yield category, description, xml
+            return
+
+        collected = defaultdict(list)
+        async for category, description, xml in items:
+            collected[category].append((description, xml))
+            yield category, description, xml
+        # only a stream that ran to completion is a full result
+        await exercise_result_cache.put(
+            exercise_result_key(digest, data.start_measure, data.end_measure, exercise_types),
+            dict(collected),
+            content_hash=digest,
+            start_measure=data.start_measure,
+            end_measure=data.end_measure
+        )
+
+    async def ndjson():
+        sent = set()
+        try:
+            async for category, description, xml in exercises():
+                line = {"category": category, "description": description}
+                if data.dedupe:
+                    line["musicxml_id"] = musicxml_id(xml)
+                    if line["musicxml_id"] not in sent:
+                        sent.add(line["musicxml_id"])
+                        line["musicxml"] = xml
+                else:
+                    line["musicxml"] = xml
+                yield json.dumps(line) + "\n"
+        except Exception as e:
+            # the status line has already been sent, so report the failure as the last line
+            print(f"Error streaming exercises for {data.filename}: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@router.post("/generate_batch", response_model=BatchGenerateResponse)
+async def generate_exercises_batch(data: BatchGenerateRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """
+    Generate exercises for many (filename, start_measure, end_measure) items at once.
+
+    Items are grouped by score. Cached ranges are answered right away; the rest of each score is
+    generated in the process pool from one parse per worker, with the ranges of a score split
+    over the idle workers when there are fewer scores than workers. Every item gets its own
+    result, and a failing item reports its error instead of failing the batch.
+    """
+    if len(data.items) > GENERATE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {GENERATE_BATCH_MAX_ITEMS} items per batch")
+    exercise_types = get_exercise_types(data.exercise_types)
+
+    results = [{"filename": item.filename, "start_measure": item.start_measure, "end_measure": item.end_measure}
+               for item in data.items]
+    items_by_score = defaultdict(list)
+    for i, item in enumerate(data.items):
+        items_by_score[item.filename].append(i)
+
+    # bounds this batch's share of the pool, so large batches queue here rather than being rejected
+    slots = asyncio.Semaphore(process_pool.max_workers)
+    chunks_per_score = max(1, process_pool.max_workers // len(items_by_score)) if items_by_score else 1
+
+    async def generate_chunk(score_name, score_data, digest, ranges):
+        async with slots:
+            try:
+                generated = await process_pool.run(generate_exercise_batch_from_bytes, score_name, score_data, ranges, exercise_types)
+            except PoolSaturatedError:
+                generated = [(None, "Server is busy, please try again shortly")] * len(ranges)
+            except Exception as e:
+                generated = [(None, str(e))] * len(ranges)
+        for (start_m, end_m), (exercises, error) in zip(ranges, generated):
+            if exercises is not None:
+                await exercise_result_cache.put(
+                    exercise_result_key(digest, start_m, end_m, exercise_types),
+                    exercises,
+                    content_hash=digest,
+                    start_measure=start_m,
+                    end_measure=end_m
+                )
+        return dict(zip(ranges, generated))
+
+    async def generate_score(score_name, indices):
+        try:
+            score_data = await get_score_data(db, score_name)
+        except HTTPException as e:
+            for i in indices:
+                results[i]["error"] = e.detail
+            return
+        digest = content_hash(score_data)
+
+        # the same range may be asked for more than once
+        pending = []
+        for i in indices:
+            measure_range = (data.items[i].start_measure, data.items[i].end_measure)
+            cached = await get_cached_exercises(db, digest, *measure_range, exercise_types)
+            if cached is not None:
+                results[i]["exercises"] = cached
+            elif measure_range not in pending:
+                pending.append(measure_range)
+        if not pending:
+            return
+
+        chunks = [pending[c::chunks_per_score] for c in range(min(chunks_per_score, len(pending)))]
+        generated = {}
+        for chunk in await asyncio.gather(*(generate_chunk(score_name, score_data, digest, ranges) for ranges in chunks)):
+            generated.update(chunk)
+        for i in indices:
+            measure_range = (data.items[i].start_measure, data.items[i].end_measure)
+            if measure_range in generated:
+                results[i]["exercises"], results[i]["error"] = generated[measure_range]
+
+    await asyncio.gather(*(generate_score(score_name, indices) for score_name, indices in items_by_score.items()))
+
+    if data.dedupe:
+        musicxml = {}
+        for result in results:
+            if result.get("exercises") is not None:
+                result["exercises"], ids = deduplicate_musicxml(result["exercises"])
+                musicxml.update(ids)
+        return {"results": results, "musicxml": musicxml}
+
+    return {"results": results}
+
+@router.post("/generate_manifest", response_model=ManifestResponse)
+async def generate_manifest(data: ManifestRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """List the exercises of a score excerpt with their ids and metadata, without generating their MusicXML."""
+    exercise_types = get_exercise_types(data.exercise_types)
+    score_data = await get_score_data(db, data.filename)
+    digest = content_hash(score_data)
+    cache_key = exercise_result_key(digest, data.start_measure, data.end_measure, exercise_types)
+
+    manifest = exercise_manifest_cache.get(cache_key)
+    if manifest is None:
+        chunks = await get_excerpt_chunks(db, digest, data.start_measure, data.end_measure)
+        manifest = await run_in_pool(
+            exercise_manifest_from_bytes,
+            data.filename,
+            None if chunks else score_data,
+            data.start_measure,
+            data.end_measure,
+            exercise_types,
+            chunks
+        )
+        exercise_manifest_cache.put(cache_key, manifest)
+
+    return {
+        "exercises": manifest,
+        "start_measure": data.start_measure,
+        "end_measure": data.end_measure
+    }
+
+@router.post("/get_exercise", response_model=ExerciseFetchResponse)
+async def get_exercise(data: ExerciseFetchRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """Generate (or return the memoized) MusicXML of one exercise listed by /generate_manifest."""
+    score_data = await get_score_data(db, data.filename)
+    digest = content_hash(score_data)
+    cache_key = (digest, data.start_measure, data.end_measure, data.exercise_id)
+
+    exercise = exercise_item_cache.get(cache_key)
+    if exercise is None:
+        chunks = await get_excerpt_chunks(db, digest, data.start_measure, data.end_measure)
+        try:
+            exercise = await run_in_pool(
+                exercise_from_bytes,
+                data.filename,
+                None if chunks else score_data,
+                data.start_measure,
+                data.end_measure,
+                data.exercise_id,
+                chunks
+            )
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=e.args[0] if e.args else "Exercise not found")
+        exercise_item_cache.put(cache_key, exercise, size=len(exercise['musicxml']))
+    return exercise
+
 @router.post("/delete_score")
-async def delete_score(data: DeleteScoreRequest):
+async def delete_score(data: DeleteScoreRequest, db: AsyncMongoDatabase = Depends(get_async_database)):
     """Delete a score from the database."""
-    db.delete_score(data.filename)
-    return {"success": True}
\ No newline at end of file
+    await db.delete_score(data.filename)
+    return {"success": True}
+
+@router.get("/precompute_jobs")
+async def list_precompute_jobs(limit: int = 50, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """List the most recent exercise precomputation jobs and their progress."""
+    return await db.get_jobs(PRECOMPUTE_JOB, limit=limit)
+
+@router.get("/precompute_jobs/{job_id}")
+async def get_precompute_job(job_id: str, db: AsyncMongoDatabase = Depends(get_async_database)):
+    """Get the progress of one exercise precomputation job."""
+    job = await db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/cache_stats")
+async def cache_stats():
+    """Report hit/miss counters and sizes for the score and exercise caches."""
+    return {
+        "parsed_scores": parsed_score_cache.stats(),
+        "frozen_scores": frozen_score_cache.stats(),
+        "exercise_results": await exercise_result_cache.stats(),
+        "exercise_manifests": exercise_manifest_cache.stats(),
+        "exercise_items": exercise_item_cache.stats(),
+        "slicehashes": slicehash_cache.stats(),
+        "process_pool": process_pool.stats(),
+    }
\ No newline at end of file
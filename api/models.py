@@ -14,6 +14,55 @@ class GenerateRequest(BaseModel):
     filename: str
     start_measure: int
     end_measure: int
+    dedupe: bool = False
+    # any of "score", "part", "voice", "dotted", "chordified", "slowed_down"; None means all of them
+    exercise_types: Optional[List[str]] = None
+
+class BatchItem(BaseModel):
+    filename: str
+    start_measure: int
+    end_measure: int
+
+class BatchGenerateRequest(BaseModel):
+    items: List[BatchItem]
+    dedupe: bool = False
+    exercise_types: Optional[List[str]] = None
+
+class BatchItemResult(BaseModel):
+    filename: str
+    start_measure: int
+    end_measure: int
+    exercises: Optional[Dict[str, List[tuple[Optional[str], Optional[str]]]]] = None
+    error: Optional[str] = None
+
+class BatchGenerateResponse(BaseModel):
+    # one result per requested item, in request order
+    results: List[BatchItemResult]
+    # with dedupe, exercises hold ids into this map, shared by the whole batch
+    musicxml: Optional[Dict[str, str]] = None
+
+class ManifestRequest(BaseModel):
+    filename: str
+    start_measure: int
+    end_measure: int
+    exercise_types: Optional[List[str]] = None
+
+class ManifestResponse(BaseModel):
+    exercises: List[Dict[str, Any]]
+    start_measure: int
+    end_measure: int
+
+class ExerciseFetchRequest(BaseModel):
+    filename: str
+    start_measure: int
+    end_measure: int
+    exercise_id: str
+
+class ExerciseFetchResponse(BaseModel):
+    id: str
+    category: str
+    description: str
+    musicxml: str
 
 class SliceRequest(BaseModel):
     filename: str
@@ -29,7 +78,11 @@ class MusicXMLRequest(BaseModel):
 class ExerciseResponse(BaseModel):
     exercises: Dict[str, List[tuple[Optional[str], Optional[str]]]]
     start_measure: int
-    end_measure: int 
+    end_measure: int
+    # with dedupe, exercises hold ids into this map instead of the MusicXML itself
+    musicxml: Optional[Dict[str, str]] = None
+    # identifies the cached exercise set, e.g. for /prerender_slices
+    generation_id: Optional[str] = None
 
 class FileDataRequest(BaseModel):
     filename: str
@@ -47,3 +100,17 @@ class ExerciseRequest(BaseModel):
 class DeleteScoreRequest(BaseModel):
     filename: str
 
+class PrerenderRequest(BaseModel):
+    # either the generation_id returned by /generate, or the exercises it returned
+    generation_id: Optional[str] = None
+    exercises: Optional[Dict[str, List[tuple[Optional[str], Optional[str]]]]] = None
+    title: Optional[str] = None
+    composer: Optional[str] = None
+
+class PrerenderResponse(BaseModel):
+    # the exercise set with the MusicXML replaced by ids, as /generate with dedupe
+    exercises: Dict[str, List[tuple[Optional[str], Optional[str]]]]
+    # slice hash by exercise id, for every exercise that has a slice
+    slicehashes: Dict[str, str]
+    # error by exercise id, for the exercises that could not be uploaded
+    errors: Dict[str, str]
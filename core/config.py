@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -6,6 +7,21 @@ load_dotenv()
 # API Configuration
 SOUNDSLICE_APP_ID = os.getenv("SOUNDSLICE_APP_ID")
 SOUNDSLICE_PASSWORD = os.getenv("SOUNDSLICE_PASSWORD")
+# Base URL of the Soundslice API, e.g. a local stub server in development
+SOUNDSLICE_API_PREFIX = os.getenv("SOUNDSLICE_API_PREFIX", "https://www.soundslice.com/api/v1")
+# Seconds to wait for each request to Soundslice and the notation upload to its file storage
+SOUNDSLICE_TIMEOUT = float(os.getenv("SOUNDSLICE_TIMEOUT", "60"))
+# Largest exercise set /prerender_slices uploads at once
+SOUNDSLICE_PRERENDER_MAX_EXERCISES = int(os.getenv("SOUNDSLICE_PRERENDER_MAX_EXERCISES", "100"))
+
+# Soundslice uploads, queued or pre-rendered: at most SOUNDSLICE_MAX_CONCURRENCY at once over as many
+# keep-alive connections, each tried up to
+# SOUNDSLICE_MAX_ATTEMPTS times, waiting SOUNDSLICE_RETRY_BASE_DELAY seconds after the first failure
+# and twice as long after each one that follows, up to SOUNDSLICE_RETRY_MAX_DELAY
+SOUNDSLICE_MAX_CONCURRENCY = int(os.getenv("SOUNDSLICE_MAX_CONCURRENCY", "8"))
+SOUNDSLICE_MAX_ATTEMPTS = int(os.getenv("SOUNDSLICE_MAX_ATTEMPTS", "5"))
+SOUNDSLICE_RETRY_BASE_DELAY = float(os.getenv("SOUNDSLICE_RETRY_BASE_DELAY", "1"))
+SOUNDSLICE_RETRY_MAX_DELAY = float(os.getenv("SOUNDSLICE_RETRY_MAX_DELAY", "60"))
 
 # File Upload Configuration
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "music")
@@ -15,4 +31,63 @@ ALLOWED_EXTENSIONS = {'xml', 'musicxml', 'mxl'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename: str) -> bool:
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS 
\ No newline at end of file
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# Uploaded scores are streamed into GridFS in chunks of SCORE_STREAM_CHUNK_BYTES, and are
+# rejected with a 413 once they go over SCORE_UPLOAD_MAX_BYTES. Downloads stream in the same chunks.
+SCORE_UPLOAD_MAX_BYTES = int(os.getenv("SCORE_UPLOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+SCORE_STREAM_CHUNK_BYTES = int(os.getenv("SCORE_STREAM_CHUNK_BYTES", str(1024 * 1024)))
+
+# Parsed score cache configuration
+PARSED_SCORE_CACHE_MAX_ENTRIES = int(os.getenv("PARSED_SCORE_CACHE_MAX_ENTRIES", "8"))
+
+
+# On-disk cache of frozen music21 scores, shared by all workers on a machine.
+# Set SCORE_DISK_CACHE_MAX_BYTES to 0 to disable it.
+SCORE_DISK_CACHE_DIR = os.getenv("SCORE_DISK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "coda_score_cache"))
+SCORE_DISK_CACHE_MAX_BYTES = int(os.getenv("SCORE_DISK_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Process pool for CPU-bound work (parsing, exercise generation, MusicXML export).
+# Requests beyond EXERCISE_POOL_WORKERS + EXERCISE_POOL_MAX_PENDING get a 503.
+EXERCISE_POOL_WORKERS = int(os.getenv("EXERCISE_POOL_WORKERS", str(os.cpu_count() or 1)))
+EXERCISE_POOL_MAX_PENDING = int(os.getenv("EXERCISE_POOL_MAX_PENDING", "8"))
+
+# Worker processes used to generate the voices of one excerpt in parallel; 0 keeps it sequential.
+# Each pool worker above starts its own line pool, so keep the product of the two within the core count.
+EXERCISE_LINE_WORKERS = int(os.getenv("EXERCISE_LINE_WORKERS", "0"))
+
+# Measure window sizes precomputed in the background after an upload; empty disables precomputation.
+PRECOMPUTE_WINDOW_SIZES = [int(size) for size in os.getenv("PRECOMPUTE_WINDOW_SIZES", "4,8").split(",") if size.strip()]
+
+# Uploaded scores are also stored in chunks of this many measures, so an excerpt only parses the
+# chunks it covers; 0 disables chunking and every excerpt is cut from a parse of the whole score.
+SCORE_CHUNK_MEASURES = int(os.getenv("SCORE_CHUNK_MEASURES", "8"))
+
+# Largest number of measure ranges accepted by one /generate_batch request
+GENERATE_BATCH_MAX_ITEMS = int(os.getenv("GENERATE_BATCH_MAX_ITEMS", "50"))
+
+# Largest page of scores /list_files returns at once
+LIST_FILES_MAX_LIMIT = int(os.getenv("LIST_FILES_MAX_LIMIT", "500"))
+
+# Cache of generated exercise sets: an in-process LRU in front of a Mongo collection with a TTL index
+EXERCISE_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("EXERCISE_RESULT_CACHE_MAX_ENTRIES", "64"))
+EXERCISE_RESULT_CACHE_MAX_BYTES = int(os.getenv("EXERCISE_RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EXERCISE_RESULT_CACHE_TTL_SECONDS = int(os.getenv("EXERCISE_RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+# In-process memo of exercise manifests and of single exercises fetched by id
+EXERCISE_MANIFEST_CACHE_MAX_ENTRIES = int(os.getenv("EXERCISE_MANIFEST_CACHE_MAX_ENTRIES", "128"))
+EXERCISE_ITEM_CACHE_MAX_ENTRIES = int(os.getenv("EXERCISE_ITEM_CACHE_MAX_ENTRIES", "512"))
+EXERCISE_ITEM_CACHE_MAX_BYTES = int(os.getenv("EXERCISE_ITEM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# MongoDB connection pool shared by everything in a process (timeouts in milliseconds)
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000"))
+
+# Threads that run database calls for the async endpoints, so they never block the event loop
+MONGODB_ASYNC_THREADS = int(os.getenv("MONGODB_ASYNC_THREADS", "16"))
+
+# Soundslice slice hashes remembered in-process, in front of the soundslice_slices collection
+SLICEHASH_CACHE_MAX_ENTRIES = int(os.getenv("SLICEHASH_CACHE_MAX_ENTRIES", "10000"))
@@ -3,7 +3,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
 from api.endpoints import router, MUSIC_DIR
-from services.database import MongoDatabase
+from services.database import get_async_database, close_database
+from core.config import EXERCISE_RESULT_CACHE_TTL_SECONDS
+from services.workers import process_pool
+from services.precompute import cancel_background_jobs, resume_pending_scores
+from services.slice_jobs import cancel_slice_jobs
 
 # Create FastAPI app
 app = FastAPI(
@@ -34,5 +38,21 @@ for route in app.routes:
 @app.on_event("startup")
 async def startup_event():
     """Initialize database and load score hashes."""
-    db = MongoDatabase()
-    print("Backend startup complete") 
\ No newline at end of file
+    db = get_async_database()
+    await db.ensure_score_indexes()
+    await db.ensure_exercise_result_indexes(EXERCISE_RESULT_CACHE_TTL_SECONDS)
+    await db.ensure_score_chunk_indexes()
+    await db.ensure_slicehash_indexes()
+    # contents whose validation was cut short, e.g. by the last shutdown, are processed again
+    resumed = await resume_pending_scores()
+    if resumed:
+        print(f"Resumed processing of {len(resumed)} pending scores")
+    print("Backend startup complete")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background jobs, the worker processes and the database client."""
+    await cancel_background_jobs()
+    await cancel_slice_jobs()
+    process_pool.shutdown()
+    close_database() 
\ No newline at end of file
@@ -0,0 +1,276 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import music21
+from music21 import converter, freezeThaw, stream
+
+from core.config import PARSED_SCORE_CACHE_MAX_ENTRIES, SCORE_DISK_CACHE_DIR, SCORE_DISK_CACHE_MAX_BYTES
+from music.validation import read_musicxml_document
+
+# bump when the on-disk layout changes; the music21 version is part of the stamp because
+# frozen streams are plain pickles of music21 objects
+DISK_CACHE_FORMAT = 1
+DISK_CACHE_VERSION = f"m21-{music21.VERSION_STR}-f{DISK_CACHE_FORMAT}"
+
+
+def content_hash(data: bytes) -> str:
+    """Return the hex SHA-256 digest of a score's raw bytes."""
+    return hashlib.sha256(bytes(data)).hexdigest()
+
+
+def freeze_score(score: stream.Score) -> bytes:
+    """Pickle a score with music21's StreamFreezer, which works on its own deepcopy and leaves the score intact."""
+    return freezeThaw.StreamFreezer(score).writeStr(fmt='pickle')
+
+
+def thaw_score(frozen: bytes) -> stream.Score:
+    """Rebuild a score frozen by freeze_score()."""
+    thawer = freezeThaw.StreamThawer()
+    thawer.openStr(frozen)
+    return thawer.stream
+
+
+class LRUCache:
+    """
+    A thread-safe, bounded least-recently-used mapping with hit/miss counters.
+
+    Entries are limited by count and, if max_bytes is set, by the total of the
+    sizes given to put().
+    """
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None):
+        self.max_entries = max(0, max_entries)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        if self.max_entries == 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._discard(next(iter(self._entries)))
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            return self._discard(key)
+
+    def _discard(self, key: Hashable) -> Optional[Any]:
+        self.bytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class FrozenScoreCache:
+    """
+    On-disk cache of frozen (pickled) music21 scores keyed by content hash.
+
+    Entries live in a subdirectory named after DISK_CACHE_VERSION, so every
+    worker process on the machine shares them and an upgrade of music21 simply
+    starts from an empty directory. Writes go to a temporary file that is then
+    renamed into place, and the least recently used entries are evicted once
+    the version directories together grow past max_bytes. Directories of other
+    versions are left to other processes, e.g. during a rolling deploy, and
+    their entries age out once nothing uses them.
+    """
+    SUFFIX = '.m21p'
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.root = directory
+        self.directory = os.path.join(directory, DISK_CACHE_VERSION)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root) and self.max_bytes > 0
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    def _version_directories(self):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('m21-') and os.path.isdir(path):
+                yield path
+
+    def load(self, digest: str) -> Optional[bytes]:
+        """Return the frozen score for the given content hash, if present."""
+        if not self.enabled:
+            return None
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                frozen = f.read()
+            # refresh the mtime so eviction is least-recently-used
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            print(f"Error loading cached score {digest}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frozen
+
+    def store(self, digest: str, frozen: bytes) -> None:
+        """Write a frozen score to disk atomically, then evict down to max_bytes."""
+        if not self.enabled:
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(frozen)
+                os.replace(tmp_path, self._path(digest))
+            except BaseException:
+                self._remove(tmp_path)
+                raise
+            self._evict()
+        except Exception as e:
+            print(f"Error caching score {digest} to disk: {e}")
+
+    def discard(self, digest: str) -> None:
+        """Remove an entry that could not be thawed."""
+        if self.enabled:
+            self._remove(self._path(digest))
+
+    def _evict(self) -> None:
+        entries = []
+        total = 0
+        for directory in self._version_directories():
+            for name in os.listdir(directory):
+                if not name.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        size = 0
+        entries = 0
+        if self.enabled:
+            for name in os.listdir(self.directory):
+                if name.endswith(self.SUFFIX):
+                    entries += 1
+                    size += os.path.getsize(os.path.join(self.directory, name))
+        return {
+            'directory': self.directory,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ParsedScoreCache(LRUCache):
+    """
+    LRU cache of parsed music21 scores keyed by content hash, so scores stored
+    under several names share one parse, and a re-uploaded score is simply a
+    new entry while the old one ages out.
+
+    Scores are kept frozen and thawed afresh for every caller: music21 caches
+    contexts and offsets on the streams it is asked to cut, so a shared parse
+    would make the same excerpt depend on the ones cut before it. Misses fall
+    back to the on-disk frozen cache before parsing from scratch.
+    """
+    def __init__(self, max_entries: int, disk_cache: Optional[FrozenScoreCache] = None):
+        super().__init__(max_entries)
+        self.disk_cache = disk_cache
+
+    def get_score(self, data: bytes) -> stream.Score:
+        """Return a parse of the given bytes that belongs to the caller, parsing on a miss."""
+        digest = content_hash(data)
+        frozen = self.get(digest)
+        if frozen is None and self.disk_cache:
+            frozen = self.disk_cache.load(digest)
+        if frozen is not None:
+            try:
+                score = thaw_score(frozen)
+            except Exception as e:
+                print(f"Error thawing cached score {digest}: {e}")
+                self.pop(digest)
+                if self.disk_cache:
+                    self.disk_cache.discard(digest)
+            else:
+                self.put(digest, frozen, len(frozen))
+                return score
+
+        # music21 cannot parse compressed .mxl archives from bytes, only from files
+        score = converter.parse(read_musicxml_document(data), format='musicxml')
+        try:
+            frozen = freeze_score(score)
+        except Exception as e:
+            print(f"Error freezing score {digest}: {e}")
+            return score
+        self.put(digest, frozen, len(frozen))
+        if self.disk_cache:
+            self.disk_cache.store(digest, frozen)
+        return score
+
+
+frozen_score_cache = FrozenScoreCache(SCORE_DISK_CACHE_DIR, SCORE_DISK_CACHE_MAX_BYTES)
+parsed_score_cache = ParsedScoreCache(PARSED_SCORE_CACHE_MAX_ENTRIES, disk_cache=frozen_score_cache)
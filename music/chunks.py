@@ -0,0 +1,211 @@
+"""
+Chunked storage of MusicXML scores for fast excerpt extraction.
+
+A partwise score is split into runs of N measures. Each chunk keeps, per
+part, the raw XML of its measures plus the <attributes> in effect where the
+chunk starts (divisions, key, time, staves, clefs, transposition), so an
+excerpt can be rebuilt from just the chunks it covers and parsed on its own
+instead of parsing the whole document. Chunks also record whether a spanner
+(slur, wedge, pedal, ...) is open where they start and end: excerpts whose
+chunks would cut one off are cut from the whole score instead.
+"""
+import copy
+import re
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional
+
+from music21 import converter, stream
+
+from music.processor import get_score_excerpt
+from music.validation import read_musicxml_document
+
+# order of the children of <attributes> in the MusicXML schema
+ATTRIBUTE_ORDER = ['footnote', 'level', 'divisions', 'key', 'time', 'staves', 'part-symbol', 'instruments',
+                   'clef', 'staff-details', 'transpose', 'for-part', 'directive', 'measure-style']
+# attributes that describe a passing notation state rather than the setup of the staff
+TRANSIENT_ATTRIBUTES = {'footnote', 'level', 'directive', 'measure-style'}
+# attributes that music21 places in the measure at their offset rather than keeping as parser state
+CONTEXT_ATTRIBUTES = {'key', 'time', 'clef'}
+# elements that start and stop a spanner, and the values of their type attribute that do so
+SPANNER_TAGS = {'slur', 'wedge', 'dashes', 'bracket', 'octave-shift', 'pedal', 'wavy-line', 'glissando', 'slide'}
+SPANNER_STARTS = {'start', 'crescendo', 'diminuendo', 'up', 'down', 'resume'}
+SPANNER_STOPS = {'stop', 'discontinue'}
+
+
+def _measure_number(number: Optional[str]) -> Optional[int]:
+    match = re.match(r'\s*(-?\d+)', number or '')
+    return int(match.group(1)) if match else None
+
+
+def _attribute_key(element: ET.Element):
+    return element.tag, element.get('number')
+
+
+def _trailing_attributes(measure: ET.Element) -> List[ET.Element]:
+    """The <attributes> that follow all of the measure's notes, e.g. a clef change before the barline."""
+    timed = [i for i, child in enumerate(measure) if child.tag in ('note', 'forward')]
+    if not timed:
+        return []
+    return [child for child in measure[timed[-1] + 1:] if child.tag == 'attributes']
+
+
+def _update_open_spanners(open_spanners: set, measure: ET.Element) -> None:
+    """Add the spanners the measure starts to the set, and remove those it stops."""
+    for element in measure.iter():
+        if element.tag in SPANNER_TAGS:
+            key = (element.tag, element.get('number', '1'))
+            if element.get('type') in SPANNER_STARTS:
+                open_spanners.add(key)
+            elif element.get('type') in SPANNER_STOPS:
+                open_spanners.discard(key)
+
+
+def split_score(data: bytes, measures_per_chunk: int) -> Optional[Dict[str, Any]]:
+    """
+    Split a partwise MusicXML score into chunks of measures_per_chunk measures.
+
+    Returns {'header': {...}, 'chunks': [...]}, or None for scores that cannot be chunked
+    (timewise documents, parts with different measures, or measure numbers that go back).
+    The header holds the document without its parts, the part ids and the first and last
+    measure numbers; each chunk holds its measure range, and per part the XML of its
+    measures and of the attributes in effect at its first measure and those changed on the
+    barline before it, which only take effect after that measure, and whether any part has
+    a spanner open where it starts and where it ends.
+    """
+    root = ET.fromstring(read_musicxml_document(data))
+    if root.tag != 'score-partwise' or measures_per_chunk < 1:
+        return None
+    parts = root.findall('part')
+    if not parts:
+        return None
+
+    measures = [part.findall('measure') for part in parts]
+    numbers = [_measure_number(m.get('number')) for m in measures[0]]
+    if not numbers or None in numbers or any(b < a for a, b in zip(numbers, numbers[1:])):
+        return None
+    if any([m.get('number') for m in part_measures] != [m.get('number') for m in measures[0]] for part_measures in measures):
+        return None
+
+    header = copy.copy(root)
+    for part in header.findall('part'):
+        header.remove(part)
+
+    in_effect = [{} for _ in parts]
+    # key, time and clef changes on the closing barline of a chunk's last measure, which
+    # music21 does not apply to the next chunk's first measure but does to the ones after it
+    on_barline = [{} for _ in parts]
+    open_spanners = [set() for _ in parts]
+    chunks = []
+    for start in range(0, len(numbers), measures_per_chunk):
+        end = min(start + measures_per_chunk, len(numbers))
+        chunk = {
+            'index': len(chunks),
+            'first_measure': numbers[start],
+            'last_measure': numbers[end - 1],
+            'attributes': [_attributes_xml(state.values()) for state in in_effect],
+            'barline_attributes': [_attributes_xml(barline.values()) for barline in on_barline],
+            'measures': [''.join(ET.tostring(m, encoding='unicode') for m in part_measures[start:end]) for part_measures in measures],
+            'spanners_open_at_start': any(open_spanners),
+        }
+        for state, barline, spanners, part_measures in zip(in_effect, on_barline, open_spanners, measures):
+            state.update(barline)
+            barline.clear()
+            for measure in part_measures[start:end]:
+                _update_open_spanners(spanners, measure)
+                trailing = _trailing_attributes(measure) if measure is part_measures[end - 1] else []
+                for attributes in measure.findall('attributes'):
+                    for element in attributes:
+                        if element.tag in TRANSIENT_ATTRIBUTES:
+                            continue
+                        if element.tag in CONTEXT_ATTRIBUTES and any(attributes is t for t in trailing):
+                            barline[_attribute_key(element)] = element
+                        else:
+                            state[_attribute_key(element)] = element
+        chunk['spanners_open_at_end'] = end < len(numbers) and any(open_spanners)
+        chunks.append(chunk)
+
+    return {
+        'header': {
+            'xml': ET.tostring(header, encoding='unicode'),
+            'part_ids': [part.get('id') for part in parts],
+            'first_measure': numbers[0],
+            'last_measure': numbers[-1],
+            'measures_per_chunk': measures_per_chunk,
+        },
+        'chunks': chunks,
+    }
+
+
+def _attributes_xml(elements) -> str:
+    attributes = ET.Element('attributes')
+    attributes.extend(_sorted_attributes(elements))
+    return ET.tostring(attributes, encoding='unicode')
+
+
+def _sorted_attributes(elements) -> List[ET.Element]:
+    def order(element):
+        return ATTRIBUTE_ORDER.index(element.tag) if element.tag in ATTRIBUTE_ORDER else len(ATTRIBUTE_ORDER)
+    return sorted((copy.deepcopy(el) for el in elements), key=order)
+
+
+def _merged_attributes(attributes: ET.Element, changes: ET.Element) -> ET.Element:
+    """The attributes with the changes applied over them."""
+    merged = {_attribute_key(el): el for el in attributes}
+    merged.update((_attribute_key(el), el) for el in changes)
+    return ET.fromstring(_attributes_xml(merged.values()))
+
+
+def _apply_attributes(measure: ET.Element, carried: ET.Element) -> None:
+    """Put the carried attributes at the start of the measure, without overriding its own."""
+    if len(carried) == 0:
+        return
+    position = 0
+    while position < len(measure) and measure[position].tag == 'print':
+        position += 1
+    own = measure[position] if position < len(measure) and measure[position].tag == 'attributes' else None
+    if own is None:
+        measure.insert(position, carried)
+        return
+    overridden = {_attribute_key(el) for el in own}
+    merged = _sorted_attributes(list(own) + [el for el in carried if _attribute_key(el) not in overridden])
+    for el in list(own):
+        own.remove(el)
+    own.extend(merged)
+
+
+def covers_range(header: Dict[str, Any], start_m: Optional[int], end_m: Optional[int]) -> bool:
+    """Whether the measure range is a valid excerpt of the chunked score."""
+    return bool(start_m and end_m) and max(1, header['first_measure']) <= start_m <= end_m <= header['last_measure']
+
+
+def select_chunks(chunks: List[Dict[str, Any]], start_m: int, end_m: int) -> List[Dict[str, Any]]:
+    """The chunks holding any of the measures start_m to end_m, in order."""
+    return [chunk for chunk in chunks if chunk['last_measure'] >= start_m and chunk['first_measure'] <= end_m]
+
+
+def spanners_cross(chunks: List[Dict[str, Any]]) -> bool:
+    """
+    Whether a spanner runs on before the first or past the last of these consecutive chunks, so
+    that parsing them alone would drop it. Chunks stored without the flags are assumed to.
+    """
+    return chunks[0].get('spanners_open_at_start', True) or chunks[-1].get('spanners_open_at_end', True)
+
+
+def assemble_excerpt(header: Dict[str, Any], chunks: List[Dict[str, Any]], start_m: int, end_m: int) -> stream.Score:
+    """
+    Rebuild the measures start_m to end_m from the chunks that cover them (in order), the
+    same as get_score_excerpt() on the whole parsed score as long as no spanner crosses the
+    edges of the chunks (see spanners_cross()).
+    """
+    root = ET.fromstring(header['xml'])
+    for part_i, part_id in enumerate(header['part_ids']):
+        part = ET.SubElement(root, 'part', id=part_id)
+        for chunk in chunks:
+            part.extend(ET.fromstring(f"<part>{chunk['measures'][part_i]}</part>"))
+        if len(part):
+            carried = ET.fromstring(chunks[0]['attributes'][part_i])
+            if start_m > chunks[0]['first_measure'] and 'barline_attributes' in chunks[0]:
+                carried = _merged_attributes(carried, ET.fromstring(chunks[0]['barline_attributes'][part_i]))
+            _apply_attributes(part[0], carried)
+    score = converter.parse(ET.tostring(root, encoding='utf-8'), format='musicxml')
+    return get_score_excerpt(score, start_m, end_m)
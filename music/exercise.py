@@ -2,9 +2,10 @@ from music21 import *
 from typing import Dict, List, Tuple, Set, Optional
 from collections import defaultdict
 import numpy as np
-from music.matrix import MusicMatrixRepresentation
-from music.processor import get_musicxml_from_music21, get_music21_from_music_matrix_representation
+from music.matrix import MusicMatrixRepresentation, SPAN_DTYPE, note_events, events_from_time_pitches
+from music.processor import get_musicxml_from_music21, get_musicxml_from_music_matrix_representation, stream_fingerprint
 import math
+import hashlib
 
 MOD_EXERCISE_DESCRIPTIONS = {
     "dotted": "Purpose: improve the evenness of playing by strengthening the fingers and allowing the brain to regroup the passage in a different way. See https://practisingthepiano.com/on-dotted-rhythms/",
@@ -12,40 +13,282 @@ MOD_EXERCISE_DESCRIPTIONS = {
     "slowed_down": "Purpose: become more familiar with the notes, develop muscle memory and finger coordination slowly.",
 }
 
+SCORE_DESCRIPTION = "Full excerpt view with all parts together, unaltered.<br><br>Purpose: To isolate and target practice the selected measure(s)."
+PART_DESCRIPTION = "Complete part view, showing all voices per part.<br><br>Purpose: To isolate and target practice one part at a time."
+VOICE_DESCRIPTION = "Single voice view, showing all notes in a single voice or melodic line.<br><br>Purpose: To isolate and target practice one voice at a time."
+
+# exercise types that can be requested, in display order: the score, part and voice views, then the generated exercises
+VIEW_TYPES = ("score", "part", "voice")
+EXERCISE_TYPES = VIEW_TYPES + tuple(MOD_EXERCISE_DESCRIPTIONS)
+
+def exercise_category(exercise_name):
+    """Display category of a generated exercise, e.g. 'Voice Level: Slowed Down'."""
+    return "Voice Level: " + exercise_name.replace('_', ' ').title()
+
+def exercise_description(exercise_name):
+    """Description shown with a generated exercise."""
+    return f"{exercise_name.replace('_', ' ').title()} exercise.<br><br>{MOD_EXERCISE_DESCRIPTIONS[exercise_name]}"
+
+CATEGORY_EXERCISE_TYPES = {
+    'Score Level': 'score',
+    'Part Level': 'part',
+    'Voice Level: Original': 'voice',
+    **{exercise_category(name): name for name in MOD_EXERCISE_DESCRIPTIONS},
+}
+
+def normalize_exercise_types(exercise_types=None):
+    """
+    Validate requested exercise types and return them as a tuple in EXERCISE_TYPES order.
+    None selects every type; an empty selection or an unknown type raises ValueError.
+    """
+    if exercise_types is None:
+        return EXERCISE_TYPES
+    unknown = sorted(set(exercise_types) - set(EXERCISE_TYPES))
+    if unknown:
+        raise ValueError(f"Unknown exercise types {unknown}, expected some of {list(EXERCISE_TYPES)}")
+    if not exercise_types:
+        raise ValueError("No exercise types requested")
+    return tuple(t for t in EXERCISE_TYPES if t in exercise_types)
+
+def filter_exercise_types(exercises, exercise_types):
+    """Keep only the categories of an exercise set that belong to the given exercise types."""
+    return {category: items for category, items in exercises.items() if CATEGORY_EXERCISE_TYPES.get(category) in exercise_types}
+
 # TODO: clean up structure
-def get_all_exercises(score):
+def get_all_exercises(score, executor=None, exercise_types=EXERCISE_TYPES):
+        """
+        Generate the exercises of the given types (see EXERCISE_TYPES) for the score excerpt, grouped by category.
+        See iter_exercises().
+        """
         # turn l into a hashmap
         l = defaultdict(list)
+        for category, description, xml in iter_exercises(score, executor, exercise_types):
+            l[category].append((description, xml))
+        return l
 
-        exerciseScore = ExerciseScore(score)
+def iter_exercises(score, executor=None, exercise_types=EXERCISE_TYPES):
+        """
+        Generate the exercises of the given types for the score excerpt, yielding each
+        (category, description, musicxml) as soon as it is serialized, in display order.
 
-        # if the score has multiple lines, we want to display the entire score together, otherwise we don't display score-level since it's the same as part-level
-        # if len(exerciseScore.parts) > 1:
-        description = "Full excerpt view with all parts together, unaltered.<br><br>Purpose: To isolate and target practice the selected measure(s)."
-        l['Score Level'].append((description, get_musicxml_from_music21(exerciseScore.original_stream)))
-        # else:
-        #     l['Score Level'].append((None, None))
+        If an executor (e.g. a ProcessPoolExecutor) is given, the voice-level work (matrices,
+        generators and MusicXML export) is distributed across it one voice at a time. The
+        items and their order are the same as in the sequential path. Voices still pending
+        when the generator is closed early are cancelled.
 
-        for part in exerciseScore.parts:
-            # if the part has multiple lines, we want to display the entire part together, otherwise we don't display part-level since it's the same as line-level
-            # if len(part.lines) > 1:
+        Views and exercises with the same content (e.g. the score, part and voice views of a
+        one-voice score, or chord levels that group the same way) are exported to MusicXML only
+        once and share the resulting string.
+        """
+        exerciseScore = ExerciseScore(score)
+        # voices are only built when a voice-level type is asked for
+        voice_types = [t for t in exercise_types if t not in ("score", "part")]
+
+        # fingerprint -> MusicXML of everything exported so far
+        serialized = {}
+        score_fingerprint = stream_fingerprint(exerciseScore.original_stream)
+        part_fingerprints = [stream_fingerprint(part.original_stream) for part in exerciseScore.parts]
+
+        # voices are independent of each other, so submit them all before serializing anything else
+        line_futures = []
+        if executor is not None and voice_types:
+            # the workers leave out what this process has exported by the time it reaches their voice:
+            # the score and the parts up to their own, if those views were asked for
+            exported_here = dict.fromkeys([score_fingerprint] if "score" in exercise_types else [])
+            for part_i, part in enumerate(exerciseScore.parts):
+                if "part" in exercise_types:
+                    exported_here = {**exported_here, part_fingerprints[part_i]: None}
+                line_futures.append([
+                    executor.submit(get_line_exercises, line_stream, part.key_signature, part.time_signature, part.quantization, exported_here, voice_types)
+                    for line_stream in part.line_streams
+                ])
+
+        try:
+            # if the score has multiple lines, we want to display the entire score together, otherwise we don't display score-level since it's the same as part-level
             # if len(exerciseScore.parts) > 1:
-            description = "Complete part view, showing all voices per part.<br><br>Purpose: To isolate and target practice one part at a time."
-            l['Part Level'].append((description, get_musicxml_from_music21(part.original_stream)))
+            if "score" in exercise_types:
+                yield 'Score Level', SCORE_DESCRIPTION, _serialize_once(serialized, score_fingerprint, lambda: get_musicxml_from_music21(exerciseScore.original_stream))
             # else:
-                # l['Part Level'].append((None, None))
-            
-            for line in part.lines:
-                description = "Single voice view, showing all notes in a single voice or melodic line.<br><br>Purpose: To isolate and target practice one voice at a time."
+            #     l['Score Level'].append((None, None))
+
+            for part_i, part in enumerate(exerciseScore.parts):
+                # if the part has multiple lines, we want to display the entire part together, otherwise we don't display part-level since it's the same as line-level
                 # if len(part.lines) > 1:
-                l['Voice Level: Original'].append((description, get_musicxml_from_music21(line.original_stream)))
-                for exercise_name, exercises in line.exercises.items():
-                    # l['line_generated_exercise'].append(get_musicxml_from_music21(exercise))
-                    for exercise in exercises:
-                        # improve the descriptions + tooltip
-                        description = f"{exercise_name.replace('_', ' ').title()} exercise.<br><br>{MOD_EXERCISE_DESCRIPTIONS[exercise_name]}"
-                        l["Voice Level: " + exercise_name.replace('_', ' ').title()].append((description, get_musicxml_from_music21(exercise)))
-        return l
+                # if len(exerciseScore.parts) > 1:
+                if "part" in exercise_types:
+                    yield 'Part Level', PART_DESCRIPTION, _serialize_once(serialized, part_fingerprints[part_i], lambda: get_musicxml_from_music21(part.original_stream))
+                # else:
+                    # l['Part Level'].append((None, None))
+                if not voice_types:
+                    continue
+
+                for line_i, line_stream in enumerate(part.line_streams):
+                    if executor is not None:
+                        line_exercises = line_futures[part_i][line_i].result()
+                    else:
+                        line_exercises = iter_line_exercises(line_stream, part.key_signature, part.time_signature, part.quantization, serialized, voice_types)
+                    for category, description, fingerprint, xml in line_exercises:
+                        if fingerprint is not None:
+                            xml = _serialize_once(serialized, fingerprint, lambda: xml)
+                        yield category, description, xml
+        finally:
+            for futures in line_futures:
+                for future in futures:
+                    future.cancel()
+
+def get_line_exercises(music21_line, key_signature, time_signature, quantization, serialized=None, exercise_types=EXERCISE_TYPES):
+    """
+    Build a single voice and serialize its original view and generated exercises, limited to
+    the given exercise types. Returns a list of (category, description, fingerprint, musicxml)
+    in display order.
+
+    serialized maps content fingerprints to MusicXML that is already known; those entries
+    (and repeats within the voice) are not exported again. A fingerprint mapped to None is
+    one the caller exports itself, and its musicxml comes back as None.
+    """
+    return list(iter_line_exercises(music21_line, key_signature, time_signature, quantization, serialized, exercise_types))
+
+def iter_line_exercises(music21_line, key_signature, time_signature, quantization, serialized=None, exercise_types=EXERCISE_TYPES):
+    """Generator version of get_line_exercises(), yielding each entry as soon as it is serialized."""
+    if serialized is None:
+        serialized = {}
+    generators = [t for t in exercise_types if t in MOD_EXERCISE_DESCRIPTIONS]
+    line = ExerciseLine(music21_line, key_signature, time_signature, quantization, generators=generators)
+
+    # if len(part.lines) > 1:
+    if "voice" in exercise_types:
+        fingerprint = stream_fingerprint(line.original_stream)
+        yield 'Voice Level: Original', VOICE_DESCRIPTION, fingerprint, _serialize_once(serialized, fingerprint, lambda: get_musicxml_from_music21(line.original_stream))
+    for exercise_name, exercises in line.exercises.items():
+        # l['line_generated_exercise'].append(get_musicxml_from_music21(exercise))
+        for exercise in exercises:
+            # improve the descriptions + tooltip
+            description = exercise_description(exercise_name)
+            if exercise is None:
+                yield exercise_category(exercise_name), description, None, None
+                continue
+            fingerprint = exercise.fingerprint()
+            yield exercise_category(exercise_name), description, fingerprint, _serialize_once(serialized, fingerprint, lambda: get_musicxml_from_music_matrix_representation(exercise))
+
+def _exercise_id(exercise_type, *indices):
+    """Id of one exercise of an excerpt, e.g. 'score', 'part-0', 'voice-0-1' or 'dotted-0-1-0'."""
+    return '-'.join([exercise_type] + [str(i) for i in indices])
+
+def _parse_exercise_id(exercise_id):
+    """Split an exercise id into its type and indices, raising KeyError if it is malformed."""
+    exercise_type, *indices = exercise_id.split('-')
+    expected = {"score": 0, "part": 1, "voice": 2}.get(exercise_type, 3)
+    if exercise_type not in EXERCISE_TYPES or len(indices) != expected or not all(i.isdigit() for i in indices):
+        raise KeyError(f"Unknown exercise id {exercise_id!r}")
+    return exercise_type, [int(i) for i in indices]
+
+def get_exercise_manifest(score, exercise_types=EXERCISE_TYPES):
+    """
+    List the exercises of the given types for the score excerpt without exporting any MusicXML.
+
+    Each entry holds the exercise id accepted by get_exercise_by_id(), its category and
+    description as in get_all_exercises(), and cheap metadata: the exercise type, part and
+    voice indices, generator parameter, note count and pitch range. Generators run on the
+    compact note events so that exercises that cannot be generated are left out.
+    """
+    exerciseScore = ExerciseScore(score)
+    generators = [t for t in exercise_types if t in MOD_EXERCISE_DESCRIPTIONS]
+    manifest = []
+
+    if "score" in exercise_types:
+        manifest.append({'id': _exercise_id("score"), 'type': "score", 'category': 'Score Level', 'description': SCORE_DESCRIPTION,
+                         'parts': len(exerciseScore.parts)})
+
+    for part_i, part in enumerate(exerciseScore.parts):
+        if "part" in exercise_types:
+            manifest.append({'id': _exercise_id("part", part_i), 'type': "part", 'category': 'Part Level', 'description': PART_DESCRIPTION,
+                             'part': part_i, 'voices': len(part.line_streams)})
+        if "voice" not in exercise_types and not generators:
+            continue
+
+        for line_i, line_stream in enumerate(part.line_streams):
+            line = ExerciseLine(line_stream, part.key_signature, part.time_signature, part.quantization, generators=())
+            if "voice" in exercise_types:
+                manifest.append({'id': _exercise_id("voice", part_i, line_i), 'type': "voice", 'category': 'Voice Level: Original',
+                                 'description': VOICE_DESCRIPTION, 'part': part_i, 'voice': line_i,
+                                 **_exercise_metadata(line.music_matrix_representation)})
+            for exercise_name, variants in line.exercise_variants().items():
+                if exercise_name not in generators:
+                    continue
+                for variant_i, variant in enumerate(variants):
+                    exercise = line.generate_exercise(exercise_name, variant)
+                    if exercise is None:
+                        continue
+                    manifest.append({'id': _exercise_id(exercise_name, part_i, line_i, variant_i), 'type': exercise_name,
+                                     'category': exercise_category(exercise_name), 'description': exercise_description(exercise_name),
+                                     'part': part_i, 'voice': line_i, 'parameter': variant, **_exercise_metadata(exercise)})
+    return manifest
+
+def _exercise_metadata(music_matrix_representation):
+    pitch_range = music_matrix_representation.pitch_range
+    return {'notes': len(music_matrix_representation.events), 'pitch_range': list(pitch_range) if pitch_range else None}
+
+def get_exercise_by_id(score, exercise_id):
+    """
+    Generate and serialize the single exercise with the given manifest id (see get_exercise_manifest()).
+    Returns (category, description, musicxml) and raises KeyError if there is no such exercise.
+    """
+    exercise_type, indices = _parse_exercise_id(exercise_id)
+    exerciseScore = ExerciseScore(score)
+
+    if exercise_type == "score":
+        return 'Score Level', SCORE_DESCRIPTION, get_musicxml_from_music21(exerciseScore.original_stream)
+
+    try:
+        part = exerciseScore.parts[indices[0]]
+        if exercise_type == "part":
+            return 'Part Level', PART_DESCRIPTION, get_musicxml_from_music21(part.original_stream)
+        line_stream = part.line_streams[indices[1]]
+        if exercise_type == "voice":
+            return 'Voice Level: Original', VOICE_DESCRIPTION, get_musicxml_from_music21(line_stream)
+        line = ExerciseLine(line_stream, part.key_signature, part.time_signature, part.quantization, generators=())
+        variant = line.exercise_variants()[exercise_type][indices[2]]
+    except IndexError:
+        raise KeyError(f"Unknown exercise id {exercise_id!r}") from None
+
+    exercise = line.generate_exercise(exercise_type, variant)
+    xml = get_musicxml_from_music_matrix_representation(exercise)
+    if xml is None:
+        raise KeyError(f"Exercise {exercise_id!r} cannot be generated for this excerpt")
+    return exercise_category(exercise_type), exercise_description(exercise_type), xml
+
+def _serialize_once(serialized, fingerprint, export):
+    """
+    Return the MusicXML stored for the fingerprint, calling export() only the first time it is seen.
+    An export that comes back as None is not remembered, so the next entry with the fingerprint exports it.
+    """
+    if fingerprint in serialized:
+        return serialized[fingerprint]
+    xml = export()
+    if xml is not None:
+        serialized[fingerprint] = xml
+    return xml
+
+def musicxml_id(xml):
+    """Short content-derived id of a MusicXML string."""
+    return hashlib.sha256(xml.encode('utf-8')).hexdigest()[:16]
+
+def deduplicate_musicxml(exercises):
+    """
+    Split an exercise set into ({category: [(description, musicxml id)]}, {musicxml id: musicxml}),
+    so MusicXML shared by several entries is only sent once. Ids are derived from the content.
+    """
+    ids = {}
+    musicxml = {}
+    indexed = {}
+    for category, items in exercises.items():
+        indexed[category] = []
+        for description, xml in items:
+            if xml is not None and xml not in ids:
+                ids[xml] = musicxml_id(xml)
+                musicxml[ids[xml]] = xml
+            indexed[category].append((description, ids[xml] if xml is not None else None))
+    return indexed, musicxml
 
 class Score:
     def __init__(self, filename):
@@ -59,16 +302,6 @@ class Score:
     def get_score_mxl(self):
         return self.score_mxl
 
-# TODO: change name to make more sense
-class MusicMatrixRepresentation:
-    def __init__(self, key_signature, time_signature, quantization, piano_roll, onset_map, durations_matrix):
-        self.key_signature = key_signature
-        self.time_signature = time_signature
-        self.quantization = quantization
-        self.piano_roll = piano_roll
-        self.onset_map = onset_map
-        self.durations_matrix = durations_matrix
-
 class ExerciseScore:
     def __init__(self, music21_score):
         self.original_stream = music21_score
@@ -131,133 +364,182 @@ class ExercisePart:
         self.key_signature = key_signature
         self.time_signature = time_signature
         self.quantization = quantization
-        self.lines = self._extract_lines() # list of ExerciseLine objects
+        self.line_streams = self._extract_line_streams() # list of music21 streams, one per voice
+        self._lines = None
+
+    @property
+    def lines(self):
+        """List of ExerciseLine objects, built on first access."""
+        if self._lines is None:
+            self._lines = [ExerciseLine(line, self.key_signature, self.time_signature, self.quantization) for line in self.line_streams]
+        return self._lines
     
-    def _extract_lines(self):
+    def _extract_line_streams(self):
         # this extracts the voices from the parts
         split_voices = self.original_stream.voicesToParts()
         lines = []
         for line in split_voices.parts:
             if line.recurse(classFilter=('Note', 'Chord')):
-                lines.append(ExerciseLine(line, self.key_signature, self.time_signature, self.quantization))
+                lines.append(line)
         return lines
         # TODO: also get rid of parts with no notes in it
 
 # TODO: change this name to "Voice" instead of "Line"?????
 class ExerciseLine:
-    def __init__(self, music21_line, key_signature, time_signature, quantization):
+    def __init__(self, music21_line, key_signature, time_signature, quantization, generators=tuple(MOD_EXERCISE_DESCRIPTIONS)):
         self.original_stream = music21_line  # music21 stream object
         self.key_signature = key_signature
         self.time_signature = time_signature
         self.quantization = quantization
 
         # might have to move some functions around and whatever but keep like this for now
-        piano_roll, onset_map, durations_matrix = self._create_matrices() # numpy arrays
+        events, sounding, length = self._create_note_events() # compact numpy arrays, dense matrices are built on demand
 
         self.music_matrix_representation = MusicMatrixRepresentation(
             key_signature = key_signature,
             time_signature=time_signature,
             quantization=quantization,
-            piano_roll=piano_roll,
-            onset_map=onset_map,
-            durations_matrix=durations_matrix
+            events=events,
+            length=length,
+            sounding=sounding
         )
 
-        self.exercises = self.generate_exercises() # map of exercise name to music21 stream object
+        self.exercises = self.generate_exercises(generators) # map of exercise name to MusicMatrixRepresentation objects
 
-    def _create_matrices(self):
+    def _create_note_events(self):
+        """
+        Returns (events, sounding, length): one note event per onset with the number of steps its
+        pitch sounds until the next onset of that pitch, the merged spans each pitch sounds, and the
+        number of time steps. These are the sparse form of the piano roll, onset map and durations matrix.
+        """
         # Get the measure offsets
         measure_offset = {}
         for el in self.original_stream.recurse(classFilter=('Measure')):
             measure_offset[el.measureNumber] = el.offset
-        
-        # Get the duration of the part
-        duration_max = 0
-        for el in self.original_stream.recurse(classFilter=('Note', 'Chord')):
-            t_end = self._get_end_time(el,measure_offset,self.quantization)
-            if(t_end>=duration_max):
-                duration_max=t_end
-
-        # Get the pitch and offset+duration
-        piano_roll = np.zeros((128,math.ceil(duration_max)))
-
-        # TODO: handle / account for the ties
-        onset_map = np.zeros((128,math.ceil(duration_max)))
 
-        durations_matrix = np.zeros((128,math.ceil(duration_max)))
-        if duration_max == 0: 
-            return piano_roll, onset_map, durations_matrix
-        
+        # Collect every sounding pitch once as (midi, start, end, is_onset)
+        midis, starts, ends, is_onset = [], [], [], []
         for el in self.original_stream.recurse(classFilter=('Note', 'Chord')):
-            note_start = self._get_start_time(el,measure_offset,self.quantization)
-            note_end = self._get_end_time(el,measure_offset,self.quantization)
+            note_start, note_end = self._get_start_end_times(el,measure_offset,self.quantization)
 
             if el.isChord:
                 for pitch in el.pitches:
-                    midi = pitch.midi
-                    onset_map[midi, note_start] = 1
-                    piano_roll[midi, note_start:note_end] = 1
+                    midis.append(pitch.midi)
+                    starts.append(note_start)
+                    ends.append(note_end)
+                    is_onset.append(True)
             else:
-                midi = el.pitch.midi
-                if el.tie != tie.Tie('stop'):
-                    onset_map[midi, note_start] = 1
-                piano_roll[midi,note_start:note_end] = 1
-
-        rows, cols = piano_roll.shape
-
-        for i in range(rows):
-            onset_indices = np.where(onset_map[i] == 1)[0]
-            for idx, start in enumerate(onset_indices):
-                end = onset_indices[idx + 1] if idx + 1 < len(onset_indices) else cols
-                # Sum the 1s in the piano roll between onset and next onset or end of row
-                duration = np.sum(piano_roll[i, start:end])
-                durations_matrix[i, start] = duration
-
-        # plot_mtx(piano_roll)
-        
-        return piano_roll, onset_map, durations_matrix
-
-    def _get_start_time(self, el,measure_offset,quantization):
-        if (el.offset is not None) and (el.measureNumber in measure_offset):
-            return int(math.ceil((measure_offset[el.measureNumber] + el.offset)*quantization))
-        return None
+                # TODO: handle / account for the ties
+                midis.append(el.pitch.midi)
+                starts.append(note_start)
+                ends.append(note_end)
+                is_onset.append(el.tie != tie.Tie('stop'))
 
-    def _get_end_time(self, el,measure_offset,quantization):
-        if (el.offset is not None) and (el.measureNumber in measure_offset):
-            return int(math.ceil((measure_offset[el.measureNumber] + el.offset + el.duration.quarterLength)*quantization))
-        return None
-
-    def generate_exercises(self):
+        # Get the duration of the part
+        duration_max = max(ends, default=0)
+        length = math.ceil(duration_max)
+        if duration_max == 0:
+            return note_events([], [], []), np.empty(0, dtype=SPAN_DTYPE), length
+
+        # (pitch, time) pairs are flattened into keys pitch * bound + time, which sort by pitch, then time
+        bound = length + 1
+        midis = np.array(midis, dtype=np.int64)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        is_onset = np.array(is_onset, dtype=bool)
+
+        # merge each pitch's notes (ties, overlapping voices) into disjoint sounding spans
+        has_length = ends > starts
+        order = np.lexsort((starts[has_length], midis[has_length]))
+        note_starts = (midis[has_length] * bound + starts[has_length])[order]
+        note_ends = (midis[has_length] * bound + ends[has_length])[order]
+        new_span = np.ones(len(note_starts), dtype=bool)
+        new_span[1:] = note_starts[1:] > np.maximum.accumulate(note_ends)[:-1]
+        span_index = np.flatnonzero(new_span)
+        span_starts = note_starts[span_index]
+        span_ends = np.maximum.reduceat(note_ends, span_index) if len(span_index) else note_ends
+        span_pitches = span_starts // bound
+
+        sounding = np.empty(len(span_index), dtype=SPAN_DTYPE)
+        sounding['pitch'] = span_pitches
+        sounding['start'] = span_starts - span_pitches * bound
+        sounding['end'] = span_ends - span_pitches * bound
+
+        # steps_sounding(key) counts the sounding steps of all spans before the key
+        span_lengths = span_ends - span_starts
+        steps_before_span = np.concatenate(([0], np.cumsum(span_lengths)))
+
+        def steps_sounding(keys):
+            if len(span_index) == 0:
+                return np.zeros_like(keys)
+            i = np.searchsorted(span_starts, keys, side='right') - 1
+            partial = np.clip(keys - span_starts[i], 0, span_lengths[i])
+            return np.where(i >= 0, steps_before_span[i] + partial, 0)
+
+        # the duration at each onset is the number of sounding steps up to the next onset of that pitch (or the end of the line)
+        onset_keys = np.unique(midis[is_onset] * bound + starts[is_onset])
+        onset_pitches = onset_keys // bound
+        next_keys = onset_pitches * bound + length
+        same_pitch = onset_pitches[1:] == onset_pitches[:-1]
+        next_keys[:-1][same_pitch] = onset_keys[1:][same_pitch]
+        durations = steps_sounding(next_keys) - steps_sounding(onset_keys)
+
+        events = note_events(onset_pitches, onset_keys - onset_pitches * bound, durations)
+        return events, sounding, length
+
+    def _get_start_end_times(self, el,measure_offset,quantization):
+        # measureNumber walks the element's context, so look it up once for both times
+        measure_number = el.measureNumber
+        if (el.offset is not None) and (measure_number in measure_offset):
+            start = measure_offset[measure_number] + el.offset
+            return int(math.ceil(start*quantization)), int(math.ceil((start + el.duration.quarterLength)*quantization))
+        return None, None
+
+    def exercise_variants(self):
         """
-        Generate exercises from the music matrix representation. Exercises are returned as music21 streams.
+        Map of exercise name to the parameters its generator is run with, in order.
         """
-        # exercises = []
-        exercises = defaultdict(list)
-
-        # try:
-
-        # generated dotted exercises
+        # dotted duration patterns
         dotted_duration_patterns = [[1.5, 0.5], [0.5, 1.5]]
-        for pattern in dotted_duration_patterns:
-            dotted = self.generate_dotted_exercise(pattern)
-            
-            # exercises.append(dotted)
-            exercises['dotted'].append(dotted)
 
-        # generate the chord exercise
+        # chord exercise levels
         # maybe just have this be all multiples of the numerator or denominator ranging from min quantization level to bar level? TODO
         level_of_chordification = set([self.music_matrix_representation.quantization, self.music_matrix_representation.quantization * 2, self.music_matrix_representation.quantization // 2, self.music_matrix_representation.time_signature.denominator, self.music_matrix_representation.time_signature.denominator * 2, self.music_matrix_representation.time_signature.denominator // 2, self.music_matrix_representation.time_signature.numerator * self.music_matrix_representation.time_signature.denominator])
-        for chord_level in level_of_chordification:
-            chordify = self.generate_chordify_exercise(chord_level)
-            if chordify is not None:
-                exercises['chordified'].append(chordify)
 
-        # generate slowed down exercises
         factor_of_slowdown = [2, 4] # i.e., 2 is twice as slow, 4 is four times as slow
-        for factor in factor_of_slowdown:
-            slowed_down = self.generate_slowed_down_exercise(factor)
-            if slowed_down is not None:
-                exercises['slowed_down'].append(slowed_down)
+
+        return {
+            'dotted': dotted_duration_patterns,
+            'chordified': list(level_of_chordification),
+            'slowed_down': factor_of_slowdown,
+        }
+
+    def generate_exercise(self, exercise_name, variant):
+        """
+        Run one generator with one of its parameters from exercise_variants(). Returns a MusicMatrixRepresentation or None.
+        """
+        generators = {
+            'dotted': self.generate_dotted_exercise,
+            'chordified': self.generate_chordify_exercise,
+            'slowed_down': self.generate_slowed_down_exercise,
+        }
+        return generators[exercise_name](variant)
+
+    def generate_exercises(self, generators=tuple(MOD_EXERCISE_DESCRIPTIONS)):
+        """
+        Generate exercises from the music matrix representation, running only the named generators. Exercises are returned as MusicMatrixRepresentation objects.
+        """
+        # exercises = []
+        exercises = defaultdict(list)
+
+        for exercise_name, variants in self.exercise_variants().items():
+            if exercise_name not in generators:
+                continue
+            for variant in variants:
+                exercise = self.generate_exercise(exercise_name, variant)
+                # dotted exercises keep their place even when they cannot be generated
+                if exercise is not None or exercise_name == 'dotted':
+                    exercises[exercise_name].append(exercise)
 
         return exercises
     
@@ -309,34 +591,8 @@ class ExerciseLine:
                 
             dotted_flat_durations[start_time:end_time] = new_rhythm_phrase
 
-        # 4. update the piano roll and onset map to reflect the flattened durations (maybe can do one pass, but splitting them for now)
-
-        # 4.0. reconstruct the new durations matrix via the hashmap
-        new_durations_matrix = np.zeros_like(self.music_matrix_representation.durations_matrix)
-        for time, pitches in pitches_hashmap.items():
-            for p in pitches:
-                new_durations_matrix[p, time] = dotted_flat_durations[time]
-
-        # 4.1. update the onset map by copying and boolean-ifying the unflatted duration
-        dotted_onset_map = new_durations_matrix.copy()
-        mask = dotted_onset_map != 0
-        dotted_onset_map[mask] = 1
-
-        # 4.2. update the piano roll from the flattened duration
-        new_piano_roll = self._reconstruct_piano_roll(new_durations_matrix)
-
-        # if there are no 1s in the new piano roll, return None
-        if np.sum(new_piano_roll) == 0:
-            return None
-
-        return get_music21_from_music_matrix_representation(MusicMatrixRepresentation(
-            key_signature=self.music_matrix_representation.key_signature,
-            time_signature=self.music_matrix_representation.time_signature,
-            quantization=self.music_matrix_representation.quantization,
-            piano_roll=new_piano_roll,
-            onset_map=dotted_onset_map,
-            durations_matrix=new_durations_matrix
-        ))
+        # 4. build the new note events from the hashmap
+        return self._get_exercise_from_time_pitches(pitches_hashmap, dotted_flat_durations, self.music_matrix_representation.length)
     
 
     # TODO: beats are weird for three blind mice first measure? extra eighth note
@@ -391,32 +647,8 @@ class ExerciseLine:
         if flattened_durations_list == chordified_flat_durations:
             return None
 
-        # 4. reconstruct the new durations matrix via the hashmap
-        new_durations_matrix = np.zeros_like(self.music_matrix_representation.durations_matrix)
-        for time, pitches in pitches_hashmap.items():
-            for p in pitches:
-                new_durations_matrix[p, time] = chordified_flat_durations[time]
-        
-        # update the onset map by copying and boolean-ifying the unflatted duration
-        chordified_onset_map = new_durations_matrix.copy()
-        mask = chordified_onset_map != 0
-        chordified_onset_map[mask] = 1
-
-        # update the piano roll from the flattened duration
-        new_piano_roll = self._reconstruct_piano_roll(new_durations_matrix)
-
-        # if there are no 1s in the new piano roll, return None
-        if np.sum(new_piano_roll) == 0:
-            return None
-
-        return get_music21_from_music_matrix_representation(MusicMatrixRepresentation(
-            key_signature=self.music_matrix_representation.key_signature,
-            time_signature=self.music_matrix_representation.time_signature,
-            quantization=self.music_matrix_representation.quantization,
-            piano_roll=new_piano_roll,
-            onset_map=chordified_onset_map,
-            durations_matrix=new_durations_matrix
-        ))
+        # 4. build the new note events from the hashmap
+        return self._get_exercise_from_time_pitches(pitches_hashmap, chordified_flat_durations, self.music_matrix_representation.length)
 
 
     def generate_slowed_down_exercise(self, factor):
@@ -444,32 +676,8 @@ class ExerciseLine:
         if flattened_durations_list == new_durations_list:
             return None
 
-        # 4. reconstruct the new durations matrix via the hashmap
-        new_durations_matrix = np.zeros((128, len(new_durations_list)))
-        for time, pitches in new_pitches_hashmap.items():
-            for p in pitches:
-                new_durations_matrix[p, time] = new_durations_list[time]
-        
-        # update the onset map by copying and boolean-ifying the unflatted duration
-        chordified_onset_map = new_durations_matrix.copy()
-        mask = chordified_onset_map != 0
-        chordified_onset_map[mask] = 1
-
-        # update the piano roll from the flattened duration
-        new_piano_roll = self._reconstruct_piano_roll(new_durations_matrix)
-
-        # if there are no 1s in the new piano roll, return None
-        if np.sum(new_piano_roll) == 0:
-            return None
-
-        return get_music21_from_music_matrix_representation(MusicMatrixRepresentation(
-            key_signature=self.music_matrix_representation.key_signature,
-            time_signature=self.music_matrix_representation.time_signature,
-            quantization=self.music_matrix_representation.quantization,
-            piano_roll=new_piano_roll,
-            onset_map=chordified_onset_map,
-            durations_matrix=new_durations_matrix
-        ))
+        # 4. build the new note events from the hashmap
+        return self._get_exercise_from_time_pitches(new_pitches_hashmap, new_durations_list, len(new_durations_list))
 
 
     def _find_sub_groupings(self, flattened_durations_list, start_time, end_time, chord_level):
@@ -482,18 +690,23 @@ class ExerciseLine:
 
     
     def _flatten_durations(self):
-        flat = [int(x) for x in self.music_matrix_representation.durations_matrix[0]]
+        # flat: time_index : duration, hashmap: time_index : [midi pitch 1, midi pitch 2]
+        return self.music_matrix_representation.flatten_durations()
 
-        # time_index : [midi pitch 1, midi pitch 2]
-        hashmap = defaultdict(list)
+    def _get_exercise_from_time_pitches(self, pitches_hashmap, flat_durations, length):
+        events = events_from_time_pitches(pitches_hashmap, flat_durations)
 
-        for ri, ci in np.ndindex(self.music_matrix_representation.durations_matrix.shape):
-            if self.music_matrix_representation.durations_matrix[ri, ci] != 0:
-                if flat[ci] == 0:
-                    flat[ci] = int(self.music_matrix_representation.durations_matrix[ri, ci])
-                hashmap[ci].append(ri)
+        # if no note sounds in the new exercise, return None
+        if not (events['duration'] > 0).any():
+            return None
 
-        return flat, hashmap
+        return MusicMatrixRepresentation(
+            key_signature=self.music_matrix_representation.key_signature,
+            time_signature=self.music_matrix_representation.time_signature,
+            quantization=self.music_matrix_representation.quantization,
+            events=events,
+            length=length
+        )
     
     def _find_duplicate_length_ranges(self, durations_list):
         windows = [] # start_time, end_time
@@ -524,27 +737,3 @@ class ExerciseLine:
             windows.append((i, j, curr_val_count))
 
         return windows
-
-    def _reconstruct_piano_roll(self, durations_matrix):
-        new_piano_roll = np.zeros_like(durations_matrix)
-
-        rows, cols = durations_matrix.shape
-
-        for r in range(rows):
-            row = durations_matrix[r]
-
-            c = 0
-            while c < cols:
-                dur = int(durations_matrix[r, c])
-                if dur == 0:
-                    c += 1
-                else:
-                    x = c
-                    for dx in range(dur):
-                        # NOTE: THIS IS A TEMPORARY SOLUTION, DOES NOT FULLY SOLVE THE DOTTED RHYTHM NEEDING RESTS ISSUE? need to fix the durations matrix to account for rests
-                        if (x+dx) >= cols:
-                            break
-                        new_piano_roll[r, x+dx] = 1
-                    c += dur
-
-        return new_piano_roll
@@ -1,50 +1,229 @@
 from music21 import *
+import hashlib
 import numpy as np
-from typing import Tuple, List, Dict, Set
+from typing import Tuple, List, Dict, Set, Optional
 from collections import defaultdict
 
+NUM_PITCHES = 128
+
+# one row per note onset; onset and duration are in quantization steps
+NOTE_EVENT_DTYPE = np.dtype([('pitch', np.uint8), ('onset', np.int32), ('duration', np.int32)])
+# one row per stretch of time a pitch sounds, [start, end) in quantization steps
+SPAN_DTYPE = np.dtype([('pitch', np.uint8), ('start', np.int32), ('end', np.int32)])
+
+
+def note_events(pitches, onsets, durations) -> np.ndarray:
+    """Pack parallel pitch/onset/duration sequences into an event array sorted by pitch, then onset."""
+    events = np.empty(len(pitches), dtype=NOTE_EVENT_DTYPE)
+    events['pitch'] = pitches
+    events['onset'] = onsets
+    events['duration'] = durations
+    return events[np.lexsort((events['onset'], events['pitch']))]
+
+
+def events_from_durations_matrix(durations_matrix: np.ndarray) -> np.ndarray:
+    """Collect the nonzero cells of a 128 x T durations matrix as note events (durations truncated to ints)."""
+    # only a handful of the 128 pitch rows are ever used, so find those first
+    has_note = durations_matrix != 0
+    used_pitches = np.flatnonzero(has_note.any(axis=1))
+    pitches, onsets = np.nonzero(has_note[used_pitches])
+    pitches = used_pitches[pitches]
+    return note_events(pitches, onsets, durations_matrix[pitches, onsets])
+
+
+def events_from_time_pitches(time_pitches: Dict[int, list], flat_durations: List[int]) -> np.ndarray:
+    """
+    Build note events from a time-to-pitches mapping and a flat durations list, as produced
+    by flatten_durations() and rewritten by the exercise generators. Every pitch at a time
+    step gets that step's duration; steps whose duration is 0 produce no note.
+    """
+    pitches, onsets = [], []
+    for time, pitch_list in time_pitches.items():
+        if flat_durations[time] == 0:
+            continue
+        for p in pitch_list:
+            # chordified groups hold a nested list of pitches
+            for midi_pitch in np.ravel(p).tolist():
+                pitches.append(midi_pitch)
+                onsets.append(time)
+    if not pitches:
+        return note_events([], [], [])
+
+    # the same pitch can be moved onto a time step more than once
+    keys = np.unique(np.array(pitches, dtype=np.int64) * len(flat_durations) + np.array(onsets, dtype=np.int64))
+    pitches, onsets = np.divmod(keys, len(flat_durations))
+    return note_events(pitches, onsets, np.array(flat_durations, dtype=np.int64)[onsets])
+
+
+def sounding_spans(events: np.ndarray, length: int) -> np.ndarray:
+    """
+    Turn note events into the spans of time each pitch sounds.
+
+    Each note with a positive duration sounds for that many time steps, clipped
+    at length. As in a left-to-right scan of each pitch, an onset that falls
+    inside the span of an earlier note of the same pitch is ignored.
+    """
+    notes = events[events['duration'] > 0]
+    pitches = notes['pitch']
+    starts = notes['onset'].astype(np.int64)
+    ends = starts + notes['duration']
+
+    # events are sorted by pitch, then onset, so consecutive notes of a pitch are in time order
+    overlapping = (pitches[1:] == pitches[:-1]) & (starts[1:] < ends[:-1])
+    if overlapping.any():
+        keep = np.ones(len(notes), dtype=bool)
+        for p in np.unique(pitches[1:][overlapping]):
+            end = 0
+            for i in np.flatnonzero(pitches == p):
+                if starts[i] < end:
+                    keep[i] = False
+                else:
+                    end = ends[i]
+        pitches, starts, ends = pitches[keep], starts[keep], ends[keep]
+
+    spans = np.empty(len(pitches), dtype=SPAN_DTYPE)
+    spans['pitch'] = pitches
+    spans['start'] = starts
+    spans['end'] = np.minimum(ends, length)
+    return spans
+
+
+def piano_roll_from_spans(spans: np.ndarray, length: int, dtype=np.float64) -> np.ndarray:
+    """Render sounding spans as a dense 128 x length piano roll of 0s and 1s."""
+    piano_roll = np.zeros((NUM_PITCHES, length), dtype=dtype)
+    if len(spans) == 0:
+        return piano_roll
+
+    # +1 at each start, -1 at each end, and a running sum along time tells whether a pitch sounds
+    pitches, rows = np.unique(spans['pitch'], return_inverse=True)
+    coverage = np.zeros((len(pitches), length + 1), dtype=np.int32)
+    np.add.at(coverage, (rows, spans['start']), 1)
+    np.add.at(coverage, (rows, spans['end']), -1)
+    piano_roll[pitches] = np.cumsum(coverage[:, :length], axis=1, dtype=np.int32) > 0
+    return piano_roll
+
+
+def flatten_events(events: np.ndarray, length: int) -> Tuple[List[int], Dict[int, List[int]]]:
+    """
+    Flatten note events into a list and a time-to-pitches mapping.
+
+    The flat list holds, for every time step, the duration of the lowest pitch
+    with a nonzero duration there, or 0. The mapping sends each time step with
+    a note to its pitches in ascending order, with keys in the order a
+    row-major scan of the durations matrix meets them.
+    """
+    flat = np.zeros(length, dtype=np.int64)
+    hashmap = defaultdict(list)
+
+    notes = events[events['duration'] != 0]
+    if len(notes) == 0:
+        return flat.tolist(), hashmap
+
+    # regroup by time step, pitches ascending within each
+    notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+    note_pitches = notes['pitch'].astype(np.int64)
+    times, first = np.unique(notes['onset'], return_index=True)
+    flat[times] = notes['duration'][first]
+
+    # a row-major scan meets time steps in order of their lowest pitch
+    order = np.lexsort((times, note_pitches[first]))
+    pitch_groups = np.split(note_pitches, first[1:])
+    for k in order.tolist():
+        hashmap[int(times[k])] = pitch_groups[k].tolist()
+
+    return flat.tolist(), hashmap
+
+
+def reconstruct_piano_roll(durations_matrix: np.ndarray) -> np.ndarray:
+    """Reconstruct a piano roll from a (integer-valued) durations matrix; see sounding_spans()."""
+    length = durations_matrix.shape[1]
+    spans = sounding_spans(events_from_durations_matrix(durations_matrix), length)
+    return piano_roll_from_spans(spans, length, dtype=durations_matrix.dtype)
+
+
+def flatten_durations(durations_matrix: np.ndarray) -> Tuple[List[int], Dict[int, List[int]]]:
+    """Flatten a (integer-valued) durations matrix into a list and a time-to-pitches mapping; see flatten_events()."""
+    return flatten_events(events_from_durations_matrix(durations_matrix), durations_matrix.shape[1])
+
+
 class MusicMatrixRepresentation:
-    def __init__(self, key_signature, time_signature, quantization, piano_roll, onset_map, durations_matrix):
+    """
+    A single voice on a 128-pitch by quantized-time grid.
+
+    Notes are held as a compact NOTE_EVENT_DTYPE array (sorted by pitch, then
+    onset) together with the grid length. The dense 128 x length piano roll,
+    onset map and durations matrix are only built, and then kept, when a
+    caller asks for them. sounding gives the exact spans each pitch sounds
+    (e.g. across ties); if it is not given it is reconstructed from the
+    durations.
+
+    Passing dense matrices instead of events is still supported.
+    """
+    def __init__(self, key_signature, time_signature, quantization, piano_roll=None, onset_map=None, durations_matrix=None,
+                 events: Optional[np.ndarray] = None, length: Optional[int] = None, sounding: Optional[np.ndarray] = None):
         self.key_signature = key_signature
         self.time_signature = time_signature
         self.quantization = quantization
-        self.piano_roll = piano_roll
-        self.onset_map = onset_map
-        self.durations_matrix = durations_matrix
 
-    def reconstruct_piano_roll(self) -> np.ndarray:
-        """Reconstruct piano roll from durations matrix."""
-        new_piano_roll = np.zeros_like(self.durations_matrix)
-        rows, cols = self.durations_matrix.shape
-
-        for r in range(rows):
-            c = 0
-            while c < cols:
-                dur = int(self.durations_matrix[r, c])
-                if dur == 0:
-                    c += 1
-                else:
-                    x = c
-                    for dx in range(dur):
-                        if (x+dx) >= cols:
-                            break
-                        new_piano_roll[r, x+dx] = 1
-                    c += dur
+        if events is None:
+            events = events_from_durations_matrix(durations_matrix)
+            length = durations_matrix.shape[1]
+        self.events = events
+        self.length = length
 
-        return new_piano_roll
+        self._sounding = sounding
+        self._piano_roll = piano_roll
+        self._onset_map = onset_map
+        self._durations_matrix = durations_matrix
 
-    def flatten_durations(self) -> Tuple[List[int], Dict[int, List[int]]]:
-        """Flatten the durations matrix into a list and create a time-to-pitches mapping."""
-        flat = [int(x) for x in self.durations_matrix[0]]
-        hashmap = defaultdict(list)
+    @property
+    def pitch_range(self) -> Optional[Tuple[int, int]]:
+        """Lowest and highest MIDI pitch of the voice, or None if it has no notes."""
+        if len(self.events) == 0:
+            return None
+        return int(self.events['pitch'].min()), int(self.events['pitch'].max())
+
+    def fingerprint(self) -> str:
+        """Hash of everything the exercise is written from; equal fingerprints give identical MusicXML."""
+        digest = hashlib.sha256(np.ascontiguousarray(self.events).tobytes())
+        key_sharps = self.key_signature.sharps if self.key_signature is not None else None
+        time_signature = self.time_signature.ratioString if self.time_signature is not None else None
+        digest.update(repr((self.length, self.quantization, key_sharps, time_signature)).encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def sounding(self) -> np.ndarray:
+        if self._sounding is None:
+            self._sounding = sounding_spans(self.events, self.length)
+        return self._sounding
 
-        for ri, ci in np.ndindex(self.durations_matrix.shape):
-            if self.durations_matrix[ri, ci] != 0:
-                if flat[ci] == 0:
-                    flat[ci] = int(self.durations_matrix[ri, ci])
-                hashmap[ci].append(ri)
+    @property
+    def piano_roll(self) -> np.ndarray:
+        if self._piano_roll is None:
+            self._piano_roll = piano_roll_from_spans(self.sounding, self.length)
+        return self._piano_roll
 
-        return flat, hashmap
+    @property
+    def onset_map(self) -> np.ndarray:
+        if self._onset_map is None:
+            self._onset_map = np.zeros((NUM_PITCHES, self.length))
+            self._onset_map[self.events['pitch'], self.events['onset']] = 1
+        return self._onset_map
+
+    @property
+    def durations_matrix(self) -> np.ndarray:
+        if self._durations_matrix is None:
+            self._durations_matrix = np.zeros((NUM_PITCHES, self.length))
+            self._durations_matrix[self.events['pitch'], self.events['onset']] = self.events['duration']
+        return self._durations_matrix
+
+    def reconstruct_piano_roll(self) -> np.ndarray:
+        """Reconstruct piano roll from the note durations."""
+        return piano_roll_from_spans(sounding_spans(self.events, self.length), self.length)
+
+    def flatten_durations(self) -> Tuple[List[int], Dict[int, List[int]]]:
+        """Flatten the note durations into a list and create a time-to-pitches mapping."""
+        return flatten_events(self.events, self.length)
 
     def find_duplicate_length_ranges(self, durations_list: List[int]) -> List[Tuple[int, int, int]]:
         """Find ranges of duplicate lengths in the durations list."""
@@ -0,0 +1,379 @@
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+import numpy as np
+from music21 import key
+
+from music.matrix import MusicMatrixRepresentation
+
+# note types from longest to shortest, with their length in quarter notes and number of beams
+NOTE_TYPES = [
+    ('breve', Fraction(8), 0),
+    ('whole', Fraction(4), 0),
+    ('half', Fraction(2), 0),
+    ('quarter', Fraction(1), 0),
+    ('eighth', Fraction(1, 2), 1),
+    ('16th', Fraction(1, 4), 2),
+    ('32nd', Fraction(1, 8), 3),
+    ('64th', Fraction(1, 16), 4),
+    ('128th', Fraction(1, 32), 5),
+]
+# every writable value, longest first: each type dotted, then plain
+NOTE_VALUES = [
+    (length * Fraction(3, 2) if dots else length, name, dots, beams)
+    for name, length, beams in NOTE_TYPES
+    for dots in (1, 0)
+][1:]  # no dotted breves
+
+STEPS = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
+STEP_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+SHARP_SPELLINGS = [('C', 0), ('C', 1), ('D', 0), ('D', 1), ('E', 0), ('F', 0), ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('A', 1), ('B', 0)]
+FLAT_SPELLINGS = [('C', 0), ('D', -1), ('D', 0), ('E', -1), ('E', 0), ('F', 0), ('G', -1), ('G', 0), ('A', -1), ('A', 0), ('B', -1), ('B', 0)]
+# what music21 picks for a bare MIDI number
+DEFAULT_SPELLINGS = [('C', 0), ('C', 1), ('D', 0), ('E', -1), ('E', 0), ('F', 0), ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('B', -1), ('B', 0)]
+SHARP_ORDER = ['F', 'C', 'G', 'D', 'A', 'E', 'B']
+ACCIDENTALS = {-2: 'flat-flat', -1: 'flat', 0: 'natural', 1: 'sharp', 2: 'double-sharp'}
+
+
+class UnsupportedNotation(Exception):
+    """The events need notation (tuplets, overlapping notes in the voice, ...) this writer does not produce."""
+
+
+class PitchSpeller:
+    """Spells MIDI pitches for a key signature: scale tones as in the key, others with the key's accidental direction."""
+    def __init__(self, sharps: int):
+        self.key_alters = {step: 0 for step in STEPS}
+        for step in SHARP_ORDER[:max(sharps, 0)]:
+            self.key_alters[step] = 1
+        for step in list(reversed(SHARP_ORDER))[:max(-sharps, 0)]:
+            self.key_alters[step] = -1
+
+        fallback = SHARP_SPELLINGS if sharps > 0 else FLAT_SPELLINGS if sharps < 0 else DEFAULT_SPELLINGS
+        self.spellings = list(fallback)
+        for step, alter in self.key_alters.items():
+            self.spellings[(STEP_PITCH_CLASSES[step] + alter) % 12] = (step, alter)
+
+    def spell(self, midi: int) -> Tuple[str, int, int]:
+        """Return (step, alter, octave) for a MIDI pitch."""
+        step, alter = self.spellings[midi % 12]
+        octave = (midi - STEP_PITCH_CLASSES[step] - alter) // 12 - 1
+        return step, alter, octave
+
+
+def split_duration(length: Fraction) -> List[Tuple[Fraction, str, int, int]]:
+    """Split a length in quarter notes into writable (value, type, dots, beams) pieces, longest first."""
+    if length.denominator & (length.denominator - 1) or length.denominator > 32:
+        raise UnsupportedNotation(f"duration {length} is not a binary note value")
+    pieces = []
+    for value in NOTE_VALUES:
+        while length >= value[0]:
+            pieces.append(value)
+            length -= value[0]
+    return pieces
+
+
+def best_clef(spelled_pitches: List[Tuple[str, int, int]]) -> Tuple[str, int, int]:
+    """Return (sign, line, octave change) the way music21's clef.bestClef chooses it."""
+    heights = []
+    for step, _, octave in spelled_pitches:
+        height = octave * 7 + STEPS.index(step) + 1
+        if height > 33:
+            height += 3
+        elif height < 24:
+            height -= 3
+        heights.append(height)
+    average_height = sum(heights) / len(heights) if heights else 29.0
+
+    if average_height > 49:
+        return 'G', 2, 1
+    if average_height > 28:
+        return 'G', 2, 0
+    if average_height > 10:
+        return 'F', 4, 0
+    return 'F', 4, -1
+
+
+def _voices(mmr: MusicMatrixRepresentation) -> List[List[Tuple[int, int, List[int]]]]:
+    """
+    Group the sounding events into (onset, duration, pitches) chords and spread them over as few
+    voices as needed so that the notes within each voice never overlap.
+    """
+    notes = mmr.events[mmr.events['duration'] > 0]
+    notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+
+    # notes starting together with the same length form a chord, lowest pitch first
+    chords = {}
+    for onset, duration, pitch in zip(notes['onset'].tolist(), notes['duration'].tolist(), notes['pitch'].tolist()):
+        chords.setdefault((onset, duration), []).append(pitch)
+
+    voices, voice_ends = [], []
+    for (onset, duration), pitches in chords.items():
+        for v, end in enumerate(voice_ends):
+            if end <= onset:
+                break
+        else:
+            v = len(voices)
+            voices.append([])
+            voice_ends.append(0)
+        voices[v].append((onset, duration, pitches))
+        voice_ends[v] = onset + duration
+    return voices
+
+
+def _measure_elements(chords, measure_start: int, measure_end: int, quantization: int, fill_rests: bool = True):
+    """
+    Lay out one voice of one measure as a list of dicts (start within the measure, duration, type,
+    dots, beams, pitches, tie_stop, tie_start), splitting notes at the barlines. Gaps become rests,
+    or invisible forwards (pitches == 'forward') when fill_rests is False.
+    """
+    elements = []
+
+    def add(start, end, pitches, tie_stop=False, tie_start=False):
+        if pitches is None and not fill_rests:
+            elements.append({'start': start - measure_start, 'duration': end - start, 'pitches': 'forward'})
+            return
+        pieces = split_duration(Fraction(end - start, quantization))
+        for i, (value, type_name, dots, beams) in enumerate(pieces):
+            elements.append({
+                'start': start - measure_start,
+                'duration': int(value * quantization),
+                'type': type_name,
+                'dots': dots,
+                'beams': beams,
+                'pitches': pitches,
+                # pieces of one note are tied together; rests never are
+                'tie_stop': pitches is not None and (tie_stop or i > 0),
+                'tie_start': pitches is not None and (tie_start or i < len(pieces) - 1),
+            })
+            start += int(value * quantization)
+
+    position = measure_start
+    for onset, duration, pitches in chords:
+        end = onset + duration
+        if end <= measure_start or onset >= measure_end:
+            continue
+        start = max(onset, measure_start)
+        if start > position:
+            add(position, start, None)
+        stop = min(end, measure_end)
+        add(start, stop, pitches, tie_stop=onset < measure_start, tie_start=end > measure_end)
+        position = stop
+    if position < measure_end and fill_rests:
+        add(position, measure_end, None)
+    return elements
+
+
+def _assign_beams(elements, beam_group_ends: List[int]) -> None:
+    """Beam runs of eighths and shorter that fall within the same beam group of the measure."""
+    def beam_group(element):
+        for i, group_end in enumerate(beam_group_ends):
+            if element['start'] < group_end:
+                return i if element['start'] + element['duration'] <= group_end else None
+        return None
+
+    runs, run = [], []
+    for element in elements + [None]:
+        beamable = element is not None and isinstance(element['pitches'], list) and element['beams'] > 0
+        group = beam_group(element) if beamable else None
+        if run and (group is None or group != beam_group(run[-1])):
+            runs.append(run)
+            run = []
+        if beamable and group is not None:
+            run.append(element)
+
+    for run in runs:
+        if len(run) < 2:
+            continue
+        for i, element in enumerate(run):
+            beams = []
+            for level in range(1, element['beams'] + 1):
+                before = i > 0 and run[i - 1]['beams'] >= level
+                after = i < len(run) - 1 and run[i + 1]['beams'] >= level
+                if before and after:
+                    beams.append('continue')
+                elif before:
+                    beams.append('end')
+                elif after:
+                    beams.append('begin')
+                else:
+                    beams.append('forward hook' if i == 0 else 'backward hook')
+            element['beam_types'] = beams
+
+
+def _write_elements(lines: List[str], elements, voice: Optional[int], spelled, key_alters) -> None:
+    """Append the <note>/<forward> elements of one voice of a measure."""
+    voice_line = f'        <voice>{voice}</voice>' if voice is not None else None
+    # accidentals carry through the measure per (step, octave) within each voice, as in music21
+    shown_alters = {}
+    for element in elements:
+        if element['pitches'] == 'forward':
+            lines.append('      <forward>')
+            lines.append(f'        <duration>{element["duration"]}</duration>')
+            if voice_line:
+                lines.append(voice_line)
+            lines.append('      </forward>')
+            continue
+
+        for i, midi in enumerate(element['pitches'] if element['pitches'] is not None else [None]):
+            lines.append('      <note>')
+            if i > 0:
+                lines.append('        <chord />')
+
+            accidental = None
+            if midi is None:
+                lines.append('        <rest />')
+            else:
+                step, alter, octave = spelled[midi]
+                current = shown_alters.get((step, octave), key_alters[step])
+                if alter != current and not element['tie_stop']:
+                    accidental = ACCIDENTALS.get(alter)
+                shown_alters[(step, octave)] = alter
+                lines.append('        <pitch>')
+                lines.append(f'          <step>{step}</step>')
+                if alter:
+                    lines.append(f'          <alter>{alter}</alter>')
+                lines.append(f'          <octave>{octave}</octave>')
+                lines.append('        </pitch>')
+
+            lines.append(f'        <duration>{element["duration"]}</duration>')
+            if element['tie_stop']:
+                lines.append('        <tie type="stop" />')
+            if element['tie_start']:
+                lines.append('        <tie type="start" />')
+            if voice_line:
+                lines.append(voice_line)
+            lines.append(f'        <type>{element["type"]}</type>')
+            lines.extend(['        <dot />'] * element['dots'])
+            if accidental:
+                lines.append(f'        <accidental>{accidental}</accidental>')
+            if i == 0:
+                for level, beam_type in enumerate(element.get('beam_types', []), start=1):
+                    lines.append(f'        <beam number="{level}">{beam_type}</beam>')
+            if element['tie_stop'] or element['tie_start']:
+                lines.append('        <notations>')
+                if element['tie_stop']:
+                    lines.append('          <tied type="stop" />')
+                if element['tie_start']:
+                    lines.append('          <tied type="start" />')
+                lines.append('        </notations>')
+            lines.append('      </note>')
+
+
+def musicxml_from_events(mmr: MusicMatrixRepresentation) -> Optional[str]:
+    """
+    Write a voice straight to a MusicXML string, without building music21 streams.
+
+    The notes are laid out on the time signature's bars: notes crossing a barline are tied,
+    lengths that have no single note value are split into tied notes, gaps become rests,
+    pitches are spelled for the key signature with accidentals shown as needed in each
+    measure, and eighths and shorter are beamed by the time signature's beat groups. Notes
+    that overlap are written in additional MusicXML voices.
+
+    Returns None when there is nothing to write or the notes need notation this writer
+    does not produce (tuplets); callers should fall back to music21.
+    """
+    time_signature = mmr.time_signature
+    quantization = mmr.quantization
+    if time_signature is None or not quantization:
+        return None
+
+    voices = _voices(mmr)
+    if not voices:
+        return None
+
+    try:
+        bar_length = Fraction(time_signature.barDuration.quarterLength) * quantization
+        if bar_length.denominator != 1 or bar_length <= 0:
+            raise UnsupportedNotation(f"bar of {time_signature.ratioString} is not a whole number of steps")
+        bar_length = int(bar_length)
+
+        total_length = max(onset + duration for chords in voices for onset, duration, _ in chords)
+        num_measures = -(-total_length // bar_length)
+        # measures[m][v] holds the elements of voice v in measure m
+        measures = [
+            [
+                _measure_elements(chords, m * bar_length, (m + 1) * bar_length, quantization, fill_rests=(v == 0))
+                for v, chords in enumerate(voices)
+            ]
+            for m in range(num_measures)
+        ]
+    except UnsupportedNotation:
+        return None
+
+    beam_group_ends, position = [], Fraction(0)
+    for term in time_signature.beamSequence:
+        position += Fraction(term.duration.quarterLength) * quantization
+        beam_group_ends.append(int(position) if position.denominator == 1 else -1)
+    for measure in measures:
+        for elements in measure:
+            _assign_beams(elements, beam_group_ends)
+
+    sharps = mmr.key_signature.sharps if mmr.key_signature is not None else 0
+    speller = PitchSpeller(sharps)
+    all_pitches = [midi for chords in voices for _, _, pitches in chords for midi in pitches]
+    spelled = {midi: speller.spell(midi) for midi in set(all_pitches)}
+    clef_sign, clef_line, clef_octave_change = best_clef([spelled[midi] for midi in all_pitches])
+
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<!DOCTYPE score-partwise  PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">',
+        '<score-partwise version="4.0">',
+        '  <part-list>',
+        '    <score-part id="P1">',
+        '      <part-name>Piano</part-name>',
+        '      <part-abbreviation>Pno</part-abbreviation>',
+        '      <score-instrument id="P1-I1">',
+        '        <instrument-name>Piano</instrument-name>',
+        '      </score-instrument>',
+        '      <midi-instrument id="P1-I1">',
+        '        <midi-channel>1</midi-channel>',
+        '        <midi-program>1</midi-program>',
+        '      </midi-instrument>',
+        '    </score-part>',
+        '  </part-list>',
+        '  <part id="P1">',
+    ]
+
+    for number, measure in enumerate(measures, start=1):
+        lines.append(f'    <measure number="{number}">')
+        if number == 1:
+            lines.append('      <attributes>')
+            lines.append(f'        <divisions>{quantization}</divisions>')
+            lines.append('        <key>')
+            lines.append(f'          <fifths>{sharps}</fifths>')
+            if isinstance(mmr.key_signature, key.Key):
+                lines.append(f'          <mode>{mmr.key_signature.mode}</mode>')
+            lines.append('        </key>')
+            symbol = f' symbol="{time_signature.symbol}"' if time_signature.symbol else ''
+            lines.append(f'        <time{symbol}>')
+            lines.append(f'          <beats>{time_signature.numerator}</beats>')
+            lines.append(f'          <beat-type>{time_signature.denominator}</beat-type>')
+            lines.append('        </time>')
+            lines.append('        <clef>')
+            lines.append(f'          <sign>{clef_sign}</sign>')
+            lines.append(f'          <line>{clef_line}</line>')
+            if clef_octave_change:
+                lines.append(f'          <clef-octave-change>{clef_octave_change}</clef-octave-change>')
+            lines.append('        </clef>')
+            lines.append('      </attributes>')
+
+        written = 0
+        for v, elements in enumerate(measure):
+            if v > 0 and not any(isinstance(element['pitches'], list) for element in elements):
+                continue
+            if written:
+                lines.append('      <backup>')
+                lines.append(f'        <duration>{written}</duration>')
+                lines.append('      </backup>')
+            _write_elements(lines, elements, v + 1 if len(voices) > 1 else None, spelled, speller.key_alters)
+            written = sum(element['duration'] for element in elements)
+
+        if number == len(measures):
+            lines.append('      <barline location="right">')
+            lines.append('        <bar-style>light-heavy</bar-style>')
+            lines.append('      </barline>')
+        lines.append('    </measure>')
+
+    lines.append('  </part>')
+    lines.append('</score-partwise>')
+    return '\n'.join(lines)
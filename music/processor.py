@@ -1,30 +1,44 @@
 from music21 import *
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 from music21.musicxml.m21ToXml import ( GeneralObjectExporter )
 from music.matrix import MusicMatrixRepresentation
+from music.musicxml import musicxml_from_events
 import numpy as np
 from collections import defaultdict
 import os
-from services.database import MongoDatabase
+import copy
+import math
+import hashlib
+from services.database import get_database
+from music.cache import parsed_score_cache
 
-db = MongoDatabase()
 
+def get_cached_score(score_filename: str) -> stream.Score:
+    """
+    Returns a parse of the given score from the parsed score cache. Every call gets its own copy.
+    """
+    score_obj = get_database().get_score(score_filename)
+    if not score_obj or not score_obj['data']:
+        raise ValueError("Score not found in database")
+
+    return parsed_score_cache.get_score(score_obj['data'])
 
 def get_music21_score_notation(score_filename: str, start_m: Optional[int] = None, end_m: Optional[int] = None) -> stream.Score:
     """
     Returns the music21 score notation for the given score filename.
     Optionally extracts a specific measure range.
-    """
-    score_obj = db.get_score(score_filename)
-    score_binary = score_obj['data']
-    if score_binary != b'':
-        score = converter.parse(score_binary)
-    else:
-        raise ValueError("Score not found in database")
 
+    Parsed scores are cached in-process; the returned stream is always a copy
+    so callers are free to modify it.
+    """
+    return get_score_excerpt(get_cached_score(score_filename), start_m, end_m)
 
+def get_score_excerpt(score: stream.Score, start_m: Optional[int] = None, end_m: Optional[int] = None) -> stream.Score:
+    """
+    Returns a copy of the given measure range of an already parsed score (the whole score if no range is given).
+    """
     if not start_m and not end_m:
-        return score
+        return copy.deepcopy(score)
     
     if not start_m:
         start_m = 1
@@ -45,7 +59,47 @@ def get_music21_score_notation(score_filename: str, start_m: Optional[int] = Non
     else:
         excerpt = score.measures(start_m, end_m)
 
-    return excerpt
+    return copy.deepcopy(excerpt)
+
+def get_measure_range_from_seconds(score: stream.Score, start_second: float, end_second: Optional[float] = None) -> Dict[str, Optional[int]]:
+    """Convert a time range in seconds to a measure range, using the score's first time signature and tempo."""
+    # Get time signature
+    time_signature = score.recurse().getElementsByClass(meter.TimeSignature)[0]
+    
+    # Get tempo marking
+    tempo_marks = score.recurse().getElementsByClass(tempo.MetronomeMark)
+    tempo_marking = tempo_marks[0] if tempo_marks else None
+    bpm = tempo_marking.number if tempo_marking else 120
+
+    # Calculate measure number
+    beats_per_measure = time_signature.numerator
+    if bpm is None:
+        bpm = 120  # Default to 120 BPM if no tempo marking found
+    
+    start_measure = math.floor(start_second / 60 * bpm / beats_per_measure) + 1
+    if end_second is not None:
+        end_measure = math.floor(end_second / 60 * bpm / beats_per_measure) + 1
+        return {"start_measure": start_measure, "end_measure": end_measure}
+    return {"start_measure": start_measure, "end_measure": None}
+
+def stream_fingerprint(score: stream.Stream) -> str:
+    """
+    Hash of a stream's notated content (notes, rests, clefs, key and time signatures, measure by
+    measure and part by part). A one-part score and that part, or a one-voice part and that voice,
+    hash the same.
+    """
+    content = []
+    for part in (score.parts if isinstance(score, stream.Score) else [score]):
+        content.append('part')
+        measures = part.getElementsByClass(stream.Measure)
+        for container in (measures if measures else [part]):
+            content.append(('measure', getattr(container, 'number', None)))
+            for el in container.recurse().getElementsByClass(['Note', 'Chord', 'Rest', 'Clef', 'KeySignature', 'TimeSignature']):
+                tie_type = el.tie.type if getattr(el, 'tie', None) is not None else None
+                # fullName spells out notes, chords and rests; the signatures and clefs describe themselves in repr()
+                description = el.fullName if isinstance(el, note.GeneralNote) else repr(el)
+                content.append((el.offset, el.quarterLength, description, tie_type))
+    return hashlib.sha256(repr(content).encode('utf-8')).hexdigest()
 
 def get_musicxml_from_music21(score: stream.Score) -> Optional[str]:
     """Convert a music21 score to MusicXML string."""
@@ -60,51 +114,24 @@ def get_musicxml_from_music21(score: stream.Score) -> Optional[str]:
     else:
         raise ValueError("Score is not well-formed. Cannot convert to MusicXML.")
 
-def get_music21_from_matrix(mmr: MusicMatrixRepresentation) -> stream.Part:
-    """Reconstructs a music21 stream from the matrix representation."""
-    part = stream.Part()
-    part.insert(0, instrument.Piano())
-    part.insert(0, mmr.key_signature)
-    part.insert(0, mmr.time_signature)
-    
-    num_pitches, num_timesteps = mmr.piano_roll.shape
+def get_musicxml_from_music_matrix_representation(MMR) -> Optional[str]:
+    """
+    Convert a matrix representation to a MusicXML string.
 
-    if num_pitches == 0:
+    Written directly from the note events when possible, which skips building and
+    re-notating a music21 stream; otherwise goes through music21.
+    """
+    if MMR is None:
         return None
 
-    for t in range(num_timesteps):
-        duration_to_pitches = defaultdict(list)
+    musicxml = musicxml_from_events(MMR)
+    if musicxml is None:
+        musicxml = get_musicxml_from_music21(get_music21_from_music_matrix_representation(MMR))
+    return musicxml
 
-        for midi_pitch in range(num_pitches):
-            dur = mmr.durations_matrix[midi_pitch, t]
-            if dur > 0:
-                duration_to_pitches[dur].append(midi_pitch)
-        
-        for dur, pitches in duration_to_pitches.items():
-            quarter_length = dur / mmr.quantization
-            offset = t / mmr.quantization
-
-            if len(pitches) > 1:
-                new_chord = chord.Chord(pitches)
-                for p in new_chord.pitches:
-                    if p.accidental and p.accidental == pitch.Accidental('natural'):
-                        p.accidental = None
-                new_chord.quarterLength = quarter_length
-                part.insert(offset, new_chord)
-            else:
-                new_note = note.Note(pitches[0])
-                new_note.quarterLength = quarter_length
-                if new_note.pitch and new_note.pitch.accidental == pitch.Accidental('natural'):
-                    new_note.pitch.accidental = None
-                part.insert(offset, new_note)
-
-    part.makeMeasures(inPlace=True)
-    part.makeNotation(inPlace=True, useKeySignature=True)
-    part.makeRests(fillGaps=True, inPlace=True)
-    part.makeAccidentals(inPlace=True)
-    part.makeTies(inPlace=True)
-    
-    return part 
+def get_music21_from_matrix(mmr: MusicMatrixRepresentation) -> stream.Part:
+    """Reconstructs a music21 stream from the matrix representation."""
+    return get_music21_from_music_matrix_representation(mmr)
 
 
 def get_music21_from_music_matrix_representation(MMR):
@@ -116,20 +143,22 @@ def get_music21_from_music_matrix_representation(MMR):
     part.insert(0, instrument.Piano())
     part.insert(0, MMR.key_signature)
     part.insert(0, MMR.time_signature)
-    
-    num_pitches, num_timesteps = MMR.piano_roll.shape
 
-    if num_pitches == 0:
-        return None
+    # notes in time order, lowest pitch first at each time step
+    notes = MMR.events[MMR.events['duration'] > 0]
+    notes = notes[np.lexsort((notes['pitch'], notes['onset']))]
+    onsets = notes['onset'].tolist()
+    durations = notes['duration'].tolist()
+    midi_pitches = notes['pitch'].tolist()
 
-    for t in range(num_timesteps):
+    i = 0
+    while i < len(notes):
+        t = onsets[i]
         duration_to_pitches = defaultdict(list)
+        while i < len(notes) and onsets[i] == t:
+            duration_to_pitches[durations[i]].append(midi_pitches[i])
+            i += 1
 
-        for midi_pitch in range(num_pitches):
-            dur = MMR.durations_matrix[midi_pitch, t]
-            if dur > 0:
-                duration_to_pitches[dur].append(midi_pitch)
-        
         for dur, pitches in duration_to_pitches.items():
             quarter_length = dur / MMR.quantization
             offset = t / MMR.quantization
@@ -157,4 +186,3 @@ def get_music21_from_music_matrix_representation(MMR):
     part.makeAccidentals(inPlace=True)
     part.makeTies(inPlace=True)
     return part
-
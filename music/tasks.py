@@ -0,0 +1,132 @@
+"""
+CPU-bound work that is run in the process pool (see services/workers.py).
+
+Everything here takes and returns plain picklable values: the raw score
+bytes travel to the worker, and each worker keeps its own parsed score cache
+(backed by the shared on-disk cache) so repeated requests skip the parse.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from music.cache import parsed_score_cache
+from music.chunks import assemble_excerpt
+from music.exercise import EXERCISE_TYPES, get_all_exercises, iter_exercises, get_exercise_by_id, get_exercise_manifest
+from music.processor import get_score_excerpt, get_measure_range_from_seconds
+from services.workers import get_line_executor
+
+
+def validate_score_bytes(data: bytes) -> int:
+    """
+    Fully parse a score, keeping the parse in the worker's cache and the on-disk cache for the
+    requests that follow, and return the number of its last measure. Raise ValueError if the
+    bytes cannot be parsed by music21.
+    """
+    try:
+        score = parsed_score_cache.get_score(data)
+    except Exception as e:
+        # music21 exceptions are not always picklable, so send back a plain error
+        raise ValueError(str(e)) from None
+    return last_measure_number(score)
+
+
+def last_measure_number(score) -> int:
+    """The number of the last measure of the score's first part, or 0 if it has none."""
+    measures = score.parts[0].getElementsByClass('Measure') if score.parts else []
+    return measures[-1].number if measures else 0
+
+
+def load_excerpt(score_name: str, data: Optional[bytes], start_m: Optional[int], end_m: Optional[int],
+                 chunks: Optional[Dict[str, Any]] = None):
+    """
+    Cut a measure range from a score. If the stored chunks covering the range are given
+    ({'header': ..., 'chunks': [...]}, see music/chunks.py), only those are parsed; otherwise
+    the range is cut from the (cached) parse of the whole score's data.
+    """
+    if chunks is not None:
+        return assemble_excerpt(chunks['header'], chunks['chunks'], start_m, end_m)
+    score = parsed_score_cache.get_score(data)
+    return get_score_excerpt(score, start_m, end_m)
+
+
+def generate_exercises_from_bytes(score_name: str, data: Optional[bytes], start_m: Optional[int], end_m: Optional[int],
+                                  exercise_types: Sequence[str] = EXERCISE_TYPES, chunks: Optional[Dict[str, Any]] = None) -> Dict[str, List[Tuple[str, str]]]:
+    """Generate the exercises of the given types for a measure range, dropping empty results and categories."""
+    score_excerpt = load_excerpt(score_name, data, start_m, end_m, chunks)
+
+    # Get all exercises
+    raw_exercises = get_all_exercises(score_excerpt, executor=get_line_executor(), exercise_types=exercise_types)
+    return _drop_empty_exercises(raw_exercises)
+
+
+def generate_exercise_batch_from_bytes(score_name: str, data: bytes, ranges: Sequence[Tuple[Optional[int], Optional[int]]],
+                                      exercise_types: Sequence[str] = EXERCISE_TYPES) -> List[Tuple[Optional[Dict[str, List[Tuple[str, str]]]], Optional[str]]]:
+    """
+    Generate the exercises for several measure ranges of one score from one cached parse.
+    Returns one (exercises, None) per range, or (None, error message) for a range that fails.
+    """
+    results = []
+    for start_m, end_m in ranges:
+        try:
+            # cutting an excerpt leaves music21's caches on the score, so each range gets its own thaw
+            score_excerpt = get_score_excerpt(parsed_score_cache.get_score(data), start_m, end_m)
+            raw_exercises = get_all_exercises(score_excerpt, executor=get_line_executor(), exercise_types=exercise_types)
+            results.append((_drop_empty_exercises(raw_exercises), None))
+        except Exception as e:
+            # music21 exceptions are not always picklable, so send back a plain message
+            results.append((None, str(e)))
+    return results
+
+
+def _drop_empty_exercises(raw_exercises: Dict[str, List[Tuple[Optional[str], Optional[str]]]]) -> Dict[str, List[Tuple[str, str]]]:
+    # Filter out None values and invalid tuples
+    filtered_exercises = {}
+    for category, exercises in raw_exercises.items():
+        valid_exercises = [
+            (desc, xml) for desc, xml in exercises 
+            if desc is not None and xml is not None
+        ]
+        if valid_exercises:  # Only include categories with valid exercises
+            filtered_exercises[category] = valid_exercises
+    return filtered_exercises
+
+
+def stream_exercises_from_bytes(score_name: str, data: Optional[bytes], start_m: Optional[int], end_m: Optional[int],
+                                exercise_types: Sequence[str], chunks: Optional[Dict[str, Any]], items, cancelled) -> None:
+    """
+    Put each (category, description, musicxml) of a measure range on the items queue as soon as
+    it is ready, skipping empty results, and stop early once the cancelled event is set.
+    Meant for ProcessPool.stream().
+    """
+    if cancelled.is_set():
+        return
+    score_excerpt = load_excerpt(score_name, data, start_m, end_m, chunks)
+
+    exercises = iter_exercises(score_excerpt, executor=get_line_executor(), exercise_types=exercise_types)
+    try:
+        for category, desc, xml in exercises:
+            if cancelled.is_set():
+                break
+            if desc is not None and xml is not None:
+                items.put((category, desc, xml))
+    finally:
+        # cancels the voices still queued on the line pool
+        exercises.close()
+
+
+def exercise_manifest_from_bytes(score_name: str, data: Optional[bytes], start_m: Optional[int], end_m: Optional[int],
+                                 exercise_types: Sequence[str] = EXERCISE_TYPES, chunks: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """List the exercises of the given types for a measure range without exporting them."""
+    return get_exercise_manifest(load_excerpt(score_name, data, start_m, end_m, chunks), exercise_types)
+
+
+def exercise_from_bytes(score_name: str, data: Optional[bytes], start_m: Optional[int], end_m: Optional[int], exercise_id: str,
+                        chunks: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    """Generate and serialize one exercise of a measure range by its manifest id; KeyError if there is none."""
+    category, description, xml = get_exercise_by_id(load_excerpt(score_name, data, start_m, end_m, chunks), exercise_id)
+    return {'id': exercise_id, 'category': category, 'description': description, 'musicxml': xml}
+
+
+def measure_range_from_bytes(score_name: str, data: bytes, start_second: float, end_second: Optional[float]) -> Dict[str, Optional[int]]:
+    """Convert a time range in seconds to a measure range for the given score."""
+    score = parsed_score_cache.get_score(data)
+    return get_measure_range_from_seconds(score, start_second, end_second)
+
@@ -0,0 +1,86 @@
+"""
+Reading and checking uploaded MusicXML files.
+
+check_musicxml_structure() is the cheap check run while an upload request is
+handled: it opens the compressed container if there is one and streams the
+score document only as far as its part list and first part, so a stored file
+is only read that far. The full music21
+parse, which catches everything else, runs afterwards in a background job.
+"""
+import io
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import IO, Union
+
+CONTAINER_PATH = 'META-INF/container.xml'
+MUSICXML_ROOTS = {'score-partwise', 'score-timewise'}
+
+
+def _container_rootfile(archive: zipfile.ZipFile) -> str:
+    """The path of the score document named by the container entry of a .mxl archive."""
+    names = archive.namelist()
+    if CONTAINER_PATH not in names:
+        raise ValueError(f"Compressed MusicXML archive has no {CONTAINER_PATH}")
+    container = ET.fromstring(archive.read(CONTAINER_PATH))
+    rootfile = next((el for el in container.iter() if el.tag.endswith('rootfile')), None)
+    if rootfile is None or rootfile.get('full-path') not in names:
+        raise ValueError("Compressed MusicXML container does not name a score document in the archive")
+    return rootfile.get('full-path')
+
+
+def read_musicxml_document(data: bytes) -> bytes:
+    """Return the score document of raw MusicXML bytes, unpacking compressed (.mxl) archives."""
+    if not zipfile.is_zipfile(io.BytesIO(data)):
+        return data
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        try:
+            rootfile = _container_rootfile(archive)
+        except ValueError:
+            # be lenient when parsing: fall back to the first document in the archive
+            documents = [name for name in archive.namelist()
+                         if not name.startswith('META-INF/') and name.endswith(('.xml', '.musicxml'))]
+            if not documents:
+                raise ValueError("Compressed MusicXML archive has no score document")
+            rootfile = documents[0]
+        return archive.read(rootfile)
+
+
+def _check_document(document: IO[bytes]) -> None:
+    events = ET.iterparse(document, events=('start', 'end'))
+    _, root = next(events)
+    if root.tag not in MUSICXML_ROOTS:
+        raise ValueError(f"Not a MusicXML score: root element is <{root.tag}>")
+
+    part_ids = None
+    for event, element in events:
+        if event == 'end' and element.tag == 'part-list':
+            part_ids = [part.get('id') for part in element.findall('score-part')]
+            if not part_ids or None in part_ids:
+                raise ValueError("MusicXML part-list has no score-part, or one without an id")
+        elif event == 'start' and element.tag in ('part', 'measure'):
+            if part_ids is None:
+                raise ValueError("MusicXML score has no part-list before its music")
+            # the rest of the document is left to the full parse
+            return
+    raise ValueError("MusicXML score has no parts" if part_ids is not None else "MusicXML score has no part-list")
+
+
+def check_musicxml_structure(data: Union[bytes, IO[bytes]]) -> None:
+    """
+    Raise ValueError unless the bytes, or the seekable binary file, look like a MusicXML score:
+    a well-formed score-partwise or score-timewise document (inside a .mxl archive with a
+    container entry, if compressed) whose part-list names at least one part and is followed by music.
+    """
+    source = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    try:
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                with archive.open(_container_rootfile(archive)) as document:
+                    _check_document(document)
+        else:
+            source.seek(0)
+            _check_document(source)
+    except ET.ParseError as e:
+        raise ValueError(f"Malformed MusicXML: {e}") from None
+    except (zipfile.BadZipFile, StopIteration) as e:
+        raise ValueError(f"Malformed MusicXML: {e or 'empty document'}") from None
@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for flatten_durations on the lines of a bundled score.
+
+Compares the sparse implementation in music/matrix.py against the former
+np.ndindex scan over the full 128xT grid.
+
+    python -m scripts.bench_flatten_durations [path/to/score.mxl] [repeats]
+"""
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from music21 import converter
+
+from music.exercise import ExerciseScore
+from music.matrix import flatten_durations
+
+
+def flatten_durations_ndindex(durations_matrix):
+    flat = [int(x) for x in durations_matrix[0]]
+    hashmap = defaultdict(list)
+
+    for ri, ci in np.ndindex(durations_matrix.shape):
+        if durations_matrix[ri, ci] != 0:
+            if flat[ci] == 0:
+                flat[ci] = int(durations_matrix[ri, ci])
+            hashmap[ci].append(ri)
+
+    return flat, hashmap
+
+
+def best_of(fn, matrices, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for matrix in matrices:
+            fn(matrix)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else 'music_scores/sonata01-1.mxl'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    exercise_score = ExerciseScore(converter.parse(path))
+    matrices = [
+        line.music_matrix_representation.durations_matrix
+        for part in exercise_score.parts
+        for line in part.lines
+    ]
+    for matrix in matrices:
+        old, new = flatten_durations_ndindex(matrix), flatten_durations(matrix)
+        assert old[0] == new[0] and list(old[1].items()) == list(new[1].items())
+
+    cells = sum(matrix.size for matrix in matrices)
+    notes = sum(np.count_nonzero(matrix) for matrix in matrices)
+    old_time = best_of(flatten_durations_ndindex, matrices, repeats)
+    new_time = best_of(flatten_durations, matrices, repeats)
+    print(f"{path}: {len(matrices)} lines, {cells} cells, {notes} nonzero")
+    print(f"np.ndindex scan: {old_time * 1000:.2f} ms")
+    print(f"sparse nonzero:  {new_time * 1000:.2f} ms ({old_time / new_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Bulk import a directory of MusicXML scores.
+
+Every .xml, .musicxml and .mxl file under the directory is checked and fully
+parsed in a pool of worker processes, which also split it into measure
+chunks and, with --precompute, generate the exercises of its practice
+windows. The results are written to MongoDB in batches of bulk writes, and
+the parses are kept by the on-disk score cache for the server.
+
+Files are named as on upload. Names that are already stored are skipped, and
+so is all the work for content that is already stored: its new names just
+share it. Files that are not valid scores are listed at the end.
+
+    python -m scripts.import_scores DIRECTORY [--workers N] [--batch-size N] [--precompute]
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from werkzeug.utils import secure_filename
+
+from core.config import allowed_file, PRECOMPUTE_WINDOW_SIZES, SCORE_CHUNK_MEASURES, SCORE_STREAM_CHUNK_BYTES
+from music.cache import parsed_score_cache
+from music.chunks import split_score
+from music.tasks import validate_score_bytes, generate_exercises_from_bytes
+from music.validation import check_musicxml_structure
+from services.database import get_database
+from services.precompute import practice_windows
+from services.result_cache import GENERATOR_VERSION
+
+
+def find_score_files(directory):
+    """The score files under the directory, in name order."""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if allowed_file(name))
+    return paths
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SCORE_STREAM_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare_score(path, score_name, chunk_measures, window_sizes):
+    """
+    Check and parse a score file in a worker process, and split it into chunks and generate the
+    exercises of its practice windows. Raises ValueError if it is not a valid score.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    check_musicxml_structure(data)
+    num_measures = validate_score_bytes(data)
+    metadata = parsed_score_cache.get_score(data).metadata
+
+    exercises, errors = [], []
+    for start_m, end_m in practice_windows(num_measures, window_sizes):
+        try:
+            exercises.append((start_m, end_m, generate_exercises_from_bytes(score_name, data, start_m, end_m)))
+        except Exception as e:
+            errors.append(f"precomputing measures {start_m}-{end_m}: {e}")
+
+    return {
+        'title': metadata.title if metadata is not None else None,
+        'composer': metadata.composer if metadata is not None else None,
+        'chunked': split_score(data, chunk_measures) if chunk_measures > 0 else None,
+        'exercises': exercises,
+        'errors': errors,
+    }
+
+
+def store_file(db, path, score_name):
+    """Stream a file into GridFS and return its id."""
+    with db.open_score_file_upload(score_name) as grid_in, open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SCORE_STREAM_CHUNK_BYTES), b''):
+            grid_in.write(chunk)
+    return grid_in._id
+
+
+def write_batch(db, batch, names_by_hash, paths, sizes):
+    """Store the files of a batch of parsed contents and save all their scores with bulk writes."""
+    scores = []
+    for digest, prepared in batch:
+        names = names_by_hash[digest]
+        file_id = store_file(db, paths[names[0]], names[0])
+        for i, score_name in enumerate(names):
+            scores.append({'score_name': score_name, 'title': prepared['title'], 'composer': prepared['composer'],
+                           'content_hash': digest, 'size': sizes[score_name],
+                           # the other names with the same content share the first one's file
+                           'file_id': file_id if i == 0 else None})
+    saved = db.bulk_import_scores(scores)
+
+    saved_hashes = {score['content_hash'] for score in scores if score['score_name'] in saved}
+    db.bulk_save_score_chunks({digest: prepared['chunked'] for digest, prepared in batch
+                               if digest in saved_hashes and prepared['chunked'] is not None})
+    db.bulk_save_precomputed_exercises([
+        {'score_name': names_by_hash[digest][0], 'content_hash': digest, 'start_measure': start_m,
+         'end_measure': end_m, 'exercises': exercises, 'generator_version': GENERATOR_VERSION}
+        for digest, prepared in batch if digest in saved_hashes
+        for start_m, end_m, exercises in prepared['exercises']
+    ])
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import a directory of MusicXML scores.")
+    parser.add_argument('directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="worker processes parsing scores")
+    parser.add_argument('--batch-size', type=int, default=50, help="parsed scores saved per bulk write")
+    parser.add_argument('--precompute', action='store_true',
+                        help="also generate and store the exercises of every practice window")
+    args = parser.parse_args()
+
+    db = get_database()
+    db.ensure_score_indexes()
+    db.ensure_score_chunk_indexes()
+    started = time.perf_counter()
+    failures = []
+
+    paths = {}
+    for path in find_score_files(args.directory):
+        score_name = secure_filename(os.path.basename(path))
+        if score_name in paths:
+            failures.append((path, f"same score name as {paths[score_name]}"))
+        else:
+            paths[score_name] = path
+    existing = db.get_existing_score_names(list(paths))
+    paths = {score_name: path for score_name, path in paths.items() if score_name not in existing}
+    sizes = {score_name: os.path.getsize(path) for score_name, path in paths.items()}
+
+    names_by_hash = defaultdict(list)
+    for score_name, path in paths.items():
+        names_by_hash[hash_file(path)].append(score_name)
+    stored = db.get_score_blobs(list(names_by_hash))
+
+    # names of contents that are already stored only need their documents
+    saved = db.bulk_import_scores([
+        {'score_name': score_name, 'title': None, 'composer': None, 'content_hash': digest,
+         'size': sizes[score_name], 'file_id': None}
+        for digest in stored for score_name in names_by_hash[digest]
+    ])
+    shared = len(saved)
+
+    window_sizes = PRECOMPUTE_WINDOW_SIZES if args.precompute else []
+    # spawn rather than fork: the parent holds MongoClient threads
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {
+            pool.submit(prepare_score, paths[names[0]], names[0], SCORE_CHUNK_MEASURES, window_sizes): digest
+            for digest, names in names_by_hash.items() if digest not in stored
+        }
+        batch = []
+        for future in as_completed(futures):
+            digest = futures[future]
+            try:
+                prepared = future.result()
+            except Exception as e:
+                failures.extend((paths[score_name], str(e)) for score_name in names_by_hash[digest])
+                continue
+            failures.extend((paths[names_by_hash[digest][0]], error) for error in prepared['errors'])
+            batch.append((digest, prepared))
+            if len(batch) >= args.batch_size:
+                saved += write_batch(db, batch, names_by_hash, paths, sizes)
+                batch = []
+        if batch:
+            saved += write_batch(db, batch, names_by_hash, paths, sizes)
+
+    elapsed = time.perf_counter() - started
+    megabytes = sum(sizes.values()) / (1024 * 1024)
+    print(f"imported {len(saved)} scores ({shared} sharing stored content), "
+          f"skipped {len(existing)} already stored, {len(failures)} failures")
+    print(f"{len(paths)} files, {megabytes:.1f} MB in {elapsed:.1f}s: "
+          f"{len(paths) / elapsed:.2f} files/s, {megabytes / elapsed:.2f} MB/s")
+    for path, error in failures:
+        print(f"failed {path}: {error}")
+
+
+if __name__ == '__main__':
+    main()
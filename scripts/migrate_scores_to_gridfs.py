@@ -0,0 +1,30 @@
+"""
+Move the data of scores stored inline in their documents into GridFS.
+
+Scores uploaded before GridFS storage keep working as they are; this only
+lets them grow past the document size limit and be streamed on download.
+Safe to run again, and while the server is up: each score is moved on its
+own, and scores that are already in GridFS are skipped.
+
+    python -m scripts.migrate_scores_to_gridfs [score_name ...]
+"""
+import sys
+
+from services.database import get_database
+
+
+def main():
+    db = get_database()
+    score_names = sys.argv[1:] or db.get_inline_score_names()
+    moved = 0
+    for score_name in score_names:
+        if db.migrate_score_to_gridfs(score_name):
+            moved += 1
+            print(f"moved {score_name}")
+        else:
+            print(f"skipped {score_name}")
+    print(f"{moved} of {len(score_names)} scores moved to GridFS")
+
+
+if __name__ == '__main__':
+    main()
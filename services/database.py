@@ -1,15 +1,41 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from bson.binary import Binary
+from bson.objectid import ObjectId
+import gridfs
+import hashlib
 import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Set, Tuple, Any
+from collections import Counter
+from datetime import datetime, timezone
+import uuid
+from core.config import (
+    MONGODB_MAX_POOL_SIZE, MONGODB_MIN_POOL_SIZE, MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+    MONGODB_CONNECT_TIMEOUT_MS, MONGODB_SOCKET_TIMEOUT_MS, MONGODB_ASYNC_THREADS
+)
 
 # Load environment variables
 load_dotenv()
 
+# validation_status of stored scores: the full music21 parse runs in a background job after upload
+VALIDATION_PENDING = 'pending'
+VALIDATION_VALID = 'valid'
+VALIDATION_INVALID = 'invalid'
+
 class MongoDatabase:
-    def __init__(self):
-        """Initialize MongoDB connection."""
+    def __init__(self, client: Optional[MongoClient] = None):
+        """
+        Initialize MongoDB connection.
+
+        Args:
+            client (MongoClient, optional): Client to use instead of connecting from the
+                environment settings, e.g. a mongomock client or one to a local mongod
+        """
         # Get MongoDB configuration from environment variables
         mongodb_username = os.getenv('MONGODB_USERNAME')
         mongodb_password = os.getenv('MONGODB_PASSWORD')
@@ -24,12 +50,31 @@ class MongoDatabase:
             self.uri = f"mongodb://{mongodb_host}:{mongodb_port}"
             
         # Initialize MongoDB client and database
-        self.client = MongoClient(self.uri)
+        if client is None:
+            client = MongoClient(
+                self.uri,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS
+            )
+        self.client = client
         self.db = self.client[mongodb_database]
         self.scores = self.db['scores']
         self.exercises = self.db['exercises']
+        self.jobs = self.db['jobs']
+        self.exercise_results = self.db['exercise_results']
+        self.score_chunks = self.db['score_chunks']
+        # one entry per distinct score content, counting the scores that point at its file
+        self.score_blobs = self.db['score_blobs']
+        # Soundslice slices by the hash of the MusicXML they were made from, shared by every worker
+        self.soundslice_slices = self.db['soundslice_slices']
+        # score files too large for an inline Binary field, streamed in and out in chunks
+        self.score_files = gridfs.GridFSBucket(self.db, bucket_name='score_files')
 
-    def save_score(self, score_name: str, title: str = None, composer: str = None, data: bytes = None, score_hash: bytes = None) -> bool:
+    def save_score(self, score_name: str, title: str = None, composer: str = None, data: bytes = None, score_hash: bytes = None,
+                   file_id: ObjectId = None, content_hash: str = None, size: int = None) -> bool:
         """
         Save a score to MongoDB with all required fields.
         
@@ -37,8 +82,13 @@ class MongoDatabase:
             score_name (str): Unique identifier for the score
             title (str, optional): Title of the score
             composer (str, optional): Name of the composer
-            data (bytes, optional): The actual score data
+            data (bytes, optional): The actual score data, stored inline
             score_hash (bytes, optional): The score hash
+            file_id (ObjectId, optional): GridFS file holding the score data instead of data;
+                deleted in favour of the stored one if that content is already stored, and
+                released again if the score cannot be saved
+            content_hash (str, optional): SHA-256 of the data in the GridFS file
+            size (int, optional): Size in bytes of the data in the GridFS file
             
         Returns:
             bool: True if save was successful, False otherwise
@@ -49,29 +99,46 @@ class MongoDatabase:
             # if score already exists, ignore upload
             if self.scores.find_one({'score_name': score_name}):
                 print("score already exists, ignoring upload")
+                if file_id is not None:
+                    self.delete_score_file(file_id)
                 return True
-            
-            self.scores.update_one(
-                {'score_name': score_name},
-                {'$set': {
-                    'title': title if title is not None else score_name,
-                    'composer': composer if composer is not None else "",
-                    'data': Binary(data),
-                    'score_hash': score_hash
-                }},
-                upsert=True
-            )
+
+            fields = {
+                'title': title if title is not None else score_name,
+                'composer': composer if composer is not None else "",
+                'score_hash': score_hash
+            }
+            if file_id is not None:
+                # scores with the same content share one stored file, and its validation
+                blob = self._acquire_score_blob(content_hash, file_id, size)
+                file_id = blob['file_id']
+                fields.update({'file_id': file_id, 'content_hash': content_hash, 'size': size,
+                               'validation_status': blob.get('validation_status', VALIDATION_PENDING),
+                               'validation_error': blob.get('validation_error')})
+            else:
+                fields['data'] = Binary(data)
+            try:
+                self.scores.update_one(
+                    {'score_name': score_name},
+                    {'$set': fields},
+                    upsert=True
+                )
+            except Exception:
+                if file_id is not None:
+                    self._release_score_blob(content_hash, file_id)
+                raise
             return True
         except Exception as e:
             print(f"Error saving score: {e}")
             return False
     
-    def update_score_with_slicehash(self, score_name: str, soundslice_hash: str) -> bool:
+    def update_score_with_slicehash(self, score_name: str, soundslice_hash: str, content_hash: Optional[str] = None) -> bool:
         """
-        Update a score with a Soundslice hash.
+        Update a score with a Soundslice hash, and the hash of the MusicXML the slice was made from.
         """
         try:
-            self.scores.update_one({'score_name': score_name}, {'$set': {'soundslice_hash': soundslice_hash}})
+            self.scores.update_one({'score_name': score_name},
+                                   {'$set': {'soundslice_hash': soundslice_hash, 'soundslice_content_hash': content_hash}})
             return True
         except Exception as e:
             print(f"Error updating score with Soundslice hash: {e}")
@@ -79,7 +146,7 @@ class MongoDatabase:
 
     def get_score(self, score_name: str) -> Optional[Dict]:
         """
-        Retrieve a complete score entry by its name.
+        Retrieve a complete score entry by its name, reading its data from GridFS if it is stored there.
         
         Args:
             score_name (str): The unique identifier of the score
@@ -95,21 +162,415 @@ class MongoDatabase:
             'score_name': result['score_name'],
             'title': result.get('title', result['score_name']),
             'composer': result.get('composer'),
-            'data': result.get('data'),
-            'score_hash': result.get('score_hash')
+            'data': self.read_score_file(result['file_id']) if result.get('file_id') else result.get('data'),
+            'score_hash': result.get('score_hash'),
+            # scores from before validation was deferred were fully parsed when uploaded
+            'validation_status': result.get('validation_status', VALIDATION_VALID),
+            'validation_error': result.get('validation_error')
         }
 
+    def get_score_file_info(self, score_name: str) -> Optional[Dict]:
+        """
+        Retrieve where a score's data is stored, without reading the data.
+
+        Returns:
+            Optional[Dict]: file_id, size and content_hash for scores kept in GridFS (file_id is
+            missing for scores stored inline), None if there is no such score
+        """
+        return self.scores.find_one({'score_name': score_name}, {'_id': 0, 'file_id': 1, 'size': 1, 'content_hash': 1})
+
+    def open_score_file_upload(self, filename: str) -> gridfs.GridIn:
+        """
+        Open a GridFS file to write score data into; close() stores it and abort() discards it.
+        """
+        return self.score_files.open_upload_stream(filename)
+
+    def open_score_file_download(self, file_id: ObjectId) -> gridfs.GridOut:
+        """
+        Open a stored score file for reading in chunks.
+        """
+        return self.score_files.open_download_stream(file_id)
+
+    def read_score_file(self, file_id: ObjectId) -> bytes:
+        """
+        Read the whole data of a stored score file.
+        """
+        with self.open_score_file_download(file_id) as grid_out:
+            return grid_out.read()
+
+    def delete_score_file(self, file_id: ObjectId) -> bool:
+        """
+        Delete a stored score file.
+
+        Returns:
+            bool: True if deletion was successful, False otherwise
+        """
+        try:
+            self.score_files.delete(file_id)
+            return True
+        except Exception as e:
+            print(f"Error deleting score file: {e}")
+            return False
+
+    def get_score_blob(self, content_hash: str) -> Optional[Dict]:
+        """
+        Retrieve the stored content with the given hash: its file_id, size and reference count,
+        if any score points at it.
+        """
+        return self.score_blobs.find_one({'content_hash': content_hash}, {'_id': 0})
+
+    def save_slicehash(self, content_hash: str, soundslice_hash: str, score_name: str) -> bool:
+        """
+        Record the Soundslice slice made from some MusicXML, for any score or exercise with the same notation.
+
+        Args:
+            content_hash (str): Hash of the MusicXML the slice was made from
+            soundslice_hash (str): The slice's scorehash
+            score_name (str): The score or exercise it was made for
+
+        Returns:
+            bool: True if the slice was saved, False otherwise
+        """
+        try:
+            self.soundslice_slices.update_one(
+                {'content_hash': content_hash},
+                {'$set': {'soundslice_hash': soundslice_hash, 'score_name': score_name,
+                          'created_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            print(f"Error saving Soundslice hash: {e}")
+            return False
+
+    def find_slicehash(self, content_hash: Optional[str], score_name: str, is_exercise: bool = False) -> Optional[str]:
+        """
+        Find the Soundslice slice of some MusicXML: the one made from the same notation, or else the
+        one saved on the score or exercise of that name, unless it is known to be of other notation.
+
+        Args:
+            content_hash (str, optional): Hash of the MusicXML; None for scores stored inline
+            score_name (str): The score or exercise name
+            is_exercise (bool): Whether to look at the exercise of that name rather than the score
+
+        Returns:
+            str: The slice's scorehash, or None if there is none
+        """
+        if content_hash:
+            result = self.soundslice_slices.find_one({'content_hash': content_hash}, {'soundslice_hash': 1})
+            # slices of stored scores were kept on their content before they had a collection
+            result = result or self.score_blobs.find_one({'content_hash': content_hash, 'soundslice_hash': {'$ne': None}},
+                                                        {'soundslice_hash': 1})
+            if result:
+                return result['soundslice_hash']
+        collection = self.exercises if is_exercise else self.scores
+        result = collection.find_one({'score_name': score_name}, {'soundslice_hash': 1, 'score_hash': 1, 'soundslice_content_hash': 1})
+        if not result:
+            return None
+        if 'soundslice_content_hash' in result:
+            return result.get('soundslice_hash') if result['soundslice_content_hash'] == content_hash else None
+        # saved before the notation of slices was recorded; documents created for a slice keep it as score_hash
+        if result.get('soundslice_hash'):
+            return result['soundslice_hash']
+        return bytes(result['score_hash']).decode('utf-8') if result.get('score_hash') else None
+
+    def bulk_save_exercise_slices(self, slices: List[Dict[str, Any]]) -> bool:
+        """
+        Save the slices of many exercises with one bulk write to the exercises, creating those
+        that do not exist yet, and one to the slices by notation.
+
+        Args:
+            slices (list): One dict per exercise with its score_name, title, composer,
+                soundslice_hash and the content_hash of its MusicXML
+
+        Returns:
+            bool: True if the slices were saved, False otherwise
+        """
+        if not slices:
+            return True
+        try:
+            self.exercises.bulk_write([
+                UpdateOne(
+                    {'score_name': entry['score_name']},
+                    {'$set': {'soundslice_hash': entry['soundslice_hash'], 'soundslice_content_hash': entry['content_hash']},
+                     '$setOnInsert': {'title': entry['title'] or entry['score_name'], 'composer': entry['composer'],
+                                      'data': Binary(b''), 'score_hash': bytes(entry['soundslice_hash'], 'utf-8')}},
+                    upsert=True
+                )
+                for entry in slices
+            ], ordered=False)
+            now = datetime.now(timezone.utc)
+            self.soundslice_slices.bulk_write([
+                UpdateOne(
+                    {'content_hash': entry['content_hash']},
+                    {'$set': {'soundslice_hash': entry['soundslice_hash'], 'score_name': entry['score_name'], 'created_at': now}},
+                    upsert=True
+                )
+                for entry in slices
+            ], ordered=False)
+            return True
+        except Exception as e:
+            print(f"Error saving exercise slices: {e}")
+            return False
+
+    def forget_slicehash(self, soundslice_hash: str) -> bool:
+        """
+        Drop a slice that Soundslice could not process from everywhere it is recorded.
+        """
+        try:
+            self.soundslice_slices.delete_many({'soundslice_hash': soundslice_hash})
+            self.score_blobs.update_many({'soundslice_hash': soundslice_hash}, {'$unset': {'soundslice_hash': ''}})
+            for collection in (self.scores, self.exercises):
+                collection.update_many({'soundslice_hash': soundslice_hash}, {'$set': {'soundslice_hash': None}})
+                collection.update_many({'score_hash': soundslice_hash.encode('utf-8')}, {'$set': {'score_hash': None}})
+            return True
+        except Exception as e:
+            print(f"Error forgetting Soundslice hash: {e}")
+            return False
+
+    def set_validation_status(self, content_hash: str, status: str, error: Optional[str] = None) -> bool:
+        """
+        Record the outcome of the full parse of a stored content on it and on every score with it.
+
+        Args:
+            content_hash (str): Hash of the score data that was parsed
+            status (str): VALIDATION_VALID or VALIDATION_INVALID
+            error (str, optional): Why the data could not be parsed
+
+        Returns:
+            bool: True if the status was saved, False otherwise
+        """
+        try:
+            fields = {'validation_status': status, 'validation_error': error}
+            self.score_blobs.update_one({'content_hash': content_hash}, {'$set': fields})
+            self.scores.update_many({'content_hash': content_hash}, {'$set': fields})
+            return True
+        except Exception as e:
+            print(f"Error saving validation status: {e}")
+            return False
+
+    def _acquire_score_blob(self, content_hash: str, file_id: ObjectId, size: int,
+                            validation_status: str = VALIDATION_PENDING) -> Dict:
+        """
+        Add a reference to the stored content with the given hash, which file_id becomes if it is
+        new (with the given validation status). A file_id duplicating content that is already
+        stored is deleted. Returns the stored content's entry.
+        """
+        blob = self.score_blobs.find_one_and_update(
+            {'content_hash': content_hash},
+            {'$inc': {'refs': 1}, '$setOnInsert': {'file_id': file_id, 'size': size, 'validation_status': validation_status}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if blob['file_id'] != file_id:
+            self.delete_score_file(file_id)
+        return blob
+
+    def _release_score_blob(self, content_hash: Optional[str], file_id: ObjectId) -> None:
+        """
+        Drop a reference to stored content, deleting its file and chunks with the last one.
+        """
+        blob = None
+        if content_hash is not None:
+            blob = self.score_blobs.find_one_and_update(
+                {'content_hash': content_hash, 'file_id': file_id},
+                {'$inc': {'refs': -1}},
+                return_document=ReturnDocument.AFTER
+            )
+        if blob is None:
+            # stored before contents were shared, so the file is the score's own
+            self.delete_score_file(file_id)
+            return
+        # an upload may have taken a new reference in the meantime
+        if self.score_blobs.delete_one({'_id': blob['_id'], 'refs': {'$lte': 0}}).deleted_count:
+            self.delete_score_file(file_id)
+            self.score_chunks.delete_many({'content_hash': content_hash})
+
+    def get_inline_score_names(self) -> List[str]:
+        """
+        Names of the scores whose data is still stored inline in their document.
+        """
+        cursor = self.scores.find({'file_id': {'$exists': False}, 'data': {'$exists': True}}, {'_id': 0, 'score_name': 1})
+        return [result['score_name'] for result in cursor]
+
+    def migrate_score_to_gridfs(self, score_name: str) -> bool:
+        """
+        Move the inline data of a score into GridFS, sharing the file of any score with the same
+        content, and keep the rest of its document.
+
+        Args:
+            score_name (str): The unique identifier of the score
+
+        Returns:
+            bool: True if the data was moved, False if there was nothing to move or it failed
+        """
+        try:
+            result = self.scores.find_one({'score_name': score_name, 'file_id': {'$exists': False}})
+            if not result or not result.get('data'):
+                return False
+            data = bytes(result['data'])
+            digest = hashlib.sha256(data).hexdigest()
+            # share the content if it is already stored, else store it
+            blob = self.score_blobs.find_one_and_update({'content_hash': digest}, {'$inc': {'refs': 1}})
+            if blob is not None:
+                file_id = blob['file_id']
+            else:
+                with self.open_score_file_upload(score_name) as grid_in:
+                    grid_in.write(data)
+                # inline scores were fully parsed when they were uploaded
+                file_id = self._acquire_score_blob(digest, grid_in._id, len(data), VALIDATION_VALID)['file_id']
+            # only drop the inline copy if no other writer got there first
+            updated = self.scores.update_one(
+                {'_id': result['_id'], 'file_id': {'$exists': False}},
+                {'$set': {'file_id': file_id, 'content_hash': digest, 'size': len(data)},
+                 '$unset': {'data': ''}}
+            )
+            if updated.modified_count == 0:
+                self._release_score_blob(digest, file_id)
+                return False
+            return True
+        except Exception as e:
+            print(f"Error migrating score {score_name} to GridFS: {e}")
+            return False
+
+    def get_existing_score_names(self, score_names: List[str]) -> Set[str]:
+        """
+        Which of the given score names are already stored.
+        """
+        cursor = self.scores.find({'score_name': {'$in': list(score_names)}}, {'_id': 0, 'score_name': 1})
+        return {result['score_name'] for result in cursor}
+
+    def get_score_blobs(self, content_hashes: List[str]) -> Dict[str, Dict]:
+        """
+        Retrieve the stored contents with any of the given hashes, keyed by hash.
+        """
+        cursor = self.score_blobs.find({'content_hash': {'$in': list(content_hashes)}}, {'_id': 0})
+        return {blob['content_hash']: blob for blob in cursor}
+
+    def get_pending_scores(self) -> List[Dict]:
+        """
+        Find the stored contents whose background validation never finished, e.g. because the
+        server stopped first.
+
+        Returns:
+            List[Dict]: score_name and content_hash of one score with each pending content
+        """
+        pending = []
+        for blob in self.score_blobs.find({'validation_status': VALIDATION_PENDING}, {'_id': 0, 'content_hash': 1}):
+            score = self.scores.find_one({'content_hash': blob['content_hash']}, {'_id': 0, 'score_name': 1})
+            if score is not None:
+                pending.append({'score_name': score['score_name'], 'content_hash': blob['content_hash']})
+        return pending
+
+    def _bulk_upsert(self, collection, operations: List[UpdateOne]) -> List[int]:
+        """
+        Run upserts unordered and return the indexes of those that inserted a document. An upsert
+        that loses a race to insert the same key fails with a duplicate key error and is left out.
+        """
+        if not operations:
+            return []
+        try:
+            return sorted(collection.bulk_write(operations, ordered=False).upserted_ids)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+            return sorted(upsert['index'] for upsert in e.details['upserted'])
+
+    def bulk_import_scores(self, scores: List[Dict[str, Any]]) -> List[str]:
+        """
+        Save many fully parsed scores with a few bulk writes, sharing stored contents like save_score().
+
+        Args:
+            scores (list): One dict per score with score_name, title, composer, content_hash and size,
+                and file_id: the GridFS file just written with its data, or None if that content is
+                already stored. New files that duplicate stored content, or that no saved score
+                points at, are deleted.
+
+        Returns:
+            list: The names of the scores that were saved; scores whose name already exists are left as they are
+        """
+        new_files = {score['content_hash']: score for score in scores if score.get('file_id') is not None}
+        try:
+            # references are only counted once the scores pointing at new contents are saved
+            self._bulk_upsert(self.score_blobs, [
+                UpdateOne(
+                    {'content_hash': digest},
+                    {'$setOnInsert': {'file_id': score['file_id'], 'size': score['size'], 'refs': 0,
+                                      'validation_status': VALIDATION_VALID}},
+                    upsert=True
+                )
+                for digest, score in new_files.items()
+            ])
+            blobs = self.get_score_blobs({score['content_hash'] for score in scores})
+            for digest, score in new_files.items():
+                if digest not in blobs or blobs[digest]['file_id'] != score['file_id']:
+                    # another upload stored the same content first
+                    self.delete_score_file(score['file_id'])
+
+            stored = [score for score in scores if score['content_hash'] in blobs]
+            inserted = self._bulk_upsert(self.scores, [
+                UpdateOne(
+                    {'score_name': score['score_name']},
+                    {'$setOnInsert': {
+                        'title': score['title'] if score.get('title') is not None else score['score_name'],
+                        'composer': score['composer'] if score.get('composer') is not None else "",
+                        'score_hash': None,
+                        'file_id': blobs[score['content_hash']]['file_id'],
+                        'content_hash': score['content_hash'],
+                        'size': score['size'],
+                        'validation_status': blobs[score['content_hash']].get('validation_status', VALIDATION_PENDING),
+                        'validation_error': blobs[score['content_hash']].get('validation_error')
+                    }},
+                    upsert=True
+                )
+                for score in stored
+            ])
+            saved = [stored[i] for i in inserted]
+
+            refs = Counter(score['content_hash'] for score in saved)
+            if refs:
+                self.score_blobs.bulk_write([
+                    UpdateOne({'content_hash': digest}, {'$inc': {'refs': count}})
+                    for digest, count in refs.items()
+                ], ordered=False)
+            for digest, score in new_files.items():
+                # every name with this new content was already taken
+                if digest not in refs and self.score_blobs.delete_one(
+                        {'content_hash': digest, 'file_id': score['file_id'], 'refs': {'$lte': 0}}).deleted_count:
+                    self.delete_score_file(score['file_id'])
+            return [score['score_name'] for score in saved]
+        except Exception as e:
+            print(f"Error importing scores: {e}")
+            return []
+
     def get_all_scores(self) -> List[Dict]:
         """
-        Get all scores with their metadata (excluding XML data for efficiency).
+        Get all scores with their metadata (excluding the score data for efficiency).
         
         Returns:
             List[Dict]: List of score metadata
         """
+        return self.list_scores()
+
+    def list_scores(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[Dict]:
+        """
+        Get one page of score metadata, ordered by score name, without the score data.
+
+        Args:
+            limit (int, optional): Largest number of scores to return; all of them if None
+            after (str, optional): Only return scores whose name sorts after this one, i.e.
+                the last score_name of the previous page
+
+        Returns:
+            List[Dict]: score_name, title, composer and validation_status of each score
+        """
+        query = {'score_name': {'$gt': after}} if after is not None else {}
         cursor = self.scores.find(
-            {}, 
-            {'xml_data': 0}  # Exclude XML data from results
-        )
+            query,
+            {'_id': 0, 'score_name': 1, 'title': 1, 'composer': 1, 'validation_status': 1}  # only the metadata, never the data
+        ).sort('score_name', 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
         return list(cursor)
 
     def delete_score(self, score_name: str) -> bool:
@@ -123,8 +584,12 @@ class MongoDatabase:
             bool: True if deletion was successful, False otherwise
         """
         try:
-            result = self.scores.delete_one({'score_name': score_name})
-            return result.deleted_count > 0
+            score = self.scores.find_one_and_delete({'score_name': score_name}, {'file_id': 1, 'content_hash': 1})
+            # chunks stored under the score's name before they were shared by content
+            self.score_chunks.delete_many({'score_name': score_name})
+            if score and score.get('file_id'):
+                self._release_score_blob(score.get('content_hash'), score['file_id'])
+            return score is not None
         except Exception as e:
             print(f"Error deleting score: {e}")
             return False 
@@ -151,12 +616,13 @@ class MongoDatabase:
             print(f"Error saving exercise: {e}")
             return False
     
-    def update_exercise_with_slicehash(self, score_name: str, soundslice_hash: str) -> bool:
+    def update_exercise_with_slicehash(self, score_name: str, soundslice_hash: str, content_hash: Optional[str] = None) -> bool:
         """
-        Update an exercise with a Soundslice hash.
+        Update an exercise with a Soundslice hash, and the hash of the MusicXML the slice was made from.
         """
         try:
-            self.exercises.update_one({'score_name': score_name}, {'$set': {'soundslice_hash': soundslice_hash}})
+            self.exercises.update_one({'score_name': score_name},
+                                   {'$set': {'soundslice_hash': soundslice_hash, 'soundslice_content_hash': content_hash}})
             return True
         except Exception as e:
             print(f"Error updating exercise with Soundslice hash: {e}")
@@ -170,3 +636,378 @@ class MongoDatabase:
         if not result:
             return None
         return result
+
+    def save_precomputed_exercises(self, score_name: str, content_hash: str, start_measure: int, end_measure: int,
+                                   exercises: Dict[str, List], generator_version: str) -> bool:
+        """
+        Save the generated exercises for one measure range of a score.
+
+        Args:
+            score_name (str): The score the exercises were generated from
+            content_hash (str): Hash of the score data they were generated from
+            start_measure (int): First measure of the range
+            end_measure (int): Last measure of the range
+            exercises (Dict[str, List]): Category to list of (description, musicxml)
+            generator_version (str): Version of the code that generated them (see services.result_cache)
+
+        Returns:
+            bool: True if save was successful, False otherwise
+        """
+        try:
+            self.exercises.update_one(
+                {'score_name': precomputed_exercise_name(score_name, start_measure, end_measure)},
+                {'$set': {
+                    'source_score': score_name,
+                    'content_hash': content_hash,
+                    'start_measure': start_measure,
+                    'end_measure': end_measure,
+                    'exercises': exercises,
+                    'generator_version': generator_version
+                }},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            print(f"Error saving precomputed exercises: {e}")
+            return False
+
+    def bulk_save_precomputed_exercises(self, results: List[Dict[str, Any]]) -> bool:
+        """
+        Save the generated exercises for many measure ranges with one bulk write.
+
+        Args:
+            results (list): One dict per measure range with the score_name, content_hash,
+                start_measure, end_measure, exercises and generator_version, as for
+                save_precomputed_exercises()
+
+        Returns:
+            bool: True if save was successful, False otherwise
+        """
+        if not results:
+            return True
+        try:
+            self.exercises.bulk_write([
+                UpdateOne(
+                    {'score_name': precomputed_exercise_name(result['score_name'], result['start_measure'], result['end_measure'])},
+                    {'$set': {
+                        'source_score': result['score_name'],
+                        'content_hash': result['content_hash'],
+                        'start_measure': result['start_measure'],
+                        'end_measure': result['end_measure'],
+                        'exercises': result['exercises'],
+                        'generator_version': result['generator_version']
+                    }},
+                    upsert=True
+                )
+                for result in results
+            ], ordered=False)
+            return True
+        except Exception as e:
+            print(f"Error saving precomputed exercises: {e}")
+            return False
+
+    def get_precomputed_exercises(self, content_hash: str, start_measure: int, end_measure: int,
+                                  generator_version: str) -> Optional[Dict[str, List]]:
+        """
+        Retrieve precomputed exercises for a measure range of the given score data, whichever
+        score they were generated for. Exercises made by another version of the generator are
+        treated as missing.
+        """
+        result = self.exercises.find_one(
+            {'content_hash': content_hash, 'start_measure': start_measure, 'end_measure': end_measure,
+             'generator_version': generator_version},
+            {'exercises': 1}
+        )
+        if not result:
+            return None
+        return result.get('exercises')
+
+    def create_job(self, job_type: str, score_name: str, total: int = 0, **fields: Any) -> str:
+        """
+        Record a new background job, with any extra fields it tracks, and return its id.
+        """
+        job_id = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        self.jobs.insert_one({
+            'job_id': job_id,
+            'type': job_type,
+            'score_name': score_name,
+            'state': 'queued',
+            'total': total,
+            'completed': 0,
+            'failed': 0,
+            'error': None,
+            'created_at': now,
+            'updated_at': now,
+            **fields
+        })
+        return job_id
+
+    def update_job(self, job_id: str, inc: Optional[Dict[str, int]] = None, **fields: Any) -> bool:
+        """
+        Update a background job's fields, optionally incrementing counters.
+        """
+        try:
+            update = {'$set': {**fields, 'updated_at': datetime.now(timezone.utc)}}
+            if inc:
+                update['$inc'] = inc
+            self.jobs.update_one({'job_id': job_id}, update)
+            return True
+        except Exception as e:
+            print(f"Error updating job: {e}")
+            return False
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """
+        Retrieve a background job by its id.
+        """
+        return self.jobs.find_one({'job_id': job_id}, {'_id': 0})
+
+    def find_job(self, job_type: str, **fields: Any) -> Optional[Dict]:
+        """
+        Retrieve the most recent background job of a type with the given field values.
+        """
+        query = {'type': job_type, **fields}
+        results = list(self.jobs.find(query, {'_id': 0}).sort('created_at', -1).limit(1))
+        return results[0] if results else None
+
+    def get_jobs(self, job_type: Optional[str] = None, limit: int = 50) -> List[Dict]:
+        """
+        Get the most recent background jobs, newest first.
+        """
+        query = {'type': job_type} if job_type else {}
+        cursor = self.jobs.find(query, {'_id': 0}).sort('created_at', -1).limit(limit)
+        return list(cursor)
+
+    def ensure_score_indexes(self) -> None:
+        """
+        Create the unique score_name indexes that score and exercise lookups and listing use,
+        and the content hash indexes that scores with the same content share work through.
+        """
+        for collection in (self.scores, self.exercises):
+            try:
+                collection.create_index('score_name', unique=True)
+            except Exception as e:
+                # e.g. documents stored twice before the index existed
+                print(f"Error creating score_name index on {collection.name}: {e}")
+        self.score_blobs.create_index('content_hash', unique=True)
+        self.exercises.create_index([('content_hash', 1), ('start_measure', 1), ('end_measure', 1)])
+
+    def ensure_slicehash_indexes(self) -> None:
+        """
+        Create the indexes Soundslice slices are looked up and forgotten by.
+        """
+        self.soundslice_slices.create_index('content_hash', unique=True)
+        self.soundslice_slices.create_index('soundslice_hash')
+
+    def ensure_score_chunk_indexes(self) -> None:
+        """
+        Create the index used to look up the chunks of a score's content by measure range.
+        """
+        self.score_chunks.create_index([('content_hash', 1), ('index', 1)], unique=True)
+
+    def save_score_chunks(self, content_hash: str, header: Dict[str, Any], chunks: List[Dict[str, Any]]) -> bool:
+        """
+        Store the chunks split from a score's data, shared by every score with that data.
+
+        Args:
+            content_hash (str): Hash of the score data the chunks were split from
+            header (dict): The chunk header (document without parts, part ids, measure range)
+            chunks (list): The chunks, each with an index and first/last measure numbers
+
+        Returns:
+            bool: True if the chunks were saved, False otherwise
+        """
+        try:
+            self.score_chunks.delete_many({'content_hash': content_hash})
+            # the header is stored as the chunk with index -1
+            documents = [{'index': -1, 'header': header}] + chunks
+            self.score_chunks.insert_many([
+                {**document, 'content_hash': content_hash}
+                for document in documents
+            ])
+            return True
+        except Exception as e:
+            print(f"Error saving score chunks: {e}")
+            return False
+
+    def bulk_save_score_chunks(self, chunked: Dict[str, Dict[str, Any]]) -> bool:
+        """
+        Store the chunks split from many scores' data with one bulk insert.
+
+        Args:
+            chunked (dict): Content hash to the split_score() result for that data
+
+        Returns:
+            bool: True if the chunks were saved, False otherwise
+        """
+        if not chunked:
+            return True
+        try:
+            self.score_chunks.delete_many({'content_hash': {'$in': list(chunked)}})
+            self.score_chunks.insert_many([
+                {**document, 'content_hash': content_hash}
+                for content_hash, split in chunked.items()
+                for document in [{'index': -1, 'header': split['header']}] + split['chunks']
+            ], ordered=False)
+            return True
+        except Exception as e:
+            print(f"Error saving score chunks: {e}")
+            return False
+
+    def get_score_chunk_header(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve the chunk header of the given score data, if it was chunked.
+        """
+        result = self.score_chunks.find_one({'content_hash': content_hash, 'index': -1}, {'header': 1})
+        return result.get('header') if result else None
+
+    def get_score_chunks(self, content_hash: str, start_measure: int, end_measure: int) -> List[Dict[str, Any]]:
+        """
+        Retrieve, in order, the chunks of the given score data that hold any measure of the given range.
+        """
+        cursor = self.score_chunks.find(
+            {
+                'content_hash': content_hash,
+                'index': {'$gte': 0},
+                'first_measure': {'$lte': end_measure},
+                'last_measure': {'$gte': start_measure}
+            },
+            {'_id': 0, 'index': 1, 'first_measure': 1, 'last_measure': 1, 'attributes': 1, 'barline_attributes': 1,
+             'measures': 1, 'spanners_open_at_start': 1, 'spanners_open_at_end': 1}
+        ).sort('index', 1)
+        return list(cursor)
+
+    def ensure_exercise_result_indexes(self, ttl_seconds: int) -> None:
+        """
+        Create the lookup index and the TTL index that expires cached exercise results.
+        """
+        self.exercise_results.create_index('key', unique=True)
+        self.exercise_results.create_index('created_at', expireAfterSeconds=ttl_seconds)
+
+    def save_exercise_result(self, key: str, exercises: Dict[str, List], size: int, **metadata: Any) -> bool:
+        """
+        Store a generated exercise set under its cache key.
+
+        Args:
+            key (str): Hash of the score content, measure range and generator version
+            exercises (Dict[str, List]): Category to list of (description, musicxml)
+            size (int): Approximate size of the exercises in bytes
+            metadata: Extra fields stored alongside for inspection (measure range etc.)
+
+        Returns:
+            bool: True if save was successful, False otherwise
+        """
+        try:
+            self.exercise_results.update_one(
+                {'key': key},
+                {'$set': {
+                    **metadata,
+                    'exercises': exercises,
+                    'size': size,
+                    'created_at': datetime.now(timezone.utc)
+                }},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            print(f"Error saving exercise result: {e}")
+            return False
+
+    def get_exercise_result(self, key: str) -> Optional[Dict[str, List]]:
+        """
+        Retrieve a cached exercise set by its cache key.
+        """
+        result = self.exercise_results.find_one({'key': key}, {'exercises': 1})
+        if not result:
+            return None
+        return result.get('exercises')
+
+    def get_exercise_result_stats(self) -> Dict[str, int]:
+        """
+        Count the cached exercise sets and the bytes they hold.
+        """
+        totals = list(self.exercise_results.aggregate([
+            {'$group': {'_id': None, 'entries': {'$sum': 1}, 'bytes': {'$sum': '$size'}}}
+        ]))
+        if not totals:
+            return {'entries': 0, 'bytes': 0}
+        return {'entries': totals[0]['entries'], 'bytes': totals[0]['bytes']}
+
+
+def precomputed_exercise_name(score_name: str, start_measure: int, end_measure: int) -> str:
+    """Name under which the exercises for a measure range are stored in the exercises collection."""
+    return f"{score_name}#m{start_measure}-{end_measure}"
+
+
+_database: Optional[MongoDatabase] = None
+_database_lock = threading.Lock()
+_async_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_database() -> MongoDatabase:
+    """The process-wide database, connected on first use; every module shares its client pool."""
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _database = MongoDatabase()
+    return _database
+
+
+def set_database(database: Optional[MongoDatabase]) -> None:
+    """Replace the process-wide database, e.g. with one on a mongomock client; None reconnects on next use."""
+    global _database
+    with _database_lock:
+        _database = database
+
+
+def close_database() -> None:
+    """Close the process-wide client and stop the threads of the async wrapper."""
+    global _database, _async_executor
+    with _database_lock:
+        if _database is not None:
+            _database.client.close()
+            _database = None
+        if _async_executor is not None:
+            _async_executor.shutdown(wait=False)
+            _async_executor = None
+
+
+def _get_async_executor() -> ThreadPoolExecutor:
+    global _async_executor
+    if _async_executor is None:
+        with _database_lock:
+            if _async_executor is None:
+                _async_executor = ThreadPoolExecutor(max_workers=MONGODB_ASYNC_THREADS, thread_name_prefix='mongodb')
+    return _async_executor
+
+
+async def run_in_database_thread(fn, *args, **kwargs):
+    """Run a blocking database call on the database threads and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_async_executor(), functools.partial(fn, *args, **kwargs))
+
+
+class AsyncMongoDatabase:
+    """
+    Async view of a MongoDatabase: every method has the same arguments and result, but is
+    awaited and runs on a small thread pool, so database calls do not block the event loop.
+    """
+    def __init__(self, database: MongoDatabase):
+        self.database = database
+
+    def __getattr__(self, name: str):
+        method = getattr(self.database, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def run(*args, **kwargs):
+            return await run_in_database_thread(method, *args, **kwargs)
+        return run
+
+
+def get_async_database() -> AsyncMongoDatabase:
+    """FastAPI dependency giving the endpoints async access to the process-wide database."""
+    return AsyncMongoDatabase(get_database())
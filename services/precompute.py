@@ -0,0 +1,138 @@
+import asyncio
+from typing import Dict, List, Set, Tuple
+
+from core.config import PRECOMPUTE_WINDOW_SIZES, SCORE_CHUNK_MEASURES
+from music.chunks import split_score
+from music.tasks import validate_score_bytes, generate_exercises_from_bytes
+from services.database import get_async_database, VALIDATION_VALID, VALIDATION_INVALID
+from services.result_cache import GENERATOR_VERSION
+from services.workers import process_pool, PoolSaturatedError
+
+# keep references so running jobs are not garbage collected
+_background_tasks: Set[asyncio.Task] = set()
+# job ids of the contents being processed in this process, by content hash
+_running_jobs: Dict[str, str] = {}
+_schedule_lock = asyncio.Lock()
+
+PRECOMPUTE_JOB = 'precompute_exercises'
+
+# how long a background job waits before retrying when interactive requests fill the pool
+POOL_RETRY_DELAY = 1.0
+
+
+def practice_windows(num_measures: int, sizes: List[int]) -> List[Tuple[int, int]]:
+    """
+    Split a score into consecutive phrases of each window size, e.g. 1-4, 5-8, ... and 1-8, 9-16, ...
+    The last phrase of each size is cut short at the end of the score.
+    """
+    windows = []
+    for size in sizes:
+        for start in range(1, num_measures + 1, size):
+            window = (start, min(start + size - 1, num_measures))
+            if window not in windows:
+                windows.append(window)
+    return windows
+
+
+async def _run_when_free(fn, *args):
+    """Run a task in the process pool, waiting for room instead of failing when it is saturated."""
+    while True:
+        try:
+            return await process_pool.run(fn, *args)
+        except PoolSaturatedError:
+            await asyncio.sleep(POOL_RETRY_DELAY)
+
+
+async def store_score_chunks(score_name: str, data: bytes, digest: str) -> None:
+    """Split a score into measure chunks and store them; scores that cannot be chunked are parsed whole."""
+    if SCORE_CHUNK_MEASURES <= 0:
+        return
+    try:
+        chunked = await _run_when_free(split_score, data, SCORE_CHUNK_MEASURES)
+        if chunked is not None:
+            await get_async_database().save_score_chunks(digest, chunked['header'], chunked['chunks'])
+    except Exception as e:
+        print(f"Error chunking score {score_name}: {e}")
+
+
+async def process_uploaded_score(job_id: str, score_name: str, digest: str) -> None:
+    """
+    Fully parse a newly stored score content, read back from GridFS, and record on it whether it
+    is valid. A valid score is then split into measure chunks and its exercises are generated and
+    stored for every practice window, recording progress on the job. The parse is kept by the
+    worker's and the on-disk score caches.
+    """
+    db = get_async_database()
+    try:
+        await db.update_job(job_id, state='validating')
+        blob = await db.get_score_blob(digest)
+        if blob is None:
+            await db.update_job(job_id, state='failed', error="Score was deleted")
+            return
+        data = await db.read_score_file(blob['file_id'])
+        try:
+            num_measures = await _run_when_free(validate_score_bytes, data)
+        except ValueError as e:
+            await db.set_validation_status(digest, VALIDATION_INVALID, str(e))
+            await db.update_job(job_id, state='failed', error=f"Invalid MusicXML file: {e}")
+            return
+        await db.set_validation_status(digest, VALIDATION_VALID)
+        await store_score_chunks(score_name, data, digest)
+
+        windows = practice_windows(num_measures, PRECOMPUTE_WINDOW_SIZES)
+        await db.update_job(job_id, state='running', total=len(windows))
+
+        for start_m, end_m in windows:
+            if await db.get_precomputed_exercises(digest, start_m, end_m, GENERATOR_VERSION) is not None:
+                await db.update_job(job_id, inc={'completed': 1})
+                continue
+            try:
+                exercises = await _run_when_free(generate_exercises_from_bytes, score_name, data, start_m, end_m)
+                await db.save_precomputed_exercises(score_name, digest, start_m, end_m, exercises, GENERATOR_VERSION)
+                await db.update_job(job_id, inc={'completed': 1})
+            except Exception as e:
+                print(f"Error precomputing {score_name} measures {start_m}-{end_m}: {e}")
+                await db.update_job(job_id, inc={'failed': 1})
+
+        await db.update_job(job_id, state='done')
+    except asyncio.CancelledError:
+        await db.update_job(job_id, state='cancelled')
+        raise
+    except Exception as e:
+        print(f"Error precomputing exercises for {score_name}: {e}")
+        await db.update_job(job_id, state='failed', error=str(e))
+
+
+async def schedule_score_processing(score_name: str, digest: str) -> str:
+    """
+    Queue the background validation and precomputation of the stored content with the given hash
+    and return the job id; content that is already being processed gets the running job's id.
+    """
+    async with _schedule_lock:
+        job_id = _running_jobs.get(digest)
+        if job_id is not None:
+            return job_id
+        job_id = await get_async_database().create_job(PRECOMPUTE_JOB, score_name, content_hash=digest)
+        _running_jobs[digest] = job_id
+    task = asyncio.create_task(process_uploaded_score(job_id, score_name, digest))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(lambda _: _running_jobs.pop(digest, None))
+    return job_id
+
+
+async def resume_pending_scores() -> List[str]:
+    """
+    Queue the processing of the stored contents whose validation never finished again, e.g. those
+    of jobs cancelled when the server last stopped, and return the job ids.
+    """
+    pending = await get_async_database().get_pending_scores()
+    return [await schedule_score_processing(score['score_name'], score['content_hash']) for score in pending]
+
+
+async def cancel_background_jobs() -> None:
+    """Cancel the running jobs and wait until they have recorded it."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,90 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import music
+from core.config import (
+    EXERCISE_RESULT_CACHE_MAX_ENTRIES, EXERCISE_RESULT_CACHE_MAX_BYTES,
+    EXERCISE_MANIFEST_CACHE_MAX_ENTRIES, EXERCISE_ITEM_CACHE_MAX_ENTRIES, EXERCISE_ITEM_CACHE_MAX_BYTES
+)
+from music.cache import LRUCache
+from music.exercise import EXERCISE_TYPES
+from services.database import get_async_database
+
+
+def _generator_version() -> str:
+    """
+    Fingerprint of the exercise generation code. Any edit to the music package
+    changes it, so results cached by an older deploy are never served.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(music.__file__), '*.py'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+GENERATOR_VERSION = _generator_version()
+
+
+def exercise_result_key(content_hash: str, start_measure: int, end_measure: int, exercise_types: Iterable[str] = EXERCISE_TYPES) -> str:
+    """Cache key for the exercises of the given types of one measure range of one score's content."""
+    payload = json.dumps([content_hash, start_measure, end_measure, sorted(exercise_types), GENERATOR_VERSION])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def exercises_size(exercises: Dict[str, List]) -> int:
+    """Approximate size in bytes of an exercise set (its descriptions and MusicXML)."""
+    return sum(len(desc or '') + len(xml or '') for items in exercises.values() for desc, xml in items)
+
+
+class ExerciseResultCache:
+    """
+    Two-tier cache of generated exercise sets: an in-process LRU in front of
+    the exercise_results collection, whose TTL index expires old entries.
+    Only the database tier is awaited; memory hits return without a thread hop.
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.memory = LRUCache(max_entries, max_bytes=max_bytes)
+        self.db_hits = 0
+        self.db_misses = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, List]]:
+        exercises = self.memory.get(key)
+        if exercises is not None:
+            return exercises
+
+        exercises = await get_async_database().get_exercise_result(key)
+        if exercises is None:
+            self.db_misses += 1
+            return None
+        self.db_hits += 1
+        self.memory.put(key, exercises, size=exercises_size(exercises))
+        return exercises
+
+    async def put(self, key: str, exercises: Dict[str, List], **metadata: Any) -> None:
+        size = exercises_size(exercises)
+        self.memory.put(key, exercises, size=size)
+        await get_async_database().save_exercise_result(key, exercises, size, generator_version=GENERATOR_VERSION, **metadata)
+
+    async def stats(self) -> Dict[str, Any]:
+        lookups = self.db_hits + self.db_misses
+        return {
+            'generator_version': GENERATOR_VERSION,
+            'memory': self.memory.stats(),
+            'database': {
+                **await get_async_database().get_exercise_result_stats(),
+                'hits': self.db_hits,
+                'misses': self.db_misses,
+                'hit_rate': self.db_hits / lookups if lookups else 0.0,
+            },
+        }
+
+
+exercise_result_cache = ExerciseResultCache(EXERCISE_RESULT_CACHE_MAX_ENTRIES, EXERCISE_RESULT_CACHE_MAX_BYTES)
+
+# manifests and single exercises are cheap to regenerate, so they are only memoized in-process
+exercise_manifest_cache = LRUCache(EXERCISE_MANIFEST_CACHE_MAX_ENTRIES)
+exercise_item_cache = LRUCache(EXERCISE_ITEM_CACHE_MAX_ENTRIES, max_bytes=EXERCISE_ITEM_CACHE_MAX_BYTES)
@@ -0,0 +1,221 @@
+"""
+Background Soundslice uploads.
+
+/get_slicehash queues the creation of a slice and the upload of its notation
+here rather than making those blocking round trips itself. At most
+SOUNDSLICE_MAX_CONCURRENCY uploads talk to Soundslice at once, and a step
+that fails is tried again with exponential backoff. The slice is created
+once and its scorehash kept on the job, so a retry only repeats the upload.
+Once the notation is uploaded the slice hash is recorded, and Soundslice's
+callback to /slice_callback marks the job done or failed. /prerender_slices
+uploads a whole exercise set the same way, waiting for all of it.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple, Union
+
+from core.config import (
+    SOUNDSLICE_MAX_CONCURRENCY, SOUNDSLICE_MAX_ATTEMPTS, SOUNDSLICE_RETRY_BASE_DELAY, SOUNDSLICE_RETRY_MAX_DELAY
+)
+from music.cache import content_hash
+from services.database import get_async_database, run_in_database_thread
+from services.slicehash_cache import slicehash_cache, slice_key
+from services.soundslice import SoundsliceService, PERMANENT_ERRORS
+
+SLICE_JOB = 'soundslice_upload'
+
+soundslice = SoundsliceService()
+
+# keep references so running jobs are not garbage collected
+_background_tasks: Set[asyncio.Task] = set()
+# job ids of the uploads running in this process, by slice key
+_running_jobs: Dict[str, str] = {}
+_schedule_lock = asyncio.Lock()
+_upload_slots = asyncio.Semaphore(SOUNDSLICE_MAX_CONCURRENCY)
+# the blocking client calls run here rather than in the event loop's default executor
+_http_executor = ThreadPoolExecutor(max_workers=SOUNDSLICE_MAX_CONCURRENCY, thread_name_prefix='soundslice')
+
+
+async def _run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_http_executor, fn, *args)
+
+
+def retry_delay(attempt: int) -> float:
+    """Seconds to wait after the given failed attempt (counting from 1) before the next one."""
+    return min(SOUNDSLICE_RETRY_BASE_DELAY * 2 ** (attempt - 1), SOUNDSLICE_RETRY_MAX_DELAY)
+
+
+def _describe(error: Exception) -> str:
+    # the Soundslice client's exceptions carry no message, or keep the response body in msg
+    message = getattr(error, 'msg', None) or str(error)
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    return message or type(error).__name__
+
+
+async def record_slicehash(score_name: str, digest: Optional[str], scorehash: str, title: str, composer: str,
+                           is_exercise: bool) -> None:
+    """Store the hash of an uploaded slice on its exercise or score, and for the notation it was made from."""
+    db = get_async_database()
+    # if the score is an exercise, look in a different part of the mongoDB server
+    if is_exercise:
+        if not await db.get_exercise(score_name):
+            await db.save_exercise(score_name, score_hash=bytes(scorehash, 'utf-8'), title=title, composer=composer, data=None)
+        await db.update_exercise_with_slicehash(score_name, scorehash, digest)
+    else:
+        if not await db.get_score_file_info(score_name):
+            await db.save_score(score_name, score_hash=bytes(scorehash, 'utf-8'), title=title, composer=composer, data=None)
+        await db.update_score_with_slicehash(score_name, scorehash, digest)
+    await slicehash_cache.put(digest, score_name, scorehash)
+
+
+async def upload_slice(title: str, composer: str, musicxml: Union[str, bytes], job_id: Optional[str] = None) -> str:
+    """
+    Create a slice and upload its notation, at most SOUNDSLICE_MAX_CONCURRENCY at once, retrying
+    failed steps with exponential backoff, and return its scorehash. Progress is recorded on the
+    job, if one is given. Raises the last error once the attempts run out, or at once if it is one
+    that trying again will not fix.
+    """
+    db = get_async_database()
+    scorehash = None
+    for attempt in range(1, SOUNDSLICE_MAX_ATTEMPTS + 1):
+        try:
+            async with _upload_slots:
+                if scorehash is None:
+                    if job_id:
+                        await db.update_job(job_id, state='creating', attempts=attempt)
+                    scorehash = await _run_blocking(soundslice.create_slice, title, composer)
+                    if job_id:
+                        await db.update_job(job_id, scorehash=scorehash)
+                if job_id:
+                    await db.update_job(job_id, state='uploading', attempts=attempt)
+                await _run_blocking(soundslice.upload_notation, scorehash, musicxml)
+            return scorehash
+        except PERMANENT_ERRORS:
+            raise
+        except Exception as e:
+            if attempt == SOUNDSLICE_MAX_ATTEMPTS:
+                raise
+            delay = retry_delay(attempt)
+            print(f"Soundslice upload of {title} failed ({_describe(e)}), retrying in {delay}s")
+            if job_id:
+                await db.update_job(job_id, state='retrying', error=_describe(e))
+            await asyncio.sleep(delay)
+
+
+async def run_slice_upload(job_id: str, score_name: str, digest: Optional[str], musicxml: Optional[Union[str, bytes]],
+                           title: str, composer: str, is_exercise: bool) -> None:
+    """
+    Upload a score to Soundslice as a job, then record its hash and leave the job waiting for
+    Soundslice's callback.
+    """
+    db = get_async_database()
+    try:
+        if not musicxml:
+            try:
+                musicxml = await run_in_database_thread(soundslice.load_musicxml, score_name)
+            except ValueError as e:
+                await db.update_job(job_id, state='failed', error=str(e))
+                return
+        scorehash = await upload_slice(title, composer, musicxml, job_id)
+        await record_slicehash(score_name, digest, scorehash, title, composer, is_exercise)
+        await db.update_job(job_id, state='processing', error=None)
+    except asyncio.CancelledError:
+        await db.update_job(job_id, state='cancelled')
+        raise
+    except Exception as e:
+        print(f"Error uploading {score_name} to Soundslice: {_describe(e)}")
+        await db.update_job(job_id, state='failed', error=_describe(e))
+
+
+async def prerender_slices(exercises: Dict[str, Tuple[str, str]], composer: Optional[str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Make sure every exercise of a set has a slice, uploading the missing ones concurrently, and
+    save them all with one bulk write.
+
+    Args:
+        exercises (dict): Exercise name to (title, musicxml); names become the exercises' names
+        composer (str, optional): Artist shown on the slices
+
+    Returns:
+        tuple: ({name: scorehash}, {name: error}) for the exercises that have a slice and those that failed
+    """
+    digests = {name: content_hash(musicxml.encode('utf-8')) for name, (_, musicxml) in exercises.items()}
+    slicehashes, errors = {}, {}
+    for name, digest in digests.items():
+        scorehash = await slicehash_cache.get(digest, name, is_exercise=True)
+        if scorehash is not None:
+            slicehashes[name] = scorehash
+
+    # exercises with the same notation share one upload
+    uploads = {}
+    for name, digest in digests.items():
+        if name not in slicehashes and digest not in uploads:
+            title, musicxml = exercises[name]
+            uploads[digest] = asyncio.ensure_future(upload_slice(title, composer, musicxml))
+    results = dict(zip(uploads, await asyncio.gather(*uploads.values(), return_exceptions=True)))
+    for name, digest in digests.items():
+        if name in slicehashes or digest not in results:
+            continue
+        if isinstance(results[digest], BaseException):
+            errors[name] = _describe(results[digest])
+        else:
+            slicehashes[name] = results[digest]
+
+    saved = [{'score_name': name, 'title': exercises[name][0], 'composer': composer,
+              'soundslice_hash': scorehash, 'content_hash': digests[name]}
+             for name, scorehash in slicehashes.items()]
+    await slicehash_cache.put_exercises(saved)
+    return slicehashes, errors
+
+
+async def schedule_slice_upload(score_name: str, digest: Optional[str], musicxml: Optional[str], title: str,
+                                composer: str, is_exercise: bool) -> str:
+    """
+    Queue the upload of a score to Soundslice and return the job id; a request for a slice that is
+    already being uploaded gets the running job's id.
+
+    Args:
+        score_name (str): The score or exercise name
+        digest (str, optional): Hash of the MusicXML to upload; None for scores stored without one
+        musicxml (str, optional): The MusicXML to upload; None uploads the stored score
+    """
+    key = slice_key(digest, score_name)
+    async with _schedule_lock:
+        job_id = _running_jobs.get(key)
+        if job_id is not None:
+            return job_id
+        job_id = await get_async_database().create_job(SLICE_JOB, score_name, slice_key=key, content_hash=digest,
+                                                       scorehash=None, attempts=0)
+        _running_jobs[key] = job_id
+    task = asyncio.create_task(run_slice_upload(job_id, score_name, digest, musicxml, title, composer, is_exercise))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(lambda _: _running_jobs.pop(key, None))
+    return job_id
+
+
+async def finish_slice_job(scorehash: str, error: Optional[str] = None) -> bool:
+    """
+    Mark the job that uploaded a slice done, or failed with the error Soundslice reported, in which
+    case the slice is forgotten so the next request makes a new one. Returns False if no job
+    uploaded the slice.
+    """
+    db = get_async_database()
+    job = await db.find_job(SLICE_JOB, scorehash=scorehash)
+    if job is None:
+        return False
+    if error is None:
+        await db.update_job(job['job_id'], state='done', error=None)
+        return True
+    await db.update_job(job['job_id'], state='failed', error=error)
+    await slicehash_cache.forget(job['slice_key'], scorehash)
+    return True
+
+
+async def cancel_slice_jobs() -> None:
+    """Cancel the running uploads and wait until they have recorded it."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
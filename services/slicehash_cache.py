@@ -0,0 +1,70 @@
+from typing import Any, Dict, List, Optional
+
+from core.config import SLICEHASH_CACHE_MAX_ENTRIES
+from music.cache import LRUCache
+from services.database import get_async_database
+
+
+def slice_key(content_hash: Optional[str], score_name: str) -> str:
+    """Key of a slice: the hash of its MusicXML, or the name of a score stored without one."""
+    return content_hash or score_name
+
+
+class SlicehashCache:
+    """
+    Read-through cache of Soundslice slice hashes: an in-process LRU in front of
+    the soundslice_slices collection and the hashes saved on score and exercise
+    documents, so every worker, and a restarted one, reuses the slices already
+    made. Slices are keyed by the hash of the MusicXML they were made from, so
+    the same notation under any name shares one slice.
+    """
+    def __init__(self, max_entries: int):
+        self.memory = LRUCache(max_entries)
+        self.db_hits = 0
+        self.db_misses = 0
+
+    async def get(self, content_hash: Optional[str], score_name: str, is_exercise: bool = False) -> Optional[str]:
+        key = slice_key(content_hash, score_name)
+        scorehash = self.memory.get(key)
+        if scorehash is not None:
+            return scorehash
+
+        scorehash = await get_async_database().find_slicehash(content_hash, score_name, is_exercise)
+        if scorehash is None:
+            self.db_misses += 1
+            return None
+        self.db_hits += 1
+        self.memory.put(key, scorehash)
+        return scorehash
+
+    async def put(self, content_hash: Optional[str], score_name: str, scorehash: str) -> None:
+        self.memory.put(slice_key(content_hash, score_name), scorehash)
+        # slices of scores stored without a content hash are only kept on the score itself
+        if content_hash:
+            await get_async_database().save_slicehash(content_hash, scorehash, score_name)
+
+    async def put_exercises(self, slices: List[Dict[str, Any]]) -> None:
+        """Remember the slices of many exercises, saving them with the exercises in bulk (see bulk_save_exercise_slices())."""
+        for entry in slices:
+            self.memory.put(slice_key(entry['content_hash'], entry['score_name']), entry['soundslice_hash'])
+        await get_async_database().bulk_save_exercise_slices(slices)
+
+    async def forget(self, key: str, scorehash: str) -> None:
+        """Drop a slice everywhere it is recorded, so the next request makes a new one."""
+        if self.memory.get(key) == scorehash:
+            self.memory.pop(key)
+        await get_async_database().forget_slicehash(scorehash)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.db_hits + self.db_misses
+        return {
+            'memory': self.memory.stats(),
+            'database': {
+                'hits': self.db_hits,
+                'misses': self.db_misses,
+                'hit_rate': self.db_hits / lookups if lookups else 0.0,
+            },
+        }
+
+
+slicehash_cache = SlicehashCache(SLICEHASH_CACHE_MAX_ENTRIES)
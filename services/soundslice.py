@@ -1,12 +1,16 @@
 from io import BytesIO
-from soundsliceapi import Client, Constants
-from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from soundsliceapi import (
+    Client, Constants, METHOD_GET, METHOD_POST, METHOD_DELETE, PermissionDenied, ValidationError, RateLimited
+)
+from typing import Optional, Union
 import os
 from dotenv import load_dotenv
 from pathlib import Path
-from services.database import MongoDatabase
+from core.config import SOUNDSLICE_API_PREFIX, SOUNDSLICE_TIMEOUT, SOUNDSLICE_MAX_CONCURRENCY
+from services.database import get_database
 
-db = MongoDatabase()
 load_dotenv()
 
 SOUNDSLICE_APP_ID = os.getenv("SOUNDSLICE_APP_ID")
@@ -17,48 +21,89 @@ CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(CURRENT_DIR)))
 MUSIC_DIR = os.path.join(PROJECT_ROOT, "cs99/coda_backend/music_scores")
 
+# errors that trying again will not fix
+PERMANENT_ERRORS = (PermissionDenied, ValidationError)
+
+HTTP_METHODS = {METHOD_GET: 'GET', METHOD_POST: 'POST', METHOD_DELETE: 'DELETE'}
+
+class SessionClient(Client):
+    """
+    The Soundslice client, sending its requests through a shared keep-alive session with a
+    timeout instead of opening a new connection for each one.
+    """
+    def __init__(self, app_id: str, password: str, session: requests.Session):
+        super().__init__(app_id, password)
+        self.session = session
+
+    def make_request_raw(self, method, endpoint, data=None):
+        url = f'{self.API_PREFIX}{endpoint}'
+        response = self.session.request(HTTP_METHODS[method], url, auth=(self.app_id, self.password), data=data,
+                                        timeout=SOUNDSLICE_TIMEOUT)
+        status_code = response.status_code
+        if status_code == 403:
+            raise PermissionDenied
+        elif status_code == 422:
+            raise ValidationError(response.content)
+        elif status_code == 429:
+            raise RateLimited
+        elif status_code >= 500:
+            response.raise_for_status()
+        return response
+
 class SoundsliceService:
     def __init__(self):
-        self.client = Client(SOUNDSLICE_APP_ID, SOUNDSLICE_PASSWORD)
+        # one connection per concurrent upload, kept open between them
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SOUNDSLICE_MAX_CONCURRENCY)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.client = SessionClient(SOUNDSLICE_APP_ID, SOUNDSLICE_PASSWORD, self.session)
+        self.client.API_PREFIX = SOUNDSLICE_API_PREFIX
 
-    def create_and_upload_slice(self, score_name: str, musicxml: str, title: str, composer: str) -> str:
-        """Create a new Soundslice score and upload notation."""
-
-        if not musicxml:
-            # try to find the score in the database
-            score = db.get_score(score_name)
-            if score:
-                musicxml = score['data']
-                if musicxml == b'':
-                    raise ValueError("Score data is empty")
-            else:
-                raise ValueError("Score not found")
+    def load_musicxml(self, score_name: str) -> bytes:
+        """The stored data of a score, to upload as its notation."""
+        score = get_database().get_score(score_name)
+        if not score:
+            raise ValueError("Score not found")
+        if score['data'] == b'':
+            raise ValueError("Score data is empty")
+        return score['data']
 
-        # Create a new slice
+    def create_slice(self, title: str, composer: str) -> str:
+        """Create a new Soundslice score and return its scorehash."""
         res = self.client.create_slice(
             name=title,
             artist=composer,
             embed_status=Constants.EMBED_STATUS_ON_ALLOWLIST,
         )
-        scorehash = res['scorehash']
-        
+        return res['scorehash']
+
+    def upload_notation(self, scorehash: str, musicxml: Union[str, bytes]) -> None:
+        """
+        Upload the notation of a slice; Soundslice reports on processing it at /api/slice_callback.
+        Unlike the client's upload_slice_notation(), a failed upload to the file storage raises.
+        """
         # Use environment-based callback URL
-        callback_url = f"{BASE_URL}/slice_callback"
-        
+        callback_url = f"{BASE_URL}/api/slice_callback"
+        response = self.client.make_request(METHOD_POST, f'/slices/{scorehash}/notation-file/',
+                                            data={'callback_url': callback_url})
+
         # Handle the XML content
         if isinstance(musicxml, str):
             file_pointer = BytesIO(musicxml.encode('utf-8'))
         else:
             file_pointer = BytesIO(musicxml)
-        
+
         try:
-            # Upload the notation
-            self.client.upload_slice_notation(
-                scorehash=scorehash,
-                fp=file_pointer,
-                callback_url=callback_url
-            )
+            self.session.put(response['url'], data=file_pointer, timeout=SOUNDSLICE_TIMEOUT).raise_for_status()
         finally:
             file_pointer.close()
-        
-        return scorehash 
\ No newline at end of file
+
+    def create_and_upload_slice(self, score_name: str, musicxml: str, title: str, composer: str) -> str:
+        """Create a new Soundslice score and upload notation."""
+        if not musicxml:
+            # try to find the score in the database
+            musicxml = self.load_musicxml(score_name)
+        scorehash = self.create_slice(title, composer)
+        self.upload_notation(scorehash, musicxml)
+        return scorehash
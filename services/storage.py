@@ -0,0 +1,80 @@
+"""
+GridFS storage of score files.
+
+Uploads are streamed into GridFS chunk by chunk, hashing them and enforcing
+the size limit as they arrive, so a score is no longer capped by the 16 MB
+BSON document limit and an oversized upload is rejected without reading it
+all. Only the hash and GridFS see the data: the structure check and the
+background processing read it back from GridFS. Downloads are streamed back
+the same way.
+"""
+import hashlib
+from typing import Any, AsyncIterator, Dict, Optional
+
+from bson.objectid import ObjectId
+from fastapi import UploadFile
+
+from core.config import SCORE_UPLOAD_MAX_BYTES, SCORE_STREAM_CHUNK_BYTES
+from music.validation import check_musicxml_structure
+from services.database import AsyncMongoDatabase, get_async_database, run_in_database_thread
+
+
+class ScoreTooLargeError(Exception):
+    """Raised when an upload goes over SCORE_UPLOAD_MAX_BYTES."""
+
+
+class ScoreStorage:
+    def __init__(self, db: Optional[AsyncMongoDatabase] = None, max_bytes: int = SCORE_UPLOAD_MAX_BYTES,
+                 chunk_bytes: int = SCORE_STREAM_CHUNK_BYTES):
+        self.db = db or get_async_database()
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+
+    async def save_upload(self, filename: str, upload: UploadFile) -> Dict[str, Any]:
+        """
+        Stream an uploaded file into GridFS, hashing it on the way.
+
+        Returns the file_id, content_hash and size of the stored file. Raises ScoreTooLargeError,
+        leaving nothing stored, as soon as the upload goes over the limit.
+        """
+        grid_in = await self.db.open_score_file_upload(filename)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                chunk = await upload.read(self.chunk_bytes)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise ScoreTooLargeError(f"Score is larger than {self.max_bytes} bytes")
+                digest.update(chunk)
+                await run_in_database_thread(grid_in.write, chunk)
+            await run_in_database_thread(grid_in.close)
+        except BaseException:
+            await run_in_database_thread(grid_in.abort)
+            raise
+        return {'file_id': grid_in._id, 'content_hash': digest.hexdigest(), 'size': size}
+
+    async def check_structure(self, file_id: ObjectId) -> None:
+        """Run check_musicxml_structure() on a stored file, reading only as much of it as the check needs."""
+        grid_out = await self.db.open_score_file_download(file_id)
+        try:
+            await run_in_database_thread(check_musicxml_structure, grid_out)
+        finally:
+            grid_out.close()
+
+    async def iter_file(self, file_id: ObjectId) -> AsyncIterator[bytes]:
+        """Yield the bytes of a stored file in chunks, reading each one off the event loop."""
+        grid_out = await self.db.open_score_file_download(file_id)
+        try:
+            while True:
+                chunk = await run_in_database_thread(grid_out.read, self.chunk_bytes)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            grid_out.close()
+
+    async def delete(self, file_id: ObjectId) -> bool:
+        return await self.db.delete_score_file(file_id)
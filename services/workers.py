@@ -0,0 +1,155 @@
+import asyncio
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Optional
+
+from core.config import EXERCISE_POOL_WORKERS, EXERCISE_POOL_MAX_PENDING, EXERCISE_LINE_WORKERS
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the process pool already has as many tasks as it is allowed to queue."""
+
+
+class ProcessPool:
+    """
+    A lazily started process pool for CPU-bound work, with a cap on queued tasks.
+
+    At most max_workers tasks run at once and at most max_pending more wait in
+    the queue; anything beyond that is rejected with PoolSaturatedError rather
+    than piling up behind a slow request.
+    """
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._stream_readers: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn rather than fork: the parent holds MongoClient threads and the event loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return self._executor
+
+    @property
+    def manager(self):
+        """Manager process owning the queues and events shared with streaming tasks, started on first use."""
+        if self._manager is None:
+            self._manager = multiprocessing.get_context('spawn').Manager()
+        return self._manager
+
+    @property
+    def stream_readers(self) -> ThreadPoolExecutor:
+        """
+        Threads waiting on the items queues of streams, one per task the pool can hold, so readers
+        never wait behind each other or tie up the event loop's default executor.
+        """
+        if self._stream_readers is None:
+            self._stream_readers = ThreadPoolExecutor(max_workers=max(1, self.max_workers + self.max_pending),
+                                                      thread_name_prefix='stream-reader')
+        return self._stream_readers
+
+    def _check_capacity(self) -> None:
+        if self.in_flight >= self.max_workers + self.max_pending:
+            raise PoolSaturatedError(f"{self.in_flight} tasks already running or queued")
+
+    async def run(self, fn: Callable, *args: Any) -> Any:
+        """Run fn(*args) in a worker process without blocking the event loop."""
+        self._check_capacity()
+
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    def stream(self, fn: Callable, *args: Any) -> AsyncIterator[Any]:
+        """
+        Run fn(*args, items, cancelled) in a worker process and asynchronously iterate over
+        everything it puts on the items queue, ending when fn returns and re-raising its error.
+
+        The task is queued right away, so saturation raises PoolSaturatedError here rather than
+        during iteration. Closing the iterator early (e.g. when the client disconnects) sets the
+        cancelled event, which fn should check between items to stop its remaining work.
+        """
+        self._check_capacity()
+
+        items = self.manager.Queue()
+        cancelled = self.manager.Event()
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        task = loop.run_in_executor(self.executor, _run_streamed, fn, args, items, cancelled)
+
+        def finished(_):
+            self.in_flight -= 1
+        task.add_done_callback(finished)
+        return self._read_stream(task, items, cancelled)
+
+    async def _read_stream(self, task: asyncio.Future, items, cancelled) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    item = await loop.run_in_executor(self.stream_readers, items.get, True, STREAM_POLL_SECONDS)
+                except queue.Empty:
+                    # a task that never ran or whose worker died cannot end its stream itself
+                    if task.done():
+                        break
+                    continue
+                if item == _STREAM_END:
+                    break
+                yield item
+            await task
+        finally:
+            if not task.done():
+                cancelled.set()
+
+    def stats(self) -> dict:
+        return {
+            'max_workers': self.max_workers,
+            'max_pending': self.max_pending,
+            'in_flight': self.in_flight,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+        if self._stream_readers is not None:
+            self._stream_readers.shutdown(wait=False, cancel_futures=True)
+            self._stream_readers = None
+
+
+# marks the end of a stream's items queue
+_STREAM_END = '__stream_end__'
+# how often a stream reader with nothing to read checks whether its task is gone
+STREAM_POLL_SECONDS = 1.0
+
+
+def _run_streamed(fn: Callable, args: tuple, items, cancelled) -> Any:
+    """Run fn(*args, items, cancelled) in a worker, ending its stream however it finishes."""
+    try:
+        return fn(*args, items, cancelled)
+    finally:
+        items.put(_STREAM_END)
+
+
+process_pool = ProcessPool(EXERCISE_POOL_WORKERS, EXERCISE_POOL_MAX_PENDING)
+
+# used synchronously from inside get_all_exercises, so it has no queue limit of its own
+line_pool = ProcessPool(EXERCISE_LINE_WORKERS, 0)
+
+
+def get_line_executor() -> Optional[ProcessPoolExecutor]:
+    """Return the executor for per-voice exercise generation, or None if it is disabled."""
+    return line_pool.executor if line_pool.max_workers > 0 else None
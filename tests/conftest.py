@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+import mongomock
+import mongomock.gridfs
+import pytest
+
+# the settings are read when the modules under test are first imported
+os.environ.setdefault('MONGODB_HOST', 'localhost')
+os.environ.setdefault('MONGODB_PORT', '27017')
+os.environ.setdefault('MONGODB_DATABASE', 'coda_test')
+os.environ.setdefault('SCORE_DISK_CACHE_DIR', tempfile.mkdtemp(prefix='coda_test_cache_'))
+
+
+@pytest.fixture
+def database():
+    """A MongoDatabase on an in-memory mongomock client, installed as the process-wide database."""
+    from services.database import MongoDatabase, close_database, set_database
+    mongomock.gridfs.enable_gridfs_integration()
+    db = MongoDatabase(client=mongomock.MongoClient())
+    set_database(db)
+    yield db
+    close_database()
@@ -0,0 +1,82 @@
+import os
+import re
+
+import pytest
+
+from music.cache import parsed_score_cache
+from music.chunks import assemble_excerpt, select_chunks, spanners_cross, split_score
+from music.processor import get_musicxml_from_music21, get_score_excerpt
+
+SCORES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'music_scores')
+MEASURES_PER_CHUNK = 8
+
+NOTE = '<note><pitch><step>C</step><octave>4</octave></pitch><duration>1</duration><type>quarter</type></note>'
+SETUP = ('<attributes><divisions>1</divisions><key><fifths>0</fifths></key>'
+         '<time><beats>4</beats><beat-type>4</beat-type></time><clef><sign>G</sign><line>2</line></clef></attributes>')
+
+
+def read_score(name):
+    with open(os.path.join(SCORES, name), 'rb') as f:
+        return f.read()
+
+
+def normalized(score):
+    return re.sub(r'id="[^"]*"', '', get_musicxml_from_music21(score))
+
+
+def excerpts_match(data, chunked, start_m, end_m):
+    chunks = select_chunks(chunked['chunks'], start_m, end_m)
+    assembled = assemble_excerpt(chunked['header'], chunks, start_m, end_m)
+    full = get_score_excerpt(parsed_score_cache.get_score(data), start_m, end_m)
+    return normalized(assembled) == normalized(full)
+
+
+@pytest.mark.parametrize('name, start_m, end_m', [
+    # a wedge started in measure 8 stops in measure 9
+    ('MUS21_Melody4.mxl', 9, 16),
+    # a slur started in measure 5 runs on into measure 6
+    ('Gymnopdie_No._1__Satie.mxl', 5, 5),
+])
+def test_excerpts_cutting_a_spanner_fall_back_to_the_whole_score(name, start_m, end_m):
+    data = read_score(name)
+    chunked = split_score(data, MEASURES_PER_CHUNK)
+    chunks = select_chunks(chunked['chunks'], start_m, end_m)
+    assert spanners_cross(chunks)
+    assert not excerpts_match(data, chunked, start_m, end_m)
+
+
+@pytest.mark.parametrize('name', ['MUS21_Melody4.mxl', 'Gymnopdie_No._1__Satie.mxl', 'sonata01-1.mxl'])
+def test_chunked_excerpts_match_the_whole_score(name):
+    data = read_score(name)
+    chunked = split_score(data, MEASURES_PER_CHUNK)
+    last = chunked['header']['last_measure']
+    assembled = 0
+    for start_m in range(1, last + 1, 4):
+        for end_m in (start_m, min(start_m + 3, last), min(start_m + 7, last)):
+            if spanners_cross(select_chunks(chunked['chunks'], start_m, end_m)):
+                continue
+            assert excerpts_match(data, chunked, start_m, end_m), (start_m, end_m)
+            assembled += 1
+    assert assembled > 0
+
+
+def test_chunks_without_spanner_flags_fall_back():
+    chunked = split_score(read_score('MUS21_Melody4.mxl'), MEASURES_PER_CHUNK)
+    chunks = [{k: v for k, v in chunk.items() if not k.startswith('spanners_')} for chunk in chunked['chunks'][:1]]
+    assert spanners_cross(chunks)
+
+
+@pytest.mark.parametrize('change', [
+    '<clef><sign>F</sign><line>4</line></clef>',
+    '<key><fifths>2</fifths></key>',
+    '<time><beats>3</beats><beat-type>4</beat-type></time>',
+])
+@pytest.mark.parametrize('measures_per_chunk, start_m', [(2, 3), (1, 3), (1, 4)])
+def test_attributes_on_a_closing_barline_carry_like_in_the_whole_score(change, measures_per_chunk, start_m):
+    measures = [SETUP + NOTE * 4, NOTE * 4 + f'<attributes>{change}</attributes>', NOTE * 4, NOTE * 4]
+    data = ('<score-partwise><part-list><score-part id="P1"><part-name>Piano</part-name></score-part></part-list><part id="P1">'
+            + ''.join(f'<measure number="{n}">{body}</measure>' for n, body in enumerate(measures, 1))
+            + '</part></score-partwise>').encode('utf-8')
+    chunked = split_score(data, measures_per_chunk)
+    assert not spanners_cross(select_chunks(chunked['chunks'], start_m, 4))
+    assert excerpts_match(data, chunked, start_m, 4)
@@ -0,0 +1,43 @@
+import mongomock
+from fastapi.testclient import TestClient
+
+from main import app
+from services import database as database_module
+from services.database import MongoDatabase, close_database, get_async_database, get_database
+from services.slice_jobs import SLICE_JOB
+
+
+def create_job(db, score_name):
+    return db.create_job(SLICE_JOB, score_name, slice_key=score_name, content_hash=None, scorehash=None, attempts=0)
+
+
+def test_endpoints_share_the_installed_database(database):
+    job_id = create_job(database, 'melody.mxl')
+    assert get_database() is database
+    assert get_async_database().database is database
+
+    client = TestClient(app)
+    response = client.get(f'/api/slice_jobs/{job_id}')
+    assert response.status_code == 200
+    assert response.json()['score_name'] == 'melody.mxl'
+
+    # a job recorded after the first request is seen by the next one
+    other_id = create_job(database, 'other.mxl')
+    jobs = client.get('/api/slice_jobs').json()
+    assert {job['job_id'] for job in jobs} == {job_id, other_id}
+
+
+def test_close_database_resets_the_shared_instance(database, monkeypatch):
+    job_id = create_job(database, 'melody.mxl')
+    with TestClient(app) as client:
+        assert client.get(f'/api/slice_jobs/{job_id}').status_code == 200
+    # shutting the app down closed the database, so the next use connects again
+    assert database_module._database is None
+
+    reconnected = MongoDatabase(client=mongomock.MongoClient())
+    monkeypatch.setattr(database_module, 'MongoDatabase', lambda: reconnected)
+    assert get_database() is reconnected
+    assert TestClient(app).get(f'/api/slice_jobs/{job_id}').status_code == 404
+
+    close_database()
+    assert database_module._database is None
@@ -0,0 +1,108 @@
+"""
+The direct MusicXML writer (music/musicxml.py) against the music21 path.
+
+Outputs are parsed back with music21. The notes are compared after merging ties (offset,
+length and MIDI pitches): always against the exercise's note events, and against the
+music21 path when no notes overlap, because music21 writes overlapping notes one after
+another and shifts everything that follows. The accidentals shown are compared with those
+music21 itself puts on the same notes, measure by measure and voice by voice.
+"""
+import os
+from fractions import Fraction
+
+import pytest
+from music21 import converter, key, meter
+
+from music.exercise import ExerciseScore
+from music.matrix import MusicMatrixRepresentation, note_events
+from music.musicxml import _voices, musicxml_from_events
+from music.processor import get_music21_from_music_matrix_representation, get_musicxml_from_music21
+
+SCORES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'music_scores')
+
+
+def note_content(musicxml):
+    score = converter.parseData(musicxml, format='musicxml')
+    return sorted(
+        (Fraction(n.offset), Fraction(n.quarterLength), tuple(sorted(p.midi for p in n.pitches)))
+        for n in score.stripTies().flatten().notes
+    )
+
+
+def event_content(mmr):
+    return sorted(
+        (Fraction(onset, mmr.quantization), Fraction(duration, mmr.quantization), tuple(pitches))
+        for chords in _voices(mmr)
+        for onset, duration, pitches in chords
+    )
+
+
+def shown_accidentals(score):
+    """(measure, voice, offset, pitch, accidental shown) for every pitch of the score's first part."""
+    shown = []
+    for measure in score.parts[0].getElementsByClass('Measure'):
+        for voice in measure.voices or [measure]:
+            for n in voice.notes:
+                for p in n.pitches:
+                    accidental = p.accidental.name if p.accidental is not None and p.accidental.displayStatus else None
+                    shown.append((measure.number, voice.id if voice is not measure else None, n.offset, p.nameWithOctave, accidental))
+    return shown
+
+
+def accidentals(musicxml):
+    """The accidentals shown in the MusicXML, and those music21 shows for the same notes."""
+    score = converter.parseData(musicxml, format='musicxml')
+    written = shown_accidentals(score)
+    for n in score.recurse().notes:
+        for p in n.pitches:
+            if p.accidental is not None:
+                p.accidental.displayStatus = None
+    key_signature = score.parts[0].recurse().getElementsByClass(key.KeySignature).first()
+    # without cautionary accidentals: repeated in the measure or restated after the barline
+    for measure in score.parts[0].getElementsByClass('Measure'):
+        for voice in measure.voices or [measure]:
+            voice.makeAccidentals(inPlace=True, useKeySignature=key_signature, cautionaryNotImmediateRepeat=False)
+    return written, shown_accidentals(score)
+
+
+def exercises(name, start_m, end_m):
+    excerpt = converter.parse(os.path.join(SCORES, name)).measures(start_m, end_m)
+    for part in ExerciseScore(excerpt).parts:
+        for line in part.lines:
+            for exercise_list in line.exercises.values():
+                yield from (exercise for exercise in exercise_list if exercise is not None)
+
+
+@pytest.mark.parametrize('name, start_m, end_m', [
+    ('MUS21_Melody4.mxl', 1, 8),
+    ('BWV_0847.mxl', 1, 4),
+    ('Gymnopdie_No._1__Satie.mxl', 1, 8),
+    ('sonata01-1.mxl', 1, 4),
+])
+def test_direct_writer_matches_music21(name, start_m, end_m):
+    compared = 0
+    for exercise in exercises(name, start_m, end_m):
+        direct = musicxml_from_events(exercise)
+        if direct is None:
+            continue
+        compared += 1
+        content = note_content(direct)
+        assert content == event_content(exercise)
+        if len(_voices(exercise)) == 1:
+            reference = get_musicxml_from_music21(get_music21_from_music_matrix_representation(exercise))
+            assert content == note_content(reference)
+        written, music21_shown = accidentals(direct)
+        assert written == music21_shown
+    assert compared > 0
+
+
+def test_accidentals_are_kept_per_voice():
+    # F#4 in the first voice, and F4 in a second voice overlapping it within the same measure
+    events = note_events([66, 65, 67], [0, 1, 2], [2, 2, 6])
+    mmr = MusicMatrixRepresentation(key.KeySignature(0), meter.TimeSignature('4/4'), 2, events=events, length=8)
+    direct = musicxml_from_events(mmr)
+    assert len(_voices(mmr)) == 2
+
+    written, music21_shown = accidentals(direct)
+    assert written == music21_shown
+    assert [(pitch, accidental) for _, _, _, pitch, accidental in written] == [('F#4', 'sharp'), ('G4', None), ('F4', None)]
@@ -0,0 +1,247 @@
+"""
+The background Soundslice uploads (services/slice_jobs.py) against a stub Soundslice API.
+
+A local HTTP server stands in for Soundslice and fails on demand, and every state a job
+passes through is recorded from the database updates the uploads make.
+"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from music.cache import content_hash
+from services import slice_jobs
+from services.slicehash_cache import slicehash_cache
+from services.soundslice import SoundsliceService
+
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.1
+
+NOTATION = '<score-partwise version="4.0"><work><work-title>{}</work-title></work></score-partwise>'
+
+
+class StubSoundslice:
+    """What the stub API was asked to do, and which of its calls fail."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = 0
+        self.deny_create = False
+        self.failing_uploads = 0
+        # (scorehash, time) of every notation file upload
+        self.uploads = []
+
+    def upload_times(self, scorehash):
+        with self.lock:
+            return [t for h, t in self.uploads if h == scorehash]
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body=None):
+            data = json.dumps(body or {}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path.endswith('/slices/'):
+                with stub.lock:
+                    if stub.deny_create:
+                        return self._reply(403)
+                    stub.created += 1
+                    scorehash = f'stub{stub.created}'
+                # slow enough for a second request to find the job still running
+                time.sleep(0.2)
+                return self._reply(201, {'scorehash': scorehash})
+            if self.path.endswith('/notation-file/'):
+                host, port = self.server.server_address[:2]
+                scorehash = self.path.split('/')[-3]
+                return self._reply(200, {'url': f'http://{host}:{port}/files/{scorehash}'})
+            self._reply(404)
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with stub.lock:
+                stub.uploads.append((self.path.rsplit('/', 1)[-1], time.monotonic()))
+                failing = stub.failing_uploads > 0
+                if failing:
+                    stub.failing_uploads -= 1
+            self._reply(500 if failing else 200)
+
+    return Handler
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubSoundslice()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service = SoundsliceService()
+    service.client.API_PREFIX = f'http://127.0.0.1:{server.server_address[1]}/api/v1'
+    monkeypatch.setattr(slice_jobs, 'soundslice', service)
+    monkeypatch.setattr(slice_jobs, 'SOUNDSLICE_MAX_ATTEMPTS', MAX_ATTEMPTS)
+    monkeypatch.setattr(slice_jobs, 'SOUNDSLICE_RETRY_BASE_DELAY', RETRY_BASE_DELAY)
+    monkeypatch.setattr(slice_jobs, 'SOUNDSLICE_RETRY_MAX_DELAY', RETRY_BASE_DELAY * 4)
+    # each test runs its own event loop
+    monkeypatch.setattr(slice_jobs, '_schedule_lock', asyncio.Lock())
+    monkeypatch.setattr(slice_jobs, '_upload_slots', asyncio.Semaphore(2))
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def states(database, monkeypatch):
+    """The states each job has been put in, in order, by job id."""
+    states = {}
+    update_job = database.update_job
+
+    def recording_update_job(job_id, inc=None, **fields):
+        if 'state' in fields:
+            states.setdefault(job_id, []).append(fields['state'])
+        return update_job(job_id, inc, **fields)
+
+    monkeypatch.setattr(database, 'update_job', recording_update_job)
+    return states
+
+
+def run(coro):
+    async def run_and_cancel():
+        try:
+            return await coro
+        finally:
+            await slice_jobs.cancel_slice_jobs()
+    return asyncio.run(run_and_cancel())
+
+
+async def schedule(name, musicxml):
+    return await slice_jobs.schedule_slice_upload(name, content_hash(musicxml.encode('utf-8')), musicxml, name, 'test', True)
+
+
+async def known_slice(name, musicxml):
+    return await slicehash_cache.get(content_hash(musicxml.encode('utf-8')), name, is_exercise=True)
+
+
+async def wait_for_job(database, job_id, states=('processing', 'failed', 'done'), timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = database.get_job(job_id)
+        if job['state'] in states or time.monotonic() > deadline:
+            return job
+        await asyncio.sleep(0.02)
+
+
+async def callback(scorehash, success='1', error=None):
+    """Post Soundslice's callback to /api/slice_callback."""
+    from main import app
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        body = {'scorehash': scorehash, 'success': success}
+        if error is not None:
+            body['error'] = error
+        return await client.post('/api/slice_callback', json=body)
+
+
+def test_failing_upload_is_retried_with_backoff(stub, database, states):
+    musicxml = NOTATION.format('retried')
+    stub.failing_uploads = 2
+
+    async def upload():
+        job_id = await schedule('retried', musicxml)
+        return await wait_for_job(database, job_id), await known_slice('retried', musicxml)
+
+    job, scorehash = run(upload())
+    assert states[job['job_id']] == ['creating', 'uploading', 'retrying', 'uploading', 'retrying', 'uploading', 'processing']
+    assert job['attempts'] == 3 and job['error'] is None
+    # the slice is created once and only the upload is repeated
+    assert stub.created == 1
+    times = stub.upload_times(job['scorehash'])
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert len(gaps) == 2
+    assert gaps[0] >= 0.9 * RETRY_BASE_DELAY and gaps[1] >= 0.9 * 2 * RETRY_BASE_DELAY
+    assert scorehash == job['scorehash']
+
+
+def test_permanent_error_fails_without_retrying(stub, database, states):
+    stub.deny_create = True
+
+    async def upload():
+        return await wait_for_job(database, await schedule('denied', NOTATION.format('denied')), ('failed', 'processing'))
+
+    job = run(upload())
+    assert states[job['job_id']] == ['creating', 'failed']
+    assert job['attempts'] == 1
+    assert stub.uploads == []
+
+
+def test_job_fails_once_its_attempts_run_out(stub, database, states):
+    stub.failing_uploads = MAX_ATTEMPTS
+
+    async def upload():
+        return await wait_for_job(database, await schedule('exhausted', NOTATION.format('exhausted')), ('failed', 'processing'))
+
+    job = run(upload())
+    assert states[job['job_id']] == ['creating', 'uploading', 'retrying', 'uploading', 'retrying', 'uploading', 'failed']
+    assert job['attempts'] == MAX_ATTEMPTS
+    assert len(stub.upload_times(job['scorehash'])) == MAX_ATTEMPTS
+
+
+def test_concurrent_requests_for_the_same_notation_share_one_job(stub, database, states):
+    musicxml = NOTATION.format('shared')
+
+    async def upload():
+        job_ids = await asyncio.gather(schedule('shared', musicxml), schedule('shared-copy', musicxml))
+        await wait_for_job(database, job_ids[0])
+        return job_ids
+
+    job_ids = run(upload())
+    assert job_ids[0] == job_ids[1]
+    assert stub.created == 1
+    assert list(states) == [job_ids[0]]
+
+
+def test_callback_marks_the_job_done(stub, database, states):
+    async def upload():
+        job = await wait_for_job(database, await schedule('finished', NOTATION.format('finished')))
+        response = await callback(job['scorehash'])
+        return job['job_id'], response
+
+    job_id, response = run(upload())
+    assert response.status_code == 200
+    assert states[job_id] == ['creating', 'uploading', 'processing', 'done']
+    assert database.get_job(job_id)['error'] is None
+
+
+def test_failed_callback_fails_the_job_and_forgets_the_slice(stub, database, states):
+    musicxml = NOTATION.format('rejected')
+
+    async def upload():
+        job = await wait_for_job(database, await schedule('rejected', musicxml))
+        response = await callback(job['scorehash'], success='2', error='bad notation')
+        forgotten = await known_slice('rejected', musicxml) is None
+        retry_id = await schedule('rejected', musicxml)
+        await wait_for_job(database, retry_id)
+        return job['job_id'], response, forgotten, retry_id
+
+    job_id, response, forgotten, retry_id = run(upload())
+    assert response.status_code == 400
+    assert states[job_id] == ['creating', 'uploading', 'processing', 'failed']
+    assert database.get_job(job_id)['error'] == 'bad notation'
+    assert forgotten
+    # the next request for the notation makes a new slice
+    assert retry_id != job_id
+    assert stub.created == 2
+
+
+def test_callback_for_an_unknown_slice_is_ignored(stub, database, states):
+    assert not run(slice_jobs.finish_slice_job('unknown'))
+    assert states == {}